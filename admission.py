@@ -0,0 +1,321 @@
+import os
+import json
+import math
+import time
+import heapq
+import asyncio
+import logging
+import threading
+import itertools
+import contextvars
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from dotenv import load_dotenv
+from metrics import metrics
+from chat_session import estimate_tokens
+
+# ตั้งค่าการบันทึกล็อก
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# โหลดค่าจากไฟล์ .env
+load_dotenv()
+
+# เปิด/ปิดการควบคุมการรับคำขอ
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() == "true"
+# header ที่ใช้ระบุผู้ใช้ (ถ้าไม่มีจะใช้ IP ของ client)
+ADMISSION_IDENTITY_HEADER = os.getenv("ADMISSION_IDENTITY_HEADER", "X-API-Key")
+# จำนวนคำขอที่ทำงานหรือรอคิวพร้อมกันได้ต่อผู้ใช้
+ADMISSION_USER_CONCURRENCY = int(os.getenv("ADMISSION_USER_CONCURRENCY", "4"))
+# จำนวน token ของ OpenAI ที่ผู้ใช้แต่ละคนใช้ได้ต่อนาที (0 = ไม่จำกัด)
+ADMISSION_USER_TOKENS_PER_MINUTE = int(os.getenv("ADMISSION_USER_TOKENS_PER_MINUTE", "0"))
+# น้ำหนักของผู้ใช้ในการแบ่งคิว ในรูปแบบ JSON {"ผู้ใช้": น้ำหนัก} (ค่าเริ่มต้น 1)
+ADMISSION_USER_WEIGHTS = json.loads(os.getenv("ADMISSION_USER_WEIGHTS", "{}") or "{}")
+# จำนวนงานที่เรียก OpenAI และงานฐานข้อมูลที่ทำงานพร้อมกันได้ทั้งหมด (ต่อ worker)
+ADMISSION_MAX_OPENAI = int(os.getenv("ADMISSION_MAX_OPENAI", "16"))
+ADMISSION_MAX_DB = int(os.getenv("ADMISSION_MAX_DB", "16"))
+# เวลารอคิวสูงสุดก่อนตอบ 429 (วินาที)
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "10"))
+# จำนวน token ของคำตอบที่ใช้ประมาณค่าเมื่อไม่ได้รับข้อมูลการใช้งานจริง (เช่น stream)
+ADMISSION_ESTIMATED_COMPLETION_TOKENS = int(os.getenv("ADMISSION_ESTIMATED_COMPLETION_TOKENS", "500"))
+# จำนวน thread ของ default executor (0 = คำนวณจากจำนวนงานที่ทำงานพร้อมกันได้)
+ADMISSION_THREAD_POOL_SIZE = int(os.getenv("ADMISSION_THREAD_POOL_SIZE", "0"))
+
+# คำขอที่กำลังทำงานใน context ปัจจุบัน (ส่งต่อไปยัง thread ของ asyncio.to_thread โดยอัตโนมัติ)
+_current_ticket = contextvars.ContextVar("admission_ticket", default=None)
+
+class AdmissionRejected(Exception):
+    """
+    คำขอเกินโควตา ให้ลองใหม่หลังจาก retry_after วินาที
+
+    identity ระบุผู้ใช้ที่เกินโควตาของตัวเอง (None เมื่อคิวรวมเต็ม)
+    """
+
+    def __init__(self, message, retry_after, identity=None):
+        super().__init__(message)
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+        self.identity = identity
+
+class _FairQueue:
+    """
+    ช่องทำงานจำนวนจำกัดของทรัพยากรหนึ่งประเภท แบ่งให้ผู้ใช้ด้วย weighted fair queuing
+
+    คำขอที่ต้องรอจะได้ tag = max(virtual time, tag ล่าสุดของผู้ใช้) + 1/น้ำหนัก และได้ช่องตามลำดับ tag
+    ผู้ใช้ที่ส่งคำขอรัวๆ จะได้ tag ที่ไกลออกไปเรื่อยๆ ทำให้คำขอของผู้ใช้อื่นแทรกเข้ามาได้
+    (ใช้ภายใน event loop เดียว)
+    """
+
+    def __init__(self, name, capacity):
+        self.name = name
+        self.capacity = max(1, capacity)
+        self.in_use = 0
+        self._heap = []
+        self._sequence = itertools.count()
+        self._virtual_time = 0.0
+        self._last_tags = {}
+        # เวลาเฉลี่ยที่ใช้ช่องทำงาน (วินาที) สำหรับประมาณ Retry-After
+        self.average_hold = 1.0
+
+    def retry_after(self):
+        return self.average_hold * (len(self._heap) + 1) / self.capacity
+
+    async def acquire(self, identity, weight, timeout):
+        if self.in_use < self.capacity and not self._heap:
+            self.in_use += 1
+            return
+        tag = max(self._virtual_time, self._last_tags.get(identity, 0.0)) + 1.0 / weight
+        self._last_tags[identity] = tag
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (tag, next(self._sequence), future))
+        metrics.increment(f"admission.{self.name}.queued")
+        started = time.perf_counter()
+        try:
+            await asyncio.wait({future}, timeout=timeout)
+        except asyncio.CancelledError:
+            # client ยกเลิกระหว่างรอ ถ้าได้ช่องไปแล้วต้องคืน
+            if future.done() and not future.cancelled():
+                self.release()
+            else:
+                future.cancel()
+            raise
+        metrics.observe(f"admission.{self.name}.queue_wait", (time.perf_counter() - started) * 1000)
+        if not future.done():
+            future.cancel()
+            metrics.increment(f"admission.{self.name}.timeouts")
+            raise AdmissionRejected(f"คิวของ {self.name} เต็ม กรุณาลองใหม่ภายหลัง", self.retry_after())
+
+    def release(self, held_seconds=None):
+        if held_seconds is not None:
+            self.average_hold = 0.9 * self.average_hold + 0.1 * held_seconds
+        while self._heap:
+            tag, _, future = heapq.heappop(self._heap)
+            if future.cancelled():
+                continue
+            # ส่งต่อช่องให้คำขอถัดไปโดยตรง (in_use ไม่เปลี่ยน)
+            self._virtual_time = tag
+            future.set_result(None)
+            return
+        self.in_use -= 1
+        if self.in_use == 0:
+            # ไม่มีงานค้าง เริ่มนับ tag ใหม่
+            self._last_tags.clear()
+            self._virtual_time = 0.0
+
+class AdmissionTicket:
+    """สิทธิ์ในการทำงานของคำขอหนึ่งรายการ ต้องเรียก release() เมื่อทำงานเสร็จ"""
+
+    def __init__(self, controller, identity, pool, estimated_tokens):
+        self._controller = controller
+        self.identity = identity
+        self.pool = pool
+        self.estimated_tokens = estimated_tokens
+        self.charged_tokens = 0
+        self.released = False
+        self.started = time.perf_counter()
+        self._loop = asyncio.get_running_loop()
+
+    def charge(self, tokens):
+        """หัก token ที่ใช้จริงจากโควตาของผู้ใช้ (เรียกจาก thread ใดก็ได้)"""
+        self.charged_tokens += tokens
+        self._controller._take_tokens(self.identity, tokens)
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        if not self.charged_tokens and self.estimated_tokens:
+            # ไม่ได้รับข้อมูลการใช้งานจริง (เช่น stream) ให้หักตามค่าประมาณ
+            self._controller._take_tokens(self.identity, self.estimated_tokens)
+        self._controller._release(self)
+
+    def __del__(self):
+        # กันช่องทำงานรั่วเมื่อ response ถูกยกเลิกก่อนเริ่มส่งข้อมูล
+        if not self.released and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self.release)
+
+class AdmissionController:
+    """
+    ควบคุมการรับคำขอที่ใช้ OpenAI หรือฐานข้อมูล
+
+    - จำกัดจำนวนคำขอพร้อมกันและ token ต่อนาทีของผู้ใช้แต่ละคน (ระบุด้วย API key หรือ IP)
+    - จำกัดจำนวนงาน OpenAI และงานฐานข้อมูลที่ทำงานพร้อมกันทั้งหมด โดยแบ่งคิวให้ผู้ใช้อย่างยุติธรรม
+    - คำขอที่เกินโควตาจะได้ AdmissionRejected พร้อมเวลาที่ควรลองใหม่
+    """
+
+    def __init__(self, enabled=ADMISSION_ENABLED, user_concurrency=ADMISSION_USER_CONCURRENCY,
+                 tokens_per_minute=ADMISSION_USER_TOKENS_PER_MINUTE, max_openai=ADMISSION_MAX_OPENAI,
+                 max_db=ADMISSION_MAX_DB, queue_timeout=ADMISSION_QUEUE_TIMEOUT, weights=None):
+        self.enabled = enabled
+        self.user_concurrency = max(1, user_concurrency)
+        self.tokens_per_minute = tokens_per_minute
+        self.queue_timeout = queue_timeout
+        self.weights = weights if weights is not None else ADMISSION_USER_WEIGHTS
+        self.pools = {'openai': _FairQueue('openai', max_openai), 'db': _FairQueue('db', max_db)}
+        self._active = defaultdict(int)
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def thread_pool_size(self):
+        """จำนวน thread ที่พอสำหรับงานที่รับเข้ามาได้ทั้งหมด (งานหนึ่งอาจใช้ได้ถึงสอง thread)"""
+        if ADMISSION_THREAD_POOL_SIZE > 0:
+            return ADMISSION_THREAD_POOL_SIZE
+        return 2 * sum(pool.capacity for pool in self.pools.values()) + 8
+
+    def identify(self, connection):
+        """ระบุผู้ใช้จาก header ที่กำหนด หรือ IP ของ client (ใช้ได้ทั้ง Request และ WebSocket)"""
+        identity = connection.headers.get(ADMISSION_IDENTITY_HEADER)
+        if identity:
+            return f"key:{identity}"
+        client = connection.client
+        return f"ip:{client.host}" if client else "anonymous"
+
+    def _weight(self, identity):
+        name = identity.split(":", 1)[-1]
+        return max(0.01, float(self.weights.get(name, 1)))
+
+    def _refill(self, identity):
+        """คืนค่า token คงเหลือของผู้ใช้หลังเติมตามเวลาที่ผ่านไป (เรียกขณะถือ lock)"""
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(identity, (float(self.tokens_per_minute), now))
+        tokens = min(float(self.tokens_per_minute), tokens + (now - updated) * self.tokens_per_minute / 60.0)
+        self._buckets[identity] = (tokens, now)
+        return tokens
+
+    def _take_tokens(self, identity, tokens):
+        if self.tokens_per_minute <= 0:
+            return
+        with self._lock:
+            remaining = self._refill(identity) - tokens
+            self._buckets[identity] = (remaining, time.monotonic())
+        metrics.increment("admission.tokens_charged", tokens)
+
+    def _token_retry_after(self, identity):
+        """เวลาที่ต้องรอจนโควตา token กลับมาเป็นบวก (0 ถ้ายังมีโควตา)"""
+        if self.tokens_per_minute <= 0:
+            return 0
+        with self._lock:
+            tokens = self._refill(identity)
+            if len(self._buckets) > 10000:
+                # ลบผู้ใช้ที่ได้โควตาเต็มแล้ว (ไม่ต่างจากผู้ใช้ใหม่)
+                full = float(self.tokens_per_minute)
+                self._buckets = {key: value for key, value in self._buckets.items() if value[0] < full}
+        if tokens > 0:
+            return 0
+        return (1 - tokens) * 60.0 / self.tokens_per_minute
+
+    async def admit(self, identity, pool, text=""):
+        """
+        ขอสิทธิ์ทำงาน (รอคิวถ้าช่องทำงานเต็ม)
+
+        Args:
+            identity (str): ผู้ใช้จาก identify()
+            pool (str): 'openai' หรือ 'db'
+            text (str): ข้อความของคำขอ สำหรับประมาณจำนวน token
+
+        Returns:
+            AdmissionTicket
+
+        Raises:
+            AdmissionRejected: ถ้าเกินโควตาของผู้ใช้หรือรอคิวนานเกินกำหนด
+        """
+        estimated_tokens = 0
+        if pool == 'openai':
+            estimated_tokens = estimate_tokens(text) + ADMISSION_ESTIMATED_COMPLETION_TOKENS
+        if not self.enabled:
+            return self._activate(AdmissionTicket(self, identity, None, 0))
+
+        if self._active[identity] >= self.user_concurrency:
+            metrics.increment("admission.rejected.concurrency")
+            raise AdmissionRejected(f"มีคำขอที่ทำงานอยู่ครบ {self.user_concurrency} รายการแล้ว", self.pools[pool].average_hold, identity)
+        if pool == 'openai':
+            retry_after = self._token_retry_after(identity)
+            if retry_after:
+                metrics.increment("admission.rejected.tokens")
+                raise AdmissionRejected("ใช้ token เกินโควตาต่อนาที", retry_after, identity)
+
+        self._active[identity] += 1
+        try:
+            await self.pools[pool].acquire(identity, self._weight(identity), self.queue_timeout)
+        except BaseException:
+            self._release_user(identity)
+            raise
+        metrics.increment(f"admission.{pool}.admitted")
+        return self._activate(AdmissionTicket(self, identity, pool, estimated_tokens))
+
+    def _activate(self, ticket):
+        _current_ticket.set(ticket)
+        return ticket
+
+    def _release_user(self, identity):
+        self._active[identity] -= 1
+        if self._active[identity] <= 0:
+            del self._active[identity]
+
+    def _release(self, ticket):
+        if ticket.pool is None:
+            return
+        self.pools[ticket.pool].release(time.perf_counter() - ticket.started)
+        self._release_user(ticket.identity)
+
+    def charge_tokens(self, tokens):
+        """หัก token ที่ใช้จริงจากโควตาของผู้ใช้ของคำขอปัจจุบัน (ถ้ามี)"""
+        ticket = _current_ticket.get()
+        if ticket is not None and tokens:
+            ticket.charge(tokens)
+
+    @asynccontextmanager
+    async def slot(self, identity, pool, text=""):
+        """ขอสิทธิ์ทำงานตลอดช่วง async with"""
+        ticket = await self.admit(identity, pool, text)
+        try:
+            yield ticket
+        finally:
+            ticket.release()
+
+    async def admitted(self, ticket, events):
+        """ส่งต่อ event ของ stream และคืนสิทธิ์เมื่อ stream จบหรือถูกยกเลิก"""
+        _current_ticket.set(ticket)
+        try:
+            async for event in events:
+                yield event
+        finally:
+            ticket.release()
+
+    def status(self):
+        """สถานะของแต่ละคิวและจำนวนผู้ใช้ที่กำลังใช้งาน"""
+        return {
+            'enabled': self.enabled,
+            'active_users': len(self._active),
+            'pools': {
+                name: {
+                    'in_use': pool.in_use,
+                    'capacity': pool.capacity,
+                    'queued': len(pool._heap),
+                    'average_hold_seconds': round(pool.average_hold, 3)
+                }
+                for name, pool in self.pools.items()
+            }
+        }
+
+# instance กลางที่ใช้ร่วมกันทั้งแอปพลิเคชัน
+admission_controller = AdmissionController()
@@ -0,0 +1,74 @@
+import os
+import hashlib
+import logging
+from dotenv import load_dotenv
+from cache import app_cache
+from singleflight import normalize_question
+
+# ตั้งค่าการบันทึกล็อก
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# โหลดค่าจากไฟล์ .env
+load_dotenv()
+
+# เปิด/ปิดการเก็บคำตอบการวิเคราะห์ผลลัพธ์ SQL
+ANALYSIS_CACHE_ENABLED = os.getenv("ANALYSIS_CACHE_ENABLED", "true").lower() == "true"
+# อายุของคำตอบใน cache (วินาที)
+ANALYSIS_CACHE_TTL = int(os.getenv("ANALYSIS_CACHE_TTL", "3600"))
+# ไม่เก็บผลลัพธ์ที่ใหญ่กว่านี้ (จำนวนตัวอักษรของ JSON) เพราะโอกาสถามซ้ำด้วยข้อมูลชุดเดิมต่ำ
+ANALYSIS_CACHE_MAX_RESULT_CHARS = int(os.getenv("ANALYSIS_CACHE_MAX_RESULT_CHARS", "200000"))
+# ขนาดของแต่ละ chunk เมื่อส่งคำตอบจาก cache ผ่าน stream (จำนวนตัวอักษร)
+ANALYSIS_REPLAY_CHUNK_SIZE = int(os.getenv("ANALYSIS_REPLAY_CHUNK_SIZE", "400"))
+
+NAMESPACE = "analysis"
+
+class AnalysisCache:
+    """
+    เก็บคำตอบการวิเคราะห์ผลลัพธ์ SQL ใน app_cache
+
+    key ประกอบด้วยคำถามที่ปรับรูปแบบแล้ว, hash ของผลลัพธ์, ประเภทฐานข้อมูล, เวอร์ชันของคำแนะนำ และ model
+    คำถามเดิมที่ได้ข้อมูลชุดเดิมจึงไม่ต้องเรียก AI ซ้ำ
+    """
+
+    def __init__(self, cache=app_cache, enabled=ANALYSIS_CACHE_ENABLED, ttl=ANALYSIS_CACHE_TTL):
+        self.cache = cache
+        self.enabled = enabled
+        self.ttl = ttl
+
+    def make_key(self, question, result_json, db_type, prompt_version, model):
+        """
+        สร้าง key ของคำตอบ
+
+        Returns:
+            tuple หรือ None ถ้าไม่ควรเก็บคำตอบนี้ (ปิดการใช้งาน หรือผลลัพธ์ใหญ่เกินไป)
+        """
+        if not self.enabled or len(result_json) > ANALYSIS_CACHE_MAX_RESULT_CHARS:
+            return None
+        fingerprint = hashlib.sha256(result_json.encode('utf-8')).hexdigest()
+        return (normalize_question(question), fingerprint, db_type, prompt_version, model)
+
+    def get(self, key):
+        """คืนค่าคำตอบที่เก็บไว้ หรือ None"""
+        if key is None:
+            return None
+        return self.cache.get(NAMESPACE, key)
+
+    def set(self, key, analysis):
+        """เก็บคำตอบที่วิเคราะห์เสร็จสมบูรณ์แล้ว"""
+        if key is None or not analysis:
+            return
+        self.cache.set(NAMESPACE, key, analysis, ttl=self.ttl)
+
+    def invalidate(self):
+        """ล้างคำตอบทั้งหมด (เรียกเมื่อคำแนะนำสำหรับการวิเคราะห์ถูกแก้ไข)"""
+        self.cache.invalidate(NAMESPACE)
+        logger.info("ล้าง cache คำตอบการวิเคราะห์ผลลัพธ์ SQL แล้ว")
+
+    def replay_chunks(self, analysis):
+        """แบ่งคำตอบเป็น chunk สำหรับส่งผ่าน stream รูปแบบเดียวกับคำตอบจาก AI"""
+        size = max(1, ANALYSIS_REPLAY_CHUNK_SIZE)
+        return [analysis[i:i + size] for i in range(0, len(analysis), size)]
+
+# instance กลางที่ใช้ร่วมกันทั้งแอปพลิเคชัน
+analysis_cache = AnalysisCache()
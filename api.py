@@ -1,5 +1,5 @@
-from fastapi import FastAPI, HTTPException, Request, Form, Depends, Query
-from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
+from fastapi import FastAPI, HTTPException, Request, Form, Depends, Query, WebSocket
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse, Response, FileResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
@@ -7,32 +7,63 @@ from typing import List, Optional, Dict, Any
 from pydantic import BaseModel
 import json
 import asyncio
+import concurrent.futures
 import uvicorn
 import logging
-from database import get_data_from_database, get_database_schema, execute_sql_query, db_manager
-from openai_service import OpenAIService
+from database import get_data_from_database, get_data_page, DATA_PAGE_MAX_SIZE, get_database_schema, execute_sql_query, execute_sql_rows, stream_query_results, db_manager, CustomJSONEncoder, QUERY_STREAM_CHUNK_SIZE
+from openai_service import get_openai_service, open_openai_client, close_openai_client
+from resilience import resilient_caller
+from singleflight import SingleFlight, normalize_question, make_key
 from models import Data
-import decimal
-from datetime import datetime, date
+from metrics import metrics
+from model_router import model_router
+from chat_session import chat_sessions
+from chat_history import chat_history_writer, get_chat_history
+from ingest import ingest_data_source, detect_format, INGEST_READ_TIMEOUT
+from jobs import job_manager, JobNotFound
+from websocket_mux import stream_multiplexer, BinaryBatch
+from admission import admission_controller, AdmissionRejected
+from cache import app_cache
+from analysis_cache import analysis_cache
+from query_cursors import query_cursors, QUERY_CURSOR_MAX_PAGE_SIZE
+from profiling import request_profiler, ProfilingMiddleware, ProfilingExecutor, PROFILING_HEADER
+from sql_speculation import generate_and_execute_sql, is_speculative_enabled, get_speculation_metrics
+from query_templates import match_question_template, record_template_fallback, get_template_metrics
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 
 # ตั้งค่าการบันทึกล็อก
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# สร้าง JSONEncoder ที่สามารถจัดการกับ Decimal ได้
-class CustomJSONEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, decimal.Decimal):
-            return float(obj)
-        elif isinstance(obj, (datetime, date)):
-            return obj.isoformat()
-        return super(CustomJSONEncoder, self).default(obj)
-
 # ฟังก์ชันสำหรับแปลงข้อมูลเป็น JSON
 def custom_json_dumps(data):
     return json.dumps(data, cls=CustomJSONEncoder, ensure_ascii=False)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    """จัดการทรัพยากรที่ใช้ร่วมกันตลอดอายุของแอปพลิเคชัน"""
+    # ให้มี thread พอสำหรับงานที่ admission controller รับเข้ามาทั้งหมด
+    # (ProfilingExecutor profile งานใน thread ของคำขอที่กำลังถูก profile ด้วย)
+    asyncio.get_running_loop().set_default_executor(
+        ProfilingExecutor(max_workers=admission_controller.thread_pool_size())
+    )
+    # สร้าง connection pool ของ OpenAI client ตอนเริ่มแอปพลิเคชัน และปิดตัวเดียวกันตอนปิด
+    open_openai_client()
+    chat_history_writer.start()
+    await job_manager.start()
+    await query_cursors.start()
+    yield
+    await query_cursors.stop()
+    await job_manager.stop()
+    # เขียนประวัติการสนทนาที่ค้างอยู่ในคิวก่อนปิด
+    await asyncio.to_thread(chat_history_writer.stop)
+    close_openai_client()
+
+app = FastAPI(lifespan=lifespan)
 
 # เพิ่ม CORS middleware
 app.add_middleware(
@@ -41,21 +72,51 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Profile-Id"],
 )
 
+# profile คำขอตามที่ผู้ดูแลสั่ง และบันทึกคำขอที่ช้า (อยู่นอกสุดเพื่อรวมเวลาของ middleware อื่นด้วย)
+app.add_middleware(ProfilingMiddleware, profiler=request_profiler)
+
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected_handler(request: Request, exc: AdmissionRejected):
+    """คำขอที่เกินโควตาตอบ 429 พร้อม Retry-After"""
+    return JSONResponse(
+        status_code=429,
+        content={"detail": str(exc), "retry_after": exc.retry_after},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
 # กำหนด templates directory
 templates = Jinja2Templates(directory="templates")
 
 # กำหนด static files directory
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
-# สร้าง OpenAI service
-openai_service = OpenAIService()
+# ใช้ OpenAI service ตัวเดียวร่วมกันทุกคำขอ
+openai_service = get_openai_service()
+
+# รวมคำถามเดียวกันที่เข้ามาพร้อมกันให้ทำงานจริงเพียงครั้งเดียว
+SINGLEFLIGHT_ENABLED = os.getenv("SINGLEFLIGHT_ENABLED", "true").lower() == "true"
+sql_query_flight = SingleFlight("sql_query")
+sql_stream_flight = SingleFlight("sql_stream")
+
+def _coalescing_key(question, speculative=None):
+    """สร้าง key จากคำถามที่ปรับรูปแบบแล้ว การเชื่อมต่อฐานข้อมูลปัจจุบัน และเวอร์ชันของคำแนะนำ"""
+    params = db_manager.connection_params
+    return make_key(
+        normalize_question(question),
+        db_manager.db_type, params.get('host'), params.get('port'), params.get('database'), params.get('mongodb_uri'),
+        openai_service.prompt_version,
+        is_speculative_enabled(speculative)
+    )
 
 # สร้าง model สำหรับรับข้อมูล
 class ChatRequest(BaseModel):
     message: str
     conversation_history: Optional[List[Dict[str, str]]] = None
+    session_id: Optional[str] = None
+    user_id: Optional[str] = None
 
 class AnalyzeRequest(BaseModel):
     query: str
@@ -67,10 +128,29 @@ class AskAIRequest(BaseModel):
 
 class SQLQueryRequest(BaseModel):
     question: str
+    # เปิด/ปิดโหมดสร้างคำสั่งหลายชุดพร้อมกัน (None = ใช้ค่าจาก SQL_SPECULATIVE_CANDIDATES)
+    speculative: Optional[bool] = None
+
+class JobSubmitRequest(BaseModel):
+    type: str
+    payload: Dict[str, Any]
+    # ลำดับความสำคัญ (ค่ามากทำก่อน)
+    priority: int = 0
 
 class PromptUpdateRequest(BaseModel):
     prompt: str
 
+class ModelRoutesRequest(BaseModel):
+    models: Optional[Dict[str, str]] = None
+    routes: Optional[Dict[str, Dict[str, Any]]] = None
+
+class ProfilingWindowRequest(BaseModel):
+    duration_seconds: int = 60
+    # profile เฉพาะคำขอที่ path ขึ้นต้นด้วยค่านี้ (None = ทุกคำขอ)
+    path_prefix: Optional[str] = None
+    # สัดส่วนของคำขอที่ถูก profile (0-1)
+    sample_rate: float = 1.0
+
 class DatabaseConnectionRequest(BaseModel):
     db_type: str
     host: str
@@ -84,74 +164,367 @@ class DatabaseConnectionRequest(BaseModel):
 async def read_root(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
+async def _get_chat_session(chat_request):
+    """
+    ดึง session การสนทนา (ประวัติที่ client ส่งมาจะใช้เฉพาะตอนสร้าง session ใหม่)
+
+    ถ้าประวัติเกิน token budget และยังไม่มีการสรุปในเบื้องหลัง จะสรุปให้เสร็จก่อนตอบ
+    """
+    session = chat_sessions.get_or_create(chat_request.session_id, chat_request.conversation_history)
+    await asyncio.to_thread(chat_sessions.compact_now, session, openai_service.summarize_conversation)
+    return session
+
+def _record_chat_turn(chat_request, session, response):
+    """บันทึกรอบการสนทนาลง session และฐานข้อมูล แล้วสรุปข้อความเก่าในเบื้องหลัง"""
+    chat_sessions.append_turn(session, chat_request.message, response)
+    chat_sessions.schedule_compaction(session, openai_service.summarize_conversation)
+    chat_history_writer.record(chat_request.user_id or session.id, chat_request.message, response)
+
 @app.post("/chat")
-async def chat(chat_request: ChatRequest):
-    response = openai_service.chat_with_bot(
-        chat_request.message, 
-        chat_request.conversation_history
-    )
-    return {"response": response}
+async def chat(chat_request: ChatRequest, request: Request):
+    # การสรุปประวัติก็เรียก OpenAI จึงต้องได้สิทธิ์ก่อน (token ที่ใช้จะถูกหักจากโควตาของผู้ใช้นี้)
+    async with admission_controller.slot(admission_controller.identify(request), "openai", chat_request.message):
+        session = await _get_chat_session(chat_request)
+        summary, recent_messages = chat_sessions.build_context(session)
+        response = await asyncio.to_thread(
+            openai_service.chat_with_bot,
+            chat_request.message, 
+            recent_messages,
+            None,
+            summary
+        )
+    _record_chat_turn(chat_request, session, response)
+    return {"response": response, "session_id": session.id}
 
 @app.post("/analyze")
-async def analyze(analyze_request: AnalyzeRequest):
-    response = openai_service.analyze_data(
-        analyze_request.query, 
-        analyze_request.category
-    )
+async def analyze(analyze_request: AnalyzeRequest, request: Request):
+    async with admission_controller.slot(admission_controller.identify(request), "openai", analyze_request.query):
+        response = await asyncio.to_thread(
+            openai_service.analyze_data,
+            analyze_request.query, 
+            analyze_request.category
+        )
     return {"response": response}
 
 @app.post("/ask-ai")
-async def ask_ai(ask_request: AskAIRequest):
-    response = openai_service.ask_ai_with_db_data(
-        ask_request.question, 
-        ask_request.category
-    )
+async def ask_ai(ask_request: AskAIRequest, request: Request):
+    async with admission_controller.slot(admission_controller.identify(request), "openai", ask_request.question):
+        response = await asyncio.to_thread(
+            openai_service.ask_ai_with_db_data,
+            ask_request.question, 
+            ask_request.category
+        )
     return {"response": response}
 
+async def _admitted_sse(request, pool, text, events):
+    """ขอสิทธิ์ทำงานก่อนเริ่ม stream (ตอบ 429 ถ้าเกินโควตา) และคืนสิทธิ์เมื่อ stream จบ"""
+    ticket = await admission_controller.admit(admission_controller.identify(request), pool, text)
+    return StreamingResponse(admission_controller.admitted(ticket, events), media_type="text/event-stream")
+
 @app.get("/debug/data")
-async def get_debug_data(category: Optional[str] = None):
+async def get_debug_data(
+    category: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=DATA_PAGE_MAX_SIZE),
+    order_by: str = "id"
+):
     """
-    API endpoint สำหรับดึงข้อมูลดิบจากฐานข้อมูลเพื่อการตรวจสอบ
+    API endpoint สำหรับดึงข้อมูลดิบจากฐานข้อมูลเพื่อการตรวจสอบ (แบ่งหน้าแบบ keyset)
+    
+    ส่ง next_cursor กลับมาใน cursor เพื่อดึงหน้าถัดไป (next_cursor เป็น null เมื่อถึงหน้าสุดท้าย)
     """
-    data = get_data_from_database(category)
+    try:
+        data, next_cursor = await asyncio.to_thread(get_data_page, category, cursor, limit, order_by)
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
     result = []
     for item in data:
         result.append({
-            "id": item.id,
-            "title": item.title,
-            "content": item.content,
-            "category": item.category
+            "id": item["id"],
+            "title": item.get("title"),
+            "content": item.get("content"),
+            "category": item.get("category"),
+            "updated_at": item.get("updated_at")
         })
-    return {"data": result, "count": len(result)}
+    return {"data": result, "count": len(result), "next_cursor": next_cursor}
+
+@app.post("/api/data-source/ingest")
+async def ingest_data(request: Request, format: Optional[str] = None, chunk_size: Optional[int] = Query(None, ge=1, le=100000)):
+    """
+    API endpoint สำหรับนำเข้าข้อมูลจำนวนมากลง data_source จาก NDJSON หรือ CSV
+    
+    อ่าน body แบบ streaming (ไม่โหลดทั้งไฟล์เข้าหน่วยความจำ) ตรวจสอบ และเขียนทีละ chunk
+    """
+    try:
+        data_format = detect_format(request.headers.get('content-type'), format)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    # ส่งข้อมูลจาก request ไปให้ thread ที่ทำการนำเข้าผ่านคิวขนาดจำกัด
+    queue = asyncio.Queue(maxsize=8)
+    loop = asyncio.get_running_loop()
+    
+    async def pump():
+        end = b''
+        try:
+            async for chunk in request.stream():
+                if chunk:
+                    await queue.put(chunk)
+        except asyncio.CancelledError:
+            # ถูก cancel หลัง thread ที่นำเข้าทำงานเสร็จแล้ว ไม่มีใครรออ่านคิว
+            raise
+        except Exception as e:
+            # เช่น ClientDisconnect: ส่งข้อผิดพลาดต่อให้ thread แทนการจบข้อมูลตามปกติ
+            end = e
+        # ต้องส่งสัญญาณจบเสมอ มิฉะนั้น thread ที่นำเข้าจะรอข้อมูลไปตลอด
+        await queue.put(end)
+    
+    def next_chunk():
+        future = asyncio.run_coroutine_threadsafe(queue.get(), loop)
+        try:
+            chunk = future.result(timeout=INGEST_READ_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise ValueError(f"ไม่ได้รับข้อมูลจาก client ภายใน {INGEST_READ_TIMEOUT:g} วินาที")
+        if isinstance(chunk, Exception):
+            raise ValueError(f"อ่านข้อมูลจาก client ไม่สำเร็จ: {str(chunk) or type(chunk).__name__}")
+        return chunk
+    
+    ticket = await admission_controller.admit(admission_controller.identify(request), "db")
+    pump_task = asyncio.create_task(pump())
+    try:
+        summary = await asyncio.to_thread(ingest_data_source, next_chunk, data_format, chunk_size)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"เกิดข้อผิดพลาดในการนำเข้าข้อมูล: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        pump_task.cancel()
+        ticket.release()
+    return summary
 
 @app.get("/db/schema")
-async def get_schema():
+async def get_schema(refresh: bool = False):
     """
-    API endpoint สำหรับดึงโครงสร้างฐานข้อมูล
+    API endpoint สำหรับดึงโครงสร้างฐานข้อมูล (refresh=true เพื่อวิเคราะห์ใหม่โดยไม่ใช้ cache)
     """
-    schema = get_database_schema()
+    schema = await asyncio.to_thread(get_database_schema, refresh)
     return {"schema": schema}
 
 @app.post("/db/query")
-async def run_sql_query(query_request: SQLQueryRequest):
+async def run_sql_query(
+    query_request: SQLQueryRequest,
+    request: Request,
+    result_format: str = Query("records", alias="format", pattern="^(records|rows)$")
+):
     """
     API endpoint สำหรับรันคำสั่ง SQL โดยตรง
+    
+    format=records (ค่าเริ่มต้น) คืนค่า {"result": [{คอลัมน์: ค่า}, ...]}
+    format=rows คืนค่า {"columns": [...], "rows": [[...], ...]} ซึ่งไม่ต้องส่งชื่อคอลัมน์ซ้ำทุกแถว (เฉพาะฐานข้อมูล SQL)
+    """
+    async with admission_controller.slot(admission_controller.identify(request), "db"):
+        try:
+            if result_format == "rows":
+                result = await asyncio.to_thread(execute_sql_rows, query_request.question)
+            else:
+                result = await asyncio.to_thread(execute_sql_query, query_request.question)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except Exception as e:
+            logger.error(f"เกิดข้อผิดพลาดในการรันคำสั่ง SQL: {str(e)}")
+            raise HTTPException(status_code=500, detail=str(e))
+    # แปลงเป็น JSON เองครั้งเดียว แทนการให้ FastAPI ตรวจและแปลงทีละค่า
+    if isinstance(result, tuple):
+        columns, rows = result
+        body = f'{{"columns": {_result_json(columns)}, "rows": {_result_json(rows)}}}'
+    else:
+        body = f'{{"result": {_result_json(result)}}}'
+    return Response(content=body, media_type="application/json")
+
+class QueryCursorRequest(BaseModel):
+    cursor: str
+
+def _query_page_response(page):
+    """ส่งหน้าผลลัพธ์ที่แปลงเป็น JSON แล้วโดยไม่ต้องแปลงแถวข้อมูลซ้ำ"""
+    body = (
+        f'{{"result": {page["rows_json"]}, "row_count": {page["row_count"]}, '
+        f'"offset": {page["offset"]}, "next_cursor": {json.dumps(page["next_cursor"])}}}'
+    )
+    return Response(content=body, media_type="application/json")
+
+async def _query_page(request, func, *args):
+    async with admission_controller.slot(admission_controller.identify(request), "db"):
+        try:
+            page = await asyncio.to_thread(func, *args)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except Exception as e:
+            logger.error(f"เกิดข้อผิดพลาดในการรันคำสั่ง SQL: {str(e)}")
+            raise HTTPException(status_code=500, detail=str(e))
+    return _query_page_response(page)
+
+@app.post("/db/query/pages")
+async def open_query_pages(
+    query_request: SQLQueryRequest,
+    request: Request,
+    page_size: Optional[int] = Query(None, ge=1, le=QUERY_CURSOR_MAX_PAGE_SIZE)
+):
     """
+    รันคำสั่งอ่านข้อมูลและคืนค่าหน้าแรก พร้อม next_cursor สำหรับหน้าถัดไป
+    
+    ผลลัพธ์ถูกอ่านจาก server-side cursor ทีละหน้า จึงเลื่อนดูผลลัพธ์ขนาดใหญ่ได้โดยเซิร์ฟเวอร์ใช้หน่วยความจำคงที่
+    """
+    return await _query_page(request, query_cursors.open, query_request.question, page_size)
+
+@app.post("/db/query/pages/next")
+async def next_query_page(cursor_request: QueryCursorRequest, request: Request):
+    """ดึงหน้าถัดไปจาก next_cursor"""
+    return await _query_page(request, query_cursors.fetch, cursor_request.cursor)
+
+@app.post("/db/query/pages/close")
+async def close_query_pages(cursor_request: QueryCursorRequest):
+    """ปิด cursor ก่อนอ่านครบเพื่อคืนการเชื่อมต่อฐานข้อมูลทันที"""
     try:
-        result = execute_sql_query(query_request.question)
-        return {"result": result}
-    except Exception as e:
-        logger.error(f"เกิดข้อผิดพลาดในการรันคำสั่ง SQL: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+        closed = await asyncio.to_thread(query_cursors.close, cursor_request.cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"success": True, "closed": closed}
+
+async def _iterate_in_thread(iterator_factory, max_pending=4):
+    """
+    อ่าน iterator แบบ blocking (เช่น cursor ของฐานข้อมูล) ใน thread แยก และส่งต่อให้ async generator
+    
+    คิวมีขนาดจำกัด ทำให้ thread หยุดรอเมื่อผู้รับอ่านไม่ทัน และหยุดอ่านเมื่อผู้รับยกเลิกการเชื่อมต่อ
+    """
+    queue = asyncio.Queue(maxsize=max_pending)
+    loop = asyncio.get_running_loop()
+    stopped = threading.Event()
+    finished = object()
+    
+    def produce():
+        iterator = None
+        try:
+            iterator = iter(iterator_factory())
+            for item in iterator:
+                if stopped.is_set():
+                    return
+                asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+            item = finished
+        except Exception as e:
+            item = e
+        finally:
+            # ปิด cursor ทันทีแทนการรอ garbage collector
+            if hasattr(iterator, 'close'):
+                iterator.close()
+        if not stopped.is_set():
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+    
+    producer = asyncio.create_task(asyncio.to_thread(produce))
+    try:
+        while True:
+            item = await queue.get()
+            if item is finished:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stopped.set()
+        # ปลดล็อก thread ที่อาจรอใส่ข้อมูลลงคิวอยู่
+        while not queue.empty():
+            queue.get_nowait()
+        await producer
+
+async def _db_query_chunks(query, chunk_size):
+    """รันคำสั่งอ่านข้อมูลแบบ streaming คืนค่า (ลำดับ chunk, จำนวนแถว, JSON array ของแถว)"""
+    started = time.perf_counter()
+    chunk_index = 0
+    async for rows, rows_json in _iterate_in_thread(lambda: stream_query_results(query, chunk_size)):
+        yield chunk_index, rows, rows_json
+        chunk_index += 1
+    metrics.observe("query_stream.duration", (time.perf_counter() - started) * 1000)
+
+@app.post("/stream/db/query")
+async def stream_db_query(query_request: SQLQueryRequest, request: Request, chunk_size: int = Query(QUERY_STREAM_CHUNK_SIZE, ge=1, le=10000)):
+    """
+    API endpoint สำหรับรันคำสั่งอ่านข้อมูลโดยตรงแบบ streaming (ส่งผลลัพธ์ทีละ chunk)
+    """
+    async def generate():
+        row_count = 0
+        chunks = 0
+        try:
+            async for chunk_index, rows, rows_json in _db_query_chunks(query_request.question, chunk_size):
+                row_count += rows
+                chunks += 1
+                yield f"data: {{\"chunk\": {chunk_index}, \"rows\": {rows_json}}}\n\n"
+        except Exception as e:
+            logger.error(f"เกิดข้อผิดพลาดในการรันคำสั่งแบบ streaming: {str(e)}")
+            yield f"data: {custom_json_dumps({'error': str(e)})}\n\n"
+            return
+        yield f"data: {custom_json_dumps({'complete': True, 'row_count': row_count, 'chunks': chunks})}\n\n"
+    
+    return await _admitted_sse(request, "db", "", generate())
 
 @app.post("/ai/sql-query")
-async def ai_sql_query(query_request: SQLQueryRequest):
+async def ai_sql_query(query_request: SQLQueryRequest, request: Request):
     """
     สร้างและรันคำสั่ง SQL จากคำถามภาษาธรรมชาติ
+    
+    คำถามเดียวกันที่เข้ามาพร้อมกันจะใช้ผลลัพธ์จากการทำงานครั้งเดียวกัน
+    เฉพาะคำขอที่เริ่มงานจริงเท่านั้นที่ใช้สิทธิ์และโควตา token คำขอที่มาร่วมรอผลลัพธ์ไม่ถูกหัก
     """
+    identity = admission_controller.identify(request)
+    if not SINGLEFLIGHT_ENABLED:
+        return await _admitted_ai_sql_query(identity, query_request)
+    key = _coalescing_key(query_request.question, query_request.speculative)
     try:
-        # ดึงโครงสร้างฐานข้อมูล
-        schema = get_database_schema()
+        response = await sql_query_flight.do(key, lambda: _admitted_ai_sql_query(identity, query_request))
+    except AdmissionRejected as e:
+        if e.identity is None or e.identity == identity:
+            raise
+        # งานที่ร่วมรอถูกปฏิเสธเพราะโควตาของผู้ใช้อื่น ให้ขอสิทธิ์ของตัวเองแล้วรันเอง
+        response = await _admitted_ai_sql_query(identity, query_request)
+    return {**response, "question": query_request.question}
+
+async def _admitted_ai_sql_query(identity, query_request):
+    """รัน pipeline ของ /ai/sql-query โดยใช้สิทธิ์และโควตาของผู้ใช้ที่เริ่มงาน"""
+    async with admission_controller.slot(identity, "openai", query_request.question):
+        return await _run_ai_sql_query(query_request)
+
+async def _run_question_template(question, schema, db_type):
+    """
+    จับคู่คำถามกับรูปแบบที่พบบ่อยและรันคำสั่งที่สร้างขึ้น
+    
+    Returns:
+        tuple: (template, sql_query, result) หรือ (None, None, None) ถ้าไม่ตรงรูปแบบหรือรันไม่ผ่าน (ให้ AI สร้างคำสั่งแทน)
+    """
+    template = match_question_template(question, schema, db_type)
+    if template is None:
+        return None, None, None
+    try:
+        result = await asyncio.to_thread(execute_sql_query, template.query)
+    except Exception as e:
+        logger.warning(f"คำสั่งจากรูปแบบคำถามรันไม่ผ่าน ให้ AI สร้างคำสั่งแทน: {str(e)}")
+        record_template_fallback()
+        return None, None, None
+    return template, template.query, result
+
+async def _run_ai_sql_query(query_request, on_progress=None):
+    """
+    ขั้นตอนการสร้าง รัน และวิเคราะห์คำสั่ง SQL ของ /ai/sql-query
+    
+    on_progress (async callable, optional): เรียกด้วย (ความคืบหน้า 0-1, ข้อความ) เมื่อจบแต่ละขั้นตอน
+    """
+    async def report(progress, message):
+        if on_progress is not None:
+            await on_progress(progress, message)
+    
+    try:
+        # ดึงโครงสร้างฐานข้อมูล (ใน thread แยก เพื่อให้คำขออื่นเข้ามารวมกับงานนี้ได้ระหว่างรอ)
+        schema = await asyncio.to_thread(get_database_schema)
+        await report(0.1, "load_context")
         if not schema:
             raise HTTPException(status_code=500, detail="ไม่สามารถดึงโครงสร้างฐานข้อมูลได้")
             
@@ -159,15 +532,34 @@ async def ai_sql_query(query_request: SQLQueryRequest):
         db_type = db_manager.db_type
         logger.info(f"ประเภทฐานข้อมูลที่ใช้: {db_type}")
         
-        # สร้างคำสั่ง SQL
-        openai_service = OpenAIService()
-        sql_query = openai_service.generate_sql_from_question(query_request.question, schema, db_type)
+        # คำถามรูปแบบที่พบบ่อยสร้างคำสั่งได้ทันทีโดยไม่ต้องเรียก AI
+        template, sql_query, result = await _run_question_template(query_request.question, schema, db_type)
         
-        # รันคำสั่ง SQL
-        result = execute_sql_query(sql_query)
+        # สร้างคำสั่ง SQL
+        if template is not None:
+            logger.info(f"ใช้คำสั่งจากรูปแบบคำถาม ({template.intent}) โดยไม่เรียก AI")
+        elif is_speculative_enabled(query_request.speculative):
+            # สร้างหลายชุดพร้อมกันและรันชุดแรกที่ถูกต้อง
+            speculation = await generate_and_execute_sql(openai_service, query_request.question, schema, db_type)
+            sql_query = speculation['sql_query']
+            result = speculation['result']
+        else:
+            sql_query = await asyncio.to_thread(
+                openai_service.generate_sql_from_question, query_request.question, schema, db_type
+            )
+            
+            # รันคำสั่ง SQL
+            result = await asyncio.to_thread(execute_sql_query, sql_query)
+        await report(0.6, "execute_sql")
         
         # วิเคราะห์ผลลัพธ์
-        analysis = openai_service.analyze_sql_result(query_request.question, sql_query, result, db_type)
+        if template is not None and template.has_direct_answer:
+            analysis = template.format_answer(result)
+        else:
+            analysis = await asyncio.to_thread(
+                openai_service.analyze_sql_result, query_request.question, sql_query, result, db_type
+            )
+        await report(1.0, "analyze_result")
         
         # ส่งผลลัพธ์กลับไปยังผู้ใช้
         return {
@@ -180,316 +572,538 @@ async def ai_sql_query(query_request: SQLQueryRequest):
         logger.error(f"เกิดข้อผิดพลาดในการสร้างและรันคำสั่ง SQL: {str(e)}")
         raise HTTPException(status_code=500, detail=f"เกิดข้อผิดพลาด: {str(e)}")
 
+async def _sql_query_job(payload, context):
+    """งานเบื้องหลังของ /ai/sql-query"""
+    return await _run_ai_sql_query(SQLQueryRequest(**payload), context.report)
+
+# ประเภทงานที่ส่งเข้าคิวงานเบื้องหลังได้
+job_manager.register("sql_query", _sql_query_job)
+
+async def _callback_stream(func, *args, **kwargs):
+    """
+    รัน func(*args, callback=..., **kwargs) ใน thread แยก และคืนค่าข้อความแต่ละส่วนที่ได้จาก callback
+    
+    จบเมื่อ func ทำงานเสร็จ (ข้อผิดพลาดจาก func จะถูกส่งต่อให้ผู้เรียก)
+    """
+    # ใช้ asyncio.Queue เพื่อรับข้อความจาก callback
+    queue = asyncio.Queue()
+    loop = asyncio.get_running_loop()
+    finished = object()
+    
+    def callback(content):
+        loop.call_soon_threadsafe(queue.put_nowait, content)
+    
+    task = asyncio.create_task(asyncio.to_thread(func, *args, callback=callback, **kwargs))
+    # ส่งสัญญาณจบเมื่อการสร้างข้อความเสร็จ (ต่อท้ายข้อความที่อยู่ในคิว)
+    task.add_done_callback(lambda _: queue.put_nowait(finished))
+    while True:
+        content = await queue.get()
+        if content is finished:
+            break
+        if content:
+            yield content
+    task.result()
+
+async def _content_events(func, *args):
+    """event {'content': ...} สำหรับ stream ข้อความจาก OpenAI"""
+    async for content in _callback_stream(func, *args):
+        yield {'content': content}
+
+async def _chat_events(chat_request):
+    """event ของการแชทพร้อมประวัติ: session_id ตามด้วยข้อความแต่ละส่วน แล้วบันทึกรอบการสนทนา"""
+    session = await _get_chat_session(chat_request)
+    summary, recent_messages = chat_sessions.build_context(session)
+    yield {'session_id': session.id}
+    
+    parts = []
+    async for content in _callback_stream(
+        openai_service.chat_with_bot, chat_request.message, recent_messages, summary=summary
+    ):
+        parts.append(content)
+        yield {'content': content}
+    _record_chat_turn(chat_request, session, ''.join(parts))
+
+def _sse_event(event):
+    """แปลง event หนึ่งรายการเป็น Server-Sent Event"""
+    if isinstance(event, BinaryBatch):
+        # ผลลัพธ์ที่แปลงเป็น JSON ไว้แล้ว ต่อเข้าไปใน event ได้โดยไม่ต้องแปลงซ้ำ
+        rows_json = event.body.decode('utf-8')
+        if event.header['type'] == 'result_rows':
+            return f'data: {{"result_offset": {event.header["offset"]}, "result_rows": {rows_json}}}\n\n'
+        return f'data: {{"result": {rows_json}}}\n\n'
+    return f"data: {custom_json_dumps(event)}\n\n"
+
+async def _sse_events(events):
+    """แปลง event (dict หรือ BinaryBatch) เป็น Server-Sent Events"""
+    try:
+        async for event in events:
+            yield _sse_event(event)
+    except Exception as e:
+        logger.error(f"เกิดข้อผิดพลาดระหว่าง streaming: {str(e)}")
+        yield f"data: {custom_json_dumps({'error': str(e)})}\n\n"
+
 @app.get("/stream-chat")
-async def stream_chat(message: str):
+async def stream_chat(message: str, request: Request):
     """
     API endpoint สำหรับการแชทแบบ streaming
     """
-    async def generate():
-        # ใช้ asyncio.Queue เพื่อรับข้อความจาก callback
-        queue = asyncio.Queue()
-        loop = asyncio.get_running_loop()
-        
-        # สร้าง callback function
-        def callback(content):
-            asyncio.run_coroutine_threadsafe(queue.put(content), loop)
-        
-        # เริ่มการสร้างข้อความใน thread แยก
-        asyncio.create_task(
-            asyncio.to_thread(
-                openai_service.generate_text_with_stream,
-                message,
-                callback
-            )
-        )
-        
-        # ส่งข้อความกลับเป็น Server-Sent Events
-        while True:
-            try:
-                content = await queue.get()
-                if content:
-                    yield f"data: {custom_json_dumps({'content': content})}\n\n"
-                else:
-                    break
-            except Exception as e:
-                yield f"data: {custom_json_dumps({'error': str(e)})}\n\n"
-                break
-    
-    return StreamingResponse(generate(), media_type="text/event-stream")
+    events = _content_events(openai_service.generate_text_with_stream, message)
+    return await _admitted_sse(request, "openai", message, _sse_events(events))
 
 @app.post("/stream/chat")
-async def stream_chat_with_history(chat_request: ChatRequest):
+async def stream_chat_with_history(chat_request: ChatRequest, request: Request):
     """
     API endpoint สำหรับการแชทแบบ streaming พร้อมประวัติการสนทนา
     """
-    async def generate():
-        # ใช้ asyncio.Queue เพื่อรับข้อความจาก callback
-        queue = asyncio.Queue()
-        loop = asyncio.get_running_loop()
-        
-        # สร้าง callback function
-        def callback(content):
-            asyncio.run_coroutine_threadsafe(queue.put(content), loop)
-        
-        # เริ่มการสร้างข้อความใน thread แยก
-        asyncio.create_task(
-            asyncio.to_thread(
-                openai_service.chat_with_bot,
-                chat_request.message,
-                chat_request.conversation_history,
-                callback
-            )
-        )
-        
-        # ส่งข้อความกลับเป็น Server-Sent Events
-        while True:
-            try:
-                content = await queue.get()
-                if content:
-                    yield f"data: {custom_json_dumps({'content': content})}\n\n"
-                else:
-                    break
-            except Exception as e:
-                yield f"data: {custom_json_dumps({'error': str(e)})}\n\n"
-                break
-    
-    return StreamingResponse(generate(), media_type="text/event-stream")
+    return await _admitted_sse(request, "openai", chat_request.message, _sse_events(_chat_events(chat_request)))
+
+@app.get("/api/chat/session/{session_id}")
+async def get_chat_session(session_id: str):
+    """ดูบทสรุปและจำนวนข้อความของ session การสนทนา"""
+    info = chat_sessions.get_session_info(session_id)
+    if info is None:
+        raise HTTPException(status_code=404, detail="ไม่พบ session การสนทนา")
+    return info
+
+@app.get("/api/chat/history")
+async def read_chat_history(user_id: str, limit: int = Query(50, ge=1, le=500), cursor: Optional[str] = None):
+    """
+    อ่านประวัติการสนทนาของผู้ใช้ เรียงจากล่าสุดก่อน (ส่ง next_cursor กลับมาเพื่ออ่านหน้าถัดไป)
+    """
+    try:
+        result = await asyncio.to_thread(get_chat_history, user_id, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"เกิดข้อผิดพลาดในการอ่านประวัติการสนทนา: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+    return JSONResponse(content=json.loads(custom_json_dumps(result)))
+
+@app.delete("/api/chat/session/{session_id}")
+async def delete_chat_session(session_id: str):
+    """ลบ session การสนทนา"""
+    if not chat_sessions.delete(session_id):
+        raise HTTPException(status_code=404, detail="ไม่พบ session การสนทนา")
+    return {"success": True}
 
 @app.post("/stream/analyze")
-async def stream_analyze(analyze_request: AnalyzeRequest):
+async def stream_analyze(analyze_request: AnalyzeRequest, request: Request):
     """
     API endpoint สำหรับการวิเคราะห์ข้อมูลแบบ streaming
     """
-    async def generate():
-        # ใช้ asyncio.Queue เพื่อรับข้อความจาก callback
-        queue = asyncio.Queue()
-        loop = asyncio.get_running_loop()
-        
-        # สร้าง callback function
-        def callback(content):
-            asyncio.run_coroutine_threadsafe(queue.put(content), loop)
-        
-        # เริ่มการสร้างข้อความใน thread แยก
-        asyncio.create_task(
-            asyncio.to_thread(
-                openai_service.analyze_data,
-                analyze_request.query,
-                analyze_request.category,
-                callback
-            )
-        )
-        
-        # ส่งข้อความกลับเป็น Server-Sent Events
-        while True:
-            try:
-                content = await queue.get()
-                if content:
-                    yield f"data: {custom_json_dumps({'content': content})}\n\n"
-                else:
-                    break
-            except Exception as e:
-                yield f"data: {custom_json_dumps({'error': str(e)})}\n\n"
-                break
-    
-    return StreamingResponse(generate(), media_type="text/event-stream")
+    events = _content_events(openai_service.analyze_data, analyze_request.query, analyze_request.category)
+    return await _admitted_sse(request, "openai", analyze_request.query, _sse_events(events))
 
 @app.post("/stream/ask-ai")
-async def stream_ask_ai(ask_request: AskAIRequest):
+async def stream_ask_ai(ask_request: AskAIRequest, request: Request):
     """
     API endpoint สำหรับการถาม AI แบบ streaming
     """
-    async def generate():
-        # ใช้ asyncio.Queue เพื่อรับข้อความจาก callback
-        queue = asyncio.Queue()
-        loop = asyncio.get_running_loop()
-        
-        # สร้าง callback function
-        def callback(content):
-            asyncio.run_coroutine_threadsafe(queue.put(content), loop)
-        
-        # เริ่มการสร้างข้อความใน thread แยก
-        asyncio.create_task(
-            asyncio.to_thread(
-                openai_service.ask_ai_with_db_data,
-                ask_request.question,
-                ask_request.category,
-                callback
-            )
-        )
-        
-        # ส่งข้อความกลับเป็น Server-Sent Events
-        while True:
-            try:
-                content = await queue.get()
-                if content:
-                    yield f"data: {custom_json_dumps({'content': content})}\n\n"
-                else:
-                    break
-            except Exception as e:
-                yield f"data: {custom_json_dumps({'error': str(e)})}\n\n"
-                break
-    
-    return StreamingResponse(generate(), media_type="text/event-stream")
+    events = _content_events(openai_service.ask_ai_with_db_data, ask_request.question, ask_request.category)
+    return await _admitted_sse(request, "openai", ask_request.question, _sse_events(events))
 
-@app.post("/stream/sql-query")
-async def stream_sql_query(query_request: SQLQueryRequest):
+def _stage_timing_event(stage, stage_started, pipeline_started):
+    """สร้าง status event สำหรับรายงานเวลาที่ใช้ในแต่ละขั้นตอนของ pipeline"""
+    now = time.perf_counter()
+    event = {
+        'status': 'stage_timing',
+        'stage': stage,
+        'duration_ms': round((now - stage_started) * 1000, 1),
+        'elapsed_ms': round((now - pipeline_started) * 1000, 1)
+    }
+    logger.info(f"ขั้นตอน {stage} ใช้เวลา {event['duration_ms']} ms (รวม {event['elapsed_ms']} ms)")
+    return event
+
+def _result_json(rows):
+    """แปลงแถวข้อมูลเป็น JSON array (ค่าที่แปลงไม่ได้จะถูกแปลงเป็นข้อความ)"""
+    try:
+        return json.dumps(rows, ensure_ascii=False, cls=CustomJSONEncoder)
+    except Exception as json_error:
+        logger.error(f"เกิดข้อผิดพลาดในการแปลงผลลัพธ์เป็น JSON: {str(json_error)}")
+        return json.dumps(rows, ensure_ascii=False, default=str)
+
+async def sql_query_event_stream(question, speculative=None):
     """
-    สร้างและรันคำสั่ง SQL จากคำถามภาษาธรรมชาติ และส่งผลลัพธ์แบบ streaming
+    สร้างและรันคำสั่ง SQL จากคำถามภาษาธรรมชาติ และคืนค่าเป็น event
+
+    event เป็น dict ยกเว้นผลลัพธ์จากฐานข้อมูลซึ่งแปลงเป็น JSON ไว้แล้วใน BinaryBatch
+    (header type เป็น result_rows พร้อม offset หรือ result) แต่ละ transport แปลงรูปแบบเอง
+    
+    system message ของการวิเคราะห์ไม่ขึ้นกับคำถาม จึงสร้างไว้ก่อนและใช้ prompt cache ของ OpenAI ร่วมกันทุกคำขอ
+    เวลาที่ใช้ในแต่ละขั้นตอนจะถูกส่งกลับเป็น status event ชื่อ stage_timing
     """
-    question = query_request.question
     logger.info(f"คำถาม SQL: {question}")
     
-    async def generate():
+    pipeline_started = time.perf_counter()
+    try:
+        # ดึงโครงสร้างฐานข้อมูล ส่วนคำแนะนำอ่านจาก prompt store ในหน่วยความจำ
+        stage_started = time.perf_counter()
+        schema = await asyncio.to_thread(get_database_schema)
+        prompt_version = openai_service.prompt_version
+        prompts = openai_service.load_prompts()
+        yield _stage_timing_event('load_context', stage_started, pipeline_started)
+    
+        if not schema:
+            error_msg = "ไม่สามารถดึงโครงสร้างฐานข้อมูลได้"
+            logger.error(error_msg)
+            yield {'error': error_msg}
+            return
+    
+        # ดึงประเภทฐานข้อมูลปัจจุบัน
+        db_type = db_manager.db_type
+        logger.info(f"ประเภทฐานข้อมูลที่ใช้: {db_type}")
+    
+        if not prompts or "sql_analysis_prompt" not in prompts:
+            logger.warning("ไม่พบคำแนะนำสำหรับการวิเคราะห์ SQL ใช้ค่าเริ่มต้น")
+            prompt_template = openai_service.default_sql_analysis_prompt
+        else:
+            prompt_template = prompts.get("sql_analysis_prompt", "")
+        analysis_system_prompt = openai_service.build_sql_analysis_system_prompt(db_type, prompt_template)
+    
+        # แจ้งสถานะการสร้าง SQL
+        yield {'status': 'generating_sql'}
+    
+        # คำถามรูปแบบที่พบบ่อยสร้างและรันคำสั่งได้ทันทีโดยไม่ต้องเรียก AI
+        stage_started = time.perf_counter()
+        template, sql_query, template_result = await _run_question_template(question, schema, db_type)
+        
+        speculative = is_speculative_enabled(speculative)
+        if template is not None:
+            speculative = False
+            yield _stage_timing_event('template_match', stage_started, pipeline_started)
+            yield {'status': 'template_match', 'intent': template.intent}
+        elif speculative:
+            # สร้างคำสั่งหลายชุดพร้อมกัน ตรวจสอบ และรันชุดแรกที่ถูกต้อง
+            stage_started = time.perf_counter()
+            try:
+                speculation = await generate_and_execute_sql(openai_service, question, schema, db_type)
+            except Exception as e:
+                logger.error(f"เกิดข้อผิดพลาดในการรันคำสั่ง SQL: {str(e)}")
+                yield {'error': f'เกิดข้อผิดพลาดในการรันคำสั่ง SQL: {str(e)}'}
+                return
+            sql_query = speculation['sql_query']
+            yield _stage_timing_event('speculative_sql', stage_started, pipeline_started)
+            yield {'status': 'speculative_sql', 'attempts': speculation['attempts'], 'repaired': speculation['repaired']}
+        else:
+            # สร้างคำสั่ง SQL ใน thread แยกเพื่อไม่ให้ event loop ถูกบล็อก
+            stage_started = time.perf_counter()
+            sql_query = await asyncio.to_thread(
+                openai_service.generate_sql_from_question, question, schema, db_type
+            )
+            yield _stage_timing_event('generate_sql', stage_started, pipeline_started)
+    
+        # ส่งคำสั่ง SQL กลับไปยังผู้ใช้
+        yield {'sql_query': sql_query}
+    
+        # แจ้งสถานะการรันคำสั่ง SQL
+        yield {'status': 'executing_sql'}
+    
+        # รันคำสั่ง SQL
         try:
-            # ดึงโครงสร้างฐานข้อมูล
-            schema = get_database_schema()
-            if not schema:
-                error_msg = "ไม่สามารถดึงโครงสร้างฐานข้อมูลได้"
+            stage_started = time.perf_counter()
+            if template is not None:
+                # คำสั่งจากรูปแบบคำถามถูกรันไปแล้วในขั้นตอนก่อนหน้า
+                result = template_result
+            elif speculative:
+                # คำสั่งถูกรันไปแล้วในขั้นตอนก่อนหน้า
+                result = speculation['result']
+            else:
+                result = await asyncio.to_thread(execute_sql_query, sql_query)
+            yield _stage_timing_event('execute_sql', stage_started, pipeline_started)
+    
+            # ตรวจสอบว่า result มีค่าหรือไม่
+            if result is None:
+                error_msg = "ไม่สามารถรันคำสั่ง SQL ได้ ผลลัพธ์เป็น None"
                 logger.error(error_msg)
-                yield f"data: {json.dumps({'error': error_msg}, ensure_ascii=False)}\n\n"
+                yield {'error': error_msg}
                 return
-                
-            # ดึงประเภทฐานข้อมูลปัจจุบัน
-            db_type = db_manager.db_type
-            logger.info(f"ประเภทฐานข้อมูลที่ใช้: {db_type}")
-            
-            # แจ้งสถานะการสร้าง SQL
-            yield f"data: {json.dumps({'status': 'generating_sql'}, ensure_ascii=False)}\n\n"
-            
-            # สร้างคำสั่ง SQL
-            openai_service = OpenAIService()
-            sql_query = openai_service.generate_sql_from_question(question, schema, db_type)
-            
-            # ส่งคำสั่ง SQL กลับไปยังผู้ใช้
-            yield f"data: {json.dumps({'sql_query': sql_query}, ensure_ascii=False)}\n\n"
-            
-            # แจ้งสถานะการรันคำสั่ง SQL
-            yield f"data: {json.dumps({'status': 'executing_sql'}, ensure_ascii=False)}\n\n"
-            
-            # รันคำสั่ง SQL
-            try:
-                result = execute_sql_query(sql_query)
-                
-                # ตรวจสอบว่า result มีค่าหรือไม่
-                if result is None:
-                    error_msg = "ไม่สามารถรันคำสั่ง SQL ได้ ผลลัพธ์เป็น None"
-                    logger.error(error_msg)
-                    yield f"data: {json.dumps({'error': error_msg}, ensure_ascii=False)}\n\n"
-                    return
-                
-                # ส่งผลลัพธ์กลับไปยังผู้ใช้
-                yield f"data: {json.dumps({'result': result}, cls=CustomJSONEncoder, ensure_ascii=False)}\n\n"
-                
-                # แจ้งสถานะการวิเคราะห์ผลลัพธ์
-                yield f"data: {json.dumps({'status': 'analyzing_result'}, ensure_ascii=False)}\n\n"
-                yield f"data: {json.dumps({'analysis_start': True}, ensure_ascii=False)}\n\n"
-                
-                # ใช้ asyncio.Queue เพื่อรับข้อความจาก callback
-                queue = asyncio.Queue()
-                
-                async def analysis_callback(content):
-                    if content:
-                        await queue.put(content)
-                    else:
-                        logger.warning("ได้รับข้อความว่างเปล่าจาก callback")
-                
-                # แปลงผลลัพธ์เป็น JSON
-                try:
-                    result_json = json.dumps(result, ensure_ascii=False, cls=CustomJSONEncoder)
-                except Exception as json_error:
-                    logger.error(f"เกิดข้อผิดพลาดในการแปลงผลลัพธ์เป็น JSON: {str(json_error)}")
-                    result_json = str(result)
-                
-                # สร้างคำแนะนำเฉพาะสำหรับแต่ละประเภทฐานข้อมูล
-                db_specific_instructions = ""
-                if db_type.lower() == "mysql":
-                    db_specific_instructions = """
-                    - คำนึงถึงว่าผลลัพธ์มาจากฐานข้อมูล MySQL
-                    - ชื่อคอลัมน์อาจมีการใช้ backticks (`) ในคำสั่ง SQL
-                    """
-                elif db_type.lower() == "postgresql":
-                    db_specific_instructions = """
-                    - คำนึงถึงว่าผลลัพธ์มาจากฐานข้อมูล PostgreSQL
-                    - ชื่อคอลัมน์อาจมีการใช้ double quotes (") ในคำสั่ง SQL
-                    """
-                elif db_type.lower() == "mongodb":
-                    db_specific_instructions = """
-                    - คำนึงถึงว่าผลลัพธ์มาจากฐานข้อมูล MongoDB
-                    - ผลลัพธ์อาจมีรูปแบบที่แตกต่างจาก SQL ทั่วไป เนื่องจาก MongoDB เป็นฐานข้อมูลแบบ NoSQL
-                    """
-                
-                # โหลดคำแนะนำจากไฟล์
-                prompts = openai_service.load_prompts()
-                if not prompts or "sql_analysis_prompt" not in prompts:
-                    logger.warning("ไม่พบคำแนะนำสำหรับการวิเคราะห์ SQL ใช้ค่าเริ่มต้น")
-                    prompt_template = openai_service.default_sql_analysis_prompt
+    
+            # แปลงผลลัพธ์เป็น JSON ครั้งเดียว และใช้ทั้งสำหรับส่งให้ผู้ใช้และสำหรับการวิเคราะห์
+            if isinstance(result, list):
+                # ส่งแถวข้อมูลเป็นชุดๆ เพื่อให้หน้าเว็บแสดงผลได้ทันทีโดยไม่ต้องรอ JSON ก้อนเดียวขนาดใหญ่
+                # แล้วต่อ JSON ของแต่ละชุดเป็น array เดียวสำหรับการวิเคราะห์ (ไม่ต้องแปลงซ้ำ)
+                batch_jsons = []
+                for offset in range(0, len(result), QUERY_STREAM_CHUNK_SIZE):
+                    batch_json = _result_json(result[offset:offset + QUERY_STREAM_CHUNK_SIZE])
+                    batch_jsons.append(batch_json[1:-1])
+                    yield BinaryBatch({'type': 'result_rows', 'offset': offset}, batch_json.encode('utf-8'))
+                result_json = '[' + ', '.join(batch_jsons) + ']'
+                yield {'result_complete': True, 'row_count': len(result)}
+            else:
+                result_json = _result_json(result)
+                yield BinaryBatch({'type': 'result'}, result_json.encode('utf-8'))
+    
+            # แจ้งสถานะการวิเคราะห์ผลลัพธ์
+            yield {'status': 'analyzing_result'}
+            yield {'analysis_start': True}
+    
+            if template is not None and template.has_direct_answer:
+                # คำถามที่ได้ค่าเดียวตอบได้เลยโดยไม่ต้องให้ AI วิเคราะห์
+                yield {'analysis_chunk': template.format_answer(result)}
+                yield _stage_timing_event('analyze_result', stage_started, pipeline_started)
+                yield {'analysis_complete': True}
+                return
+    
+            # ใช้ asyncio.Queue เพื่อรับข้อความจาก callback
+            queue = asyncio.Queue()
+    
+            async def analysis_callback(content):
+                if content:
+                    await queue.put(content)
                 else:
-                    prompt_template = prompts.get("sql_analysis_prompt", "")
-                
-                # สร้างคำแนะนำสำหรับ AI
-                prompt = f"""คุณเป็นผู้เชี่ยวชาญในการวิเคราะห์ข้อมูลและการตอบคำถามจากผลลัพธ์ SQL
-
-คำถาม: {question}
-
-คำสั่ง SQL ที่ใช้: {sql_query}
-
-ประเภทฐานข้อมูล: {db_type}
-
-คำแนะนำเฉพาะสำหรับฐานข้อมูล {db_type}:
-{db_specific_instructions}
-
-ผลลัพธ์: {result_json}
-
-{prompt_template}
-
-กรุณาวิเคราะห์ผลลัพธ์และตอบคำถามข้างต้น:"""
-                
-                logger.info("เริ่มการวิเคราะห์ผลลัพธ์")
-                
-                # เริ่มการวิเคราะห์ในอีก task หนึ่ง
-                analysis_task = asyncio.create_task(
-                    openai_service.analyze_sql_result_with_callback(prompt, analysis_callback)
-                )
-                
-                # รอรับข้อความจาก callback และส่งกลับไปยังผู้ใช้
-                timeout = 60  # เพิ่มเวลา timeout เป็น 60 วินาที
-                try:
-                    while True:
-                        try:
-                            content = await asyncio.wait_for(queue.get(), timeout=timeout)
-                            if content:
-                                yield f"data: {json.dumps({'analysis_chunk': content}, ensure_ascii=False)}\n\n"
-                            else:
-                                # ถ้าได้รับข้อความว่างให้ตรวจสอบว่า task เสร็จสิ้นแล้วหรือไม่
-                                if analysis_task.done():
-                                    break
-                                logger.warning("ได้รับข้อความว่างเปล่าจาก queue")
-                        except asyncio.TimeoutError:
-                            # ถ้าเกิด timeout ให้ตรวจสอบว่า task เสร็จสิ้นแล้วหรือไม่
+                    logger.warning("ได้รับข้อความว่างเปล่าจาก callback")
+    
+            # ต่อคำถามและผลลัพธ์ท้าย system message ที่เตรียมไว้แล้ว
+            messages = openai_service.build_sql_analysis_messages(analysis_system_prompt, question, sql_query, result_json)
+    
+            stage_started = time.perf_counter()
+            route = model_router.route("sql_analysis", question, result_json)
+            cache_key = analysis_cache.make_key(question, result_json, db_type, prompt_version, route.model)
+            cached_analysis = await asyncio.to_thread(analysis_cache.get, cache_key)
+            if cached_analysis is not None:
+                # คำถามเดิมกับข้อมูลชุดเดิม ส่งคำตอบที่เก็บไว้ได้ทันทีโดยไม่ต้องเรียก AI
+                logger.info("ใช้คำตอบการวิเคราะห์จาก cache")
+                yield {'status': 'analysis_cached'}
+                for content in analysis_cache.replay_chunks(cached_analysis):
+                    yield {'analysis_chunk': content}
+                yield _stage_timing_event('analyze_result', stage_started, pipeline_started)
+                yield {'analysis_complete': True}
+                return
+    
+            logger.info("เริ่มการวิเคราะห์ผลลัพธ์")
+    
+            # เริ่มการวิเคราะห์ในอีก task หนึ่ง
+            analysis_task = asyncio.create_task(
+                openai_service.analyze_sql_result_with_callback(messages, analysis_callback, route=route, cache_key=cache_key)
+            )
+    
+            # รอรับข้อความจาก callback และส่งกลับไปยังผู้ใช้
+            timeout = 60  # เพิ่มเวลา timeout เป็น 60 วินาที
+            first_chunk = True
+            try:
+                while True:
+                    # ถ้า task เสร็จสิ้นและไม่มีข้อความค้างใน queue แล้ว ให้จบการรอ
+                    if analysis_task.done() and queue.empty():
+                        break
+                    try:
+                        content = await asyncio.wait_for(queue.get(), timeout=timeout)
+                        if content:
+                            if first_chunk:
+                                first_chunk = False
+                                yield _stage_timing_event('analysis_first_token', stage_started, pipeline_started)
+                            yield {'analysis_chunk': content}
+                        else:
+                            # ถ้าได้รับข้อความว่างให้ตรวจสอบว่า task เสร็จสิ้นแล้วหรือไม่
                             if analysis_task.done():
                                 break
-                            else:
-                                logger.warning("เกิด timeout ในการรอข้อความจาก OpenAI API")
-                                yield f"data: {json.dumps({'analysis_error': 'เกิด timeout ในการวิเคราะห์ผลลัพธ์'}, ensure_ascii=False)}\n\n"
-                                break
-                    
-                    # แจ้งว่าการวิเคราะห์เสร็จสิ้น
-                    yield f"data: {json.dumps({'analysis_complete': True}, ensure_ascii=False)}\n\n"
-                    logger.info("การวิเคราะห์ผลลัพธ์เสร็จสิ้น")
-                    
-                except Exception as e:
-                    logger.error(f"เกิดข้อผิดพลาดในการวิเคราะห์ผลลัพธ์: {str(e)}")
-                    yield f"data: {json.dumps({'analysis_error': str(e)}, ensure_ascii=False)}\n\n"
-                
+                            logger.warning("ได้รับข้อความว่างเปล่าจาก queue")
+                    except asyncio.TimeoutError:
+                        # ถ้าเกิด timeout ให้ตรวจสอบว่า task เสร็จสิ้นแล้วหรือไม่
+                        if analysis_task.done():
+                            break
+                        else:
+                            logger.warning("เกิด timeout ในการรอข้อความจาก OpenAI API")
+                            yield {'analysis_error': 'เกิด timeout ในการวิเคราะห์ผลลัพธ์'}
+                            break
+    
+                yield _stage_timing_event('analyze_result', stage_started, pipeline_started)
+    
+                # แจ้งว่าการวิเคราะห์เสร็จสิ้น
+                yield {'analysis_complete': True}
+                logger.info("การวิเคราะห์ผลลัพธ์เสร็จสิ้น")
+    
             except Exception as e:
-                logger.error(f"เกิดข้อผิดพลาดในการรันคำสั่ง SQL: {str(e)}")
-                yield f"data: {json.dumps({'error': f'เกิดข้อผิดพลาดในการรันคำสั่ง SQL: {str(e)}'}, ensure_ascii=False)}\n\n"
-                
+                logger.error(f"เกิดข้อผิดพลาดในการวิเคราะห์ผลลัพธ์: {str(e)}")
+                yield {'analysis_error': str(e)}
+    
         except Exception as e:
-            logger.error(f"เกิดข้อผิดพลาดในการสร้างคำสั่ง SQL: {str(e)}")
-            yield f"data: {json.dumps({'error': f'เกิดข้อผิดพลาดในการสร้างคำสั่ง SQL: {str(e)}'}, ensure_ascii=False)}\n\n"
+            logger.error(f"เกิดข้อผิดพลาดในการรันคำสั่ง SQL: {str(e)}")
+            yield {'error': f'เกิดข้อผิดพลาดในการรันคำสั่ง SQL: {str(e)}'}
+    
+    except Exception as e:
+        logger.error(f"เกิดข้อผิดพลาดในการสร้างคำสั่ง SQL: {str(e)}")
+        yield {'error': f'เกิดข้อผิดพลาดในการสร้างคำสั่ง SQL: {str(e)}'}
+
+def _sql_query_events(query_request):
+    """event ของ pipeline SQL (รวมกับคำขอที่ซ้ำกันถ้าเปิด SINGLEFLIGHT_ENABLED)"""
+    question = query_request.question
+    if not SINGLEFLIGHT_ENABLED:
+        return sql_query_event_stream(question, query_request.speculative)
+    key = _coalescing_key(question, query_request.speculative)
+    return sql_stream_flight.subscribe(
+        key, lambda: sql_query_event_stream(question, query_request.speculative)
+    )
+
+@app.post("/stream/sql-query")
+async def stream_sql_query(query_request: SQLQueryRequest, request: Request):
+    """
+    สร้างและรันคำสั่ง SQL จากคำถามภาษาธรรมชาติ และส่งผลลัพธ์แบบ streaming
+    
+    คำถามเดียวกัน (บนการเชื่อมต่อและคำแนะนำเวอร์ชันเดียวกัน) ที่เข้ามาพร้อมกันจะใช้ pipeline เดียวกัน
+    และได้รับ event ชุดเดียวกัน
+    """
+    return await _admitted_sse(request, "openai", query_request.question, _sse_events(_sql_query_events(query_request)))
+
+# stream ที่ใช้ได้ผ่าน WebSocket /ws (payload เหมือนกับ body ของ endpoint แบบ SSE)
+def _ws_sql_query_stream(payload):
+    """pipeline SQL ผ่าน WebSocket (ผลลัพธ์จากฐานข้อมูลเป็น BinaryBatch จึงส่งเป็น binary frame ได้ทันที)"""
+    return _sql_query_events(SQLQueryRequest(**payload))
+
+async def _ws_db_query_stream(payload):
+    """รันคำสั่งอ่านข้อมูลผ่าน WebSocket โดยส่งแต่ละ chunk เป็น binary frame"""
+    query_request = SQLQueryRequest(**payload)
+    chunk_size = min(max(1, int(payload.get('chunk_size') or QUERY_STREAM_CHUNK_SIZE)), 10000)
+    row_count = 0
+    chunks = 0
+    async for chunk_index, rows, rows_json in _db_query_chunks(query_request.question, chunk_size):
+        row_count += rows
+        chunks += 1
+        yield BinaryBatch({'type': 'result_batch', 'chunk': chunk_index, 'rows': rows}, rows_json.encode('utf-8'))
+    yield {'complete': True, 'row_count': row_count, 'chunks': chunks}
+
+def _ws_analyze_stream(payload):
+    analyze_request = AnalyzeRequest(**payload)
+    return _content_events(openai_service.analyze_data, analyze_request.query, analyze_request.category)
+
+def _ws_ask_ai_stream(payload):
+    ask_request = AskAIRequest(**payload)
+    return _content_events(openai_service.ask_ai_with_db_data, ask_request.question, ask_request.category)
+
+stream_multiplexer.register("chat", lambda payload: _chat_events(ChatRequest(**payload)))
+stream_multiplexer.register("analyze", _ws_analyze_stream)
+stream_multiplexer.register("ask_ai", _ws_ask_ai_stream)
+stream_multiplexer.register("sql_query", _ws_sql_query_stream)
+stream_multiplexer.register("db_query", _ws_db_query_stream)
+
+# ทรัพยากรและฟิลด์ข้อความ (สำหรับประมาณ token) ของแต่ละประเภท stream
+WS_STREAM_ADMISSION = {
+    "chat": ("openai", "message"),
+    "analyze": ("openai", "query"),
+    "ask_ai": ("openai", "question"),
+    "sql_query": ("openai", "question"),
+    "db_query": ("db", None)
+}
+
+async def _ws_admit(identity, stream_type, payload):
+    pool, text_field = WS_STREAM_ADMISSION[stream_type]
+    text = str(payload.get(text_field) or "") if text_field else ""
+    ticket = await admission_controller.admit(identity, pool, text)
+    return ticket.release
+
+stream_multiplexer.admit = _ws_admit
+
+@app.websocket("/ws")
+async def websocket_streams(websocket: WebSocket):
+    """
+    WebSocket เส้นเดียวสำหรับหลาย stream พร้อมกัน (chat, analyze, ask_ai, sql_query, db_query)
     
-    return StreamingResponse(generate(), media_type="text/event-stream")
+    ส่ง {"id", "type", "payload"} เพื่อเริ่ม stream และ {"id", "type": "cancel"} เพื่อยกเลิก
+    """
+    await stream_multiplexer.serve(websocket, admission_controller.identify(websocket))
+
+@app.post("/api/jobs")
+async def submit_job(job_request: JobSubmitRequest):
+    """
+    ส่งงานที่ใช้เวลานานเข้าคิว (เช่น type=sql_query, payload={"question": ...}) และคืนค่า job id สำหรับติดตามสถานะ
+    """
+    try:
+        job_id = await job_manager.submit(job_request.type, job_request.payload, job_request.priority)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return JSONResponse(status_code=202, content={"job_id": job_id, "status": "queued"})
+
+@app.get("/api/jobs")
+async def list_jobs(status: Optional[str] = None, type: Optional[str] = None, limit: int = Query(50, ge=1, le=500)):
+    """รายการงานล่าสุด (ไม่รวมผลลัพธ์)"""
+    return {"jobs": await job_manager.list(status, type, limit), "queues": job_manager.status()}
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    """สถานะ ความคืบหน้า และผลลัพธ์ (เมื่อเสร็จแล้ว) ของงาน"""
+    try:
+        job = await job_manager.get(job_id)
+    except JobNotFound:
+        raise HTTPException(status_code=404, detail="ไม่พบงาน")
+    return JSONResponse(content=json.loads(custom_json_dumps(job)))
+
+@app.delete("/api/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """ยกเลิกงานที่รออยู่ในคิวหรือกำลังรัน"""
+    try:
+        cancelled = await job_manager.cancel(job_id)
+    except JobNotFound:
+        raise HTTPException(status_code=404, detail="ไม่พบงาน")
+    if not cancelled:
+        raise HTTPException(status_code=409, detail="งานเสร็จสิ้นไปแล้ว")
+    return {"success": True}
+
+@app.get("/api/metrics")
+async def get_metrics():
+    """ดึงข้อมูล metrics ของแอปพลิเคชัน"""
+    return {
+        "metrics": metrics.snapshot(),
+        "sql_speculation": get_speculation_metrics(),
+        "openai_resilience": resilient_caller.status(),
+        "model_routes": model_router.get_metrics(),
+        "query_templates": get_template_metrics(),
+        "jobs": job_manager.status(),
+        "query_cursors": query_cursors.status(),
+        "websocket": stream_multiplexer.status(),
+        "admission": admission_controller.status(),
+        "profiling": request_profiler.status(),
+        "cache": app_cache.stats()
+    }
+
+def require_profiling_admin(request: Request):
+    """อนุญาตเฉพาะผู้ดูแลที่ส่ง PROFILING_ADMIN_TOKEN มาใน PROFILING_HEADER"""
+    if not request_profiler.admin_token:
+        raise HTTPException(status_code=404, detail="ยังไม่ได้เปิดใช้งาน profiling (ตั้งค่า PROFILING_ADMIN_TOKEN)")
+    if not request_profiler.authorize(request.headers.get(PROFILING_HEADER)):
+        raise HTTPException(status_code=403, detail="ไม่มีสิทธิ์ใช้งาน profiling")
+
+@app.get("/api/profiling", dependencies=[Depends(require_profiling_admin)])
+async def get_profiling():
+    """ดูสถานะการ profile คำขอช้าล่าสุด และไฟล์ profile ที่เก็บไว้"""
+    profiles = await asyncio.to_thread(request_profiler.list_profiles)
+    return {**request_profiler.status(), "profiles": profiles}
+
+@app.post("/api/profiling/window", dependencies=[Depends(require_profiling_admin)])
+async def start_profiling_window(window_request: ProfilingWindowRequest):
+    """เปิดการ profile คำขอทุก worker เป็นช่วงเวลาที่กำหนด"""
+    window = await asyncio.to_thread(
+        request_profiler.start_window,
+        window_request.duration_seconds,
+        window_request.path_prefix,
+        window_request.sample_rate
+    )
+    return {"success": True, "window": window}
+
+@app.delete("/api/profiling/window", dependencies=[Depends(require_profiling_admin)])
+async def stop_profiling_window():
+    """ปิดการ profile ตามช่วงเวลาก่อนหมดเวลา"""
+    await asyncio.to_thread(request_profiler.stop_window)
+    return {"success": True}
+
+@app.get("/api/profiling/profiles/{name}", dependencies=[Depends(require_profiling_admin)])
+async def download_profile(name: str):
+    """ดาวน์โหลดไฟล์ profile จากชื่อไฟล์หรือค่า X-Profile-Id"""
+    path = await asyncio.to_thread(request_profiler.profile_path, name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="ไม่พบไฟล์ profile")
+    return FileResponse(path, filename=os.path.basename(path))
+
+@app.get("/api/model-routes")
+async def get_model_routes():
+    """ดึงการตั้งค่าการเลือก model ของแต่ละงาน"""
+    return model_router.get_config()
+
+@app.post("/api/model-routes")
+async def update_model_routes(routes_request: ModelRoutesRequest):
+    """อัปเดตการเลือก model ของแต่ละงาน (mode: auto, fast, strong หรือชื่อ model)"""
+    try:
+        return {"success": True, **model_router.update_config(routes_request.models, routes_request.routes)}
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 @app.get("/api/prompt")
 async def get_prompt():
@@ -506,6 +1120,8 @@ async def update_prompt(prompt_request: PromptUpdateRequest):
     try:
         success = openai_service.save_prompts(prompt_request.prompt)
         if success:
+            # คำตอบที่วิเคราะห์ด้วยคำแนะนำเดิมใช้ไม่ได้แล้ว
+            analysis_cache.invalidate()
             return {"status": "success", "message": "อัปเดตคำแนะนำสำเร็จ"}
         else:
             raise HTTPException(status_code=500, detail="ไม่สามารถบันทึกคำแนะนำได้")
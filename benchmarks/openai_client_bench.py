@@ -0,0 +1,118 @@
+"""
+เปรียบเทียบ overhead ต่อคำขอระหว่างการสร้าง OpenAI client ใหม่ทุกคำขอ กับการใช้ client ร่วมกัน
+
+ใช้ HTTP server จำลองในเครื่องที่ตอบกลับแบบ chat completion (ไม่เรียก OpenAI จริง)
+และจำลองผู้ใช้พร้อมกัน 200 คน
+
+วิธีใช้:
+    python benchmarks/openai_client_bench.py --users 200 --requests 5
+"""
+import argparse
+import json
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+from openai import OpenAI
+
+COMPLETION = json.dumps({
+    "id": "chatcmpl-bench",
+    "object": "chat.completion",
+    "created": 0,
+    "model": "gpt-4o",
+    "choices": [{"index": 0, "message": {"role": "assistant", "content": "SELECT 1"}, "finish_reason": "stop"}],
+    "usage": {"prompt_tokens": 10, "completion_tokens": 2, "total_tokens": 12}
+}).encode("utf-8")
+
+class StubHandler(BaseHTTPRequestHandler):
+    """ตอบกลับ chat completion แบบคงที่ พร้อม keep-alive"""
+    protocol_version = "HTTP/1.1"
+    response_delay = 0.0
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        if self.response_delay:
+            time.sleep(self.response_delay)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(COMPLETION)))
+        self.end_headers()
+        self.wfile.write(COMPLETION)
+
+    def log_message(self, format, *args):
+        pass
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+def start_stub_server(delay):
+    StubHandler.response_delay = delay
+    server = StubServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def call(client):
+    started = time.perf_counter()
+    client.chat.completions.create(model="gpt-4o", messages=[{"role": "user", "content": "ping"}])
+    return (time.perf_counter() - started) * 1000
+
+def run(label, make_client, users, requests_per_user):
+    latencies = []
+    lock = threading.Lock()
+
+    def user_session():
+        for _ in range(requests_per_user):
+            client = make_client()
+            elapsed = call(client)
+            with lock:
+                latencies.append(elapsed)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users) as executor:
+        for future in [executor.submit(user_session) for _ in range(users)]:
+            future.result()
+    total = time.perf_counter() - started
+
+    latencies.sort()
+    print(
+        f"{label:<28} requests={len(latencies):>5}  req/s={len(latencies) / total:>8.1f}  "
+        f"mean={statistics.mean(latencies):>7.2f}ms  p95={latencies[int(len(latencies) * 0.95) - 1]:>7.2f}ms"
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=5, help="จำนวนคำขอต่อผู้ใช้")
+    parser.add_argument("--delay", type=float, default=0.005, help="เวลาตอบกลับจำลองของ server (วินาที)")
+    args = parser.parse_args()
+
+    server = start_stub_server(args.delay)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+    # แบบเดิม: สร้าง client (และ connection pool) ใหม่ทุกคำขอ
+    run(
+        "per-request client",
+        lambda: OpenAI(api_key="bench", base_url=base_url, max_retries=0),
+        args.users, args.requests
+    )
+
+    # แบบใหม่: ใช้ client ตัวเดียวกับ connection pool ที่ปรับแต่งแล้ว
+    # server จำลองรองรับเฉพาะ HTTP/1.1 จึงปิด HTTP/2 ในการทดสอบนี้
+    shared_http_client = httpx.Client(
+        http2=False,
+        limits=httpx.Limits(max_connections=args.users, max_keepalive_connections=args.users, keepalive_expiry=60),
+        timeout=httpx.Timeout(60, connect=5, pool=10)
+    )
+    shared_client = OpenAI(api_key="bench", base_url=base_url, http_client=shared_http_client, max_retries=0)
+    run("shared client (pooled)", lambda: shared_client, args.users, args.requests)
+
+    shared_http_client.close()
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
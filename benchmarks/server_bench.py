@@ -0,0 +1,98 @@
+"""
+เปรียบเทียบจำนวนคำขอต่อวินาทีระหว่างเซิร์ฟเวอร์โหมด dev (worker เดียว + reload) กับโหมด prod (หลาย worker + uvloop/httptools)
+
+สคริปต์จะรัน main.py แต่ละโหมดเป็น process แยก รอจนพร้อม แล้วยิงคำขอพร้อมกันไปยัง endpoint ที่ไม่เรียก OpenAI
+(ค่าเริ่มต้นคือ /api/metrics) ต้องมีไฟล์ .env ที่ทำให้ api.py เริ่มทำงานได้
+
+วิธีใช้:
+    python benchmarks/server_bench.py --users 100 --requests 50 --workers 4
+"""
+import argparse
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def start_server(mode, port, workers):
+    command = [sys.executable, "main.py", "--mode", mode, "--host", "127.0.0.1", "--port", str(port)]
+    if mode == "prod":
+        command += ["--workers", str(workers)]
+    # ให้ process ลูกอยู่ใน process group ของตัวเอง เพื่อปิด reloader / worker ทั้งหมดได้ในครั้งเดียว
+    return subprocess.Popen(command, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+
+def wait_ready(url, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"เซิร์ฟเวอร์ไม่พร้อมภายใน {timeout} วินาที: {url}")
+
+def stop_server(process):
+    os.killpg(process.pid, signal.SIGTERM)
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+
+def run(label, url, users, requests_per_user):
+    latencies = []
+    errors = 0
+
+    def user_session():
+        nonlocal errors
+        # หนึ่งผู้ใช้ใช้การเชื่อมต่อ keep-alive เดียว เหมือน browser
+        with httpx.Client(timeout=30) as client:
+            for _ in range(requests_per_user):
+                started = time.perf_counter()
+                try:
+                    client.get(url).raise_for_status()
+                except httpx.HTTPError:
+                    errors += 1
+                    continue
+                latencies.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users) as executor:
+        for future in [executor.submit(user_session) for _ in range(users)]:
+            future.result()
+    total = time.perf_counter() - started
+
+    latencies.sort()
+    print(
+        f"{label:<28} requests={len(latencies):>6}  errors={errors:>4}  req/s={len(latencies) / total:>8.1f}  "
+        f"mean={statistics.mean(latencies):>7.2f}ms  p95={latencies[int(len(latencies) * 0.95) - 1]:>7.2f}ms"
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--requests", type=int, default=50, help="จำนวนคำขอต่อผู้ใช้")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="จำนวน worker ในโหมด prod")
+    parser.add_argument("--path", default="/api/metrics", help="endpoint ที่ใช้ทดสอบ")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    for mode, label in (("dev", "dev (1 worker, reload)"), ("prod", f"prod ({args.workers} workers)")):
+        process = start_server(mode, args.port, args.workers)
+        url = f"http://127.0.0.1:{args.port}{args.path}"
+        try:
+            wait_ready(url)
+            # อุ่นเครื่องให้ทุก worker import และเปิดการเชื่อมต่อเสร็จก่อนวัดผล
+            run(f"{label} warm-up", url, args.users, 2)
+            run(label, url, args.users, args.requests)
+        finally:
+            stop_server(process)
+
+if __name__ == "__main__":
+    main()
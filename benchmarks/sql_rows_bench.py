@@ -0,0 +1,90 @@
+"""
+เปรียบเทียบจำนวนแถวต่อวินาทีของการแปลงผลลัพธ์คำสั่ง SQL ระหว่างวิธีเดิมและวิธีใหม่
+
+- เดิม: pymysql แปลงค่าเป็น Decimal/datetime แล้ววนตรวจทุกค่าด้วย isinstance เพื่อสร้าง dict ต่อแถว
+  และ CustomJSONEncoder แปลง Decimal/datetime อีกครั้งตอนสร้าง JSON
+- ใหม่: driver แปลง DECIMAL เป็น float และวันที่เป็นข้อความ ISO ทันที (mysql_result_conversions)
+  แถวเป็น tuple ที่ใช้หัวคอลัมน์ร่วมกัน (format=rows) หรือสร้าง dict ด้วย zip (format=records)
+
+ข้อมูลทดสอบเป็นค่าข้อความแบบที่ pymysql อ่านได้จาก protocol ของ MySQL จึงไม่ต้องมีฐานข้อมูลจริง
+แต่ต้องติดตั้ง dependency ของ database.py ครบ (pymysql, sqlalchemy, pandas, pymongo)
+
+วิธีใช้:
+    python benchmarks/sql_rows_bench.py --rows 1000000
+"""
+import argparse
+import decimal
+import json
+import os
+import sys
+import time
+
+from pymysql.constants import FIELD_TYPE
+from pymysql.converters import decoders
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from database import CustomJSONEncoder, mysql_result_conversions
+
+COLUMNS = ("id", "amount", "name", "created_at", "order_date")
+FIELD_TYPES = (FIELD_TYPE.LONG, FIELD_TYPE.NEWDECIMAL, FIELD_TYPE.VAR_STRING, FIELD_TYPE.DATETIME, FIELD_TYPE.DATE)
+
+def fixture(start, count):
+    """แถวข้อมูลดิบในรูปแบบข้อความตามที่ driver ได้รับ"""
+    return [
+        (str(i), f"{i % 100000}.{i % 100:02d}", f"ลูกค้า {i % 5000}",
+         f"2024-{i % 12 + 1:02d}-{i % 28 + 1:02d} {i % 24:02d}:{i % 60:02d}:00", f"2024-{i % 12 + 1:02d}-{i % 28 + 1:02d}")
+        for i in range(start, start + count)
+    ]
+
+def decode(raw_rows, conv):
+    """จำลองการแปลงค่าของ pymysql: เรียก converter ตามชนิดของแต่ละคอลัมน์ (ไม่แปลงถ้าไม่มี converter)"""
+    converters = [conv.get(field_type) for field_type in FIELD_TYPES]
+    return [
+        tuple(value if converter is None else converter(value) for converter, value in zip(converters, row))
+        for row in raw_rows
+    ]
+
+def before(raw_rows):
+    rows = []
+    for row in decode(raw_rows, decoders):
+        processed_row = {}
+        for i, column in enumerate(COLUMNS):
+            value = row[i]
+            if isinstance(value, decimal.Decimal):
+                processed_row[column] = float(value)
+            else:
+                processed_row[column] = value
+        rows.append(processed_row)
+    return json.dumps(rows, cls=CustomJSONEncoder, ensure_ascii=False)
+
+def after_records(raw_rows, conv):
+    rows = [dict(zip(COLUMNS, row)) for row in decode(raw_rows, conv)]
+    return json.dumps(rows, cls=CustomJSONEncoder, ensure_ascii=False)
+
+def after_rows(raw_rows, conv):
+    rows = decode(raw_rows, conv)
+    return json.dumps({"columns": COLUMNS, "rows": rows}, cls=CustomJSONEncoder, ensure_ascii=False)
+
+def measure(label, func, total, batch):
+    elapsed = 0.0
+    size = 0
+    for start in range(0, total, batch):
+        raw_rows = fixture(start, min(batch, total - start))
+        started = time.perf_counter()
+        size += len(func(raw_rows))
+        elapsed += time.perf_counter() - started
+    print(f"{label:<32} rows/s={total / elapsed:>12,.0f}  time={elapsed:>7.2f}s  json={size / 1e6:>8.1f}MB")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--batch", type=int, default=50000, help="จำนวนแถวที่สร้างและวัดผลต่อรอบ (จำกัดหน่วยความจำ)")
+    args = parser.parse_args()
+
+    conv = mysql_result_conversions()
+    measure("เดิม (Decimal + isinstance)", before, args.rows, args.batch)
+    measure("ใหม่ format=records", lambda raw_rows: after_records(raw_rows, conv), args.rows, args.batch)
+    measure("ใหม่ format=rows", lambda raw_rows: after_rows(raw_rows, conv), args.rows, args.batch)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,478 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import decimal
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, date
+from dotenv import load_dotenv
+from metrics import metrics
+
+try:
+    import msgpack
+except ImportError:  # ไม่มี msgpack จะเก็บข้อมูลเป็น JSON แทน
+    msgpack = None
+
+try:
+    import redis
+except ImportError:  # ใช้ backend แบบ redis ไม่ได้ถ้าไม่ได้ติดตั้ง
+    redis = None
+
+# ตั้งค่าการบันทึกล็อก
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# โหลดค่าจากไฟล์ .env
+load_dotenv()
+
+# ที่เก็บ cache ที่ใช้ร่วมกันระหว่าง worker: memory (เฉพาะ process), redis หรือ sqlite
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory").lower()
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0")
+CACHE_SQLITE_PATH = os.getenv("CACHE_SQLITE_PATH", "cache.db")
+# ขนาด memory-mapped I/O ของไฟล์ SQLite (bytes)
+CACHE_SQLITE_MMAP_SIZE = int(os.getenv("CACHE_SQLITE_MMAP_SIZE", str(64 * 1024 * 1024)))
+# จำนวนรายการและอายุสูงสุด (วินาที) ของ cache ในหน่วยความจำของแต่ละ process เมื่อมีที่เก็บร่วม
+CACHE_LOCAL_MAX_ENTRIES = int(os.getenv("CACHE_LOCAL_MAX_ENTRIES", "1000"))
+CACHE_LOCAL_TTL = float(os.getenv("CACHE_LOCAL_TTL", "5"))
+# อายุเริ่มต้นของรายการ (วินาที)
+CACHE_DEFAULT_TTL = int(os.getenv("CACHE_DEFAULT_TTL", "300"))
+# เวลาสูงสุดที่รอ worker อื่นคำนวณค่าเดียวกัน (วินาที)
+CACHE_LOCK_TIMEOUT = float(os.getenv("CACHE_LOCK_TIMEOUT", "30"))
+CACHE_KEY_PREFIX = os.getenv("CACHE_KEY_PREFIX", "dbassistant")
+
+# ช่วงเวลาระหว่างการตรวจว่า worker อื่นคำนวณเสร็จแล้วหรือยัง (วินาที)
+LOCK_POLL_INTERVAL = 0.05
+
+_EXT_DATETIME = 1
+_EXT_DATE = 2
+_EXT_DECIMAL = 3
+
+def _msgpack_default(obj):
+    if isinstance(obj, datetime):
+        return msgpack.ExtType(_EXT_DATETIME, obj.isoformat().encode('utf-8'))
+    if isinstance(obj, date):
+        return msgpack.ExtType(_EXT_DATE, obj.isoformat().encode('utf-8'))
+    if isinstance(obj, decimal.Decimal):
+        return msgpack.ExtType(_EXT_DECIMAL, str(obj).encode('utf-8'))
+    # ชนิดข้อมูลอื่น (เช่น ObjectId) เก็บเป็นข้อความ
+    return str(obj)
+
+def _msgpack_ext_hook(code, data):
+    text = data.decode('utf-8')
+    if code == _EXT_DATETIME:
+        return datetime.fromisoformat(text)
+    if code == _EXT_DATE:
+        return date.fromisoformat(text)
+    if code == _EXT_DECIMAL:
+        return decimal.Decimal(text)
+    return msgpack.ExtType(code, data)
+
+def serialize(value):
+    """แปลงค่าเป็น bytes (msgpack ถ้ามี ไม่เช่นนั้นใช้ JSON) โดย byte แรกระบุรูปแบบ"""
+    if msgpack is not None:
+        return b'm' + msgpack.packb(value, default=_msgpack_default, use_bin_type=True)
+    return b'j' + json.dumps(value, ensure_ascii=False, default=str).encode('utf-8')
+
+def deserialize(data):
+    if data[:1] == b'm':
+        if msgpack is None:
+            raise ValueError("ข้อมูลใน cache เป็น msgpack แต่ไม่ได้ติดตั้ง msgpack")
+        return msgpack.unpackb(data[1:], ext_hook=_msgpack_ext_hook, raw=False, strict_map_key=False)
+    return json.loads(data[1:].decode('utf-8'))
+
+def make_cache_key(*parts):
+    """สร้าง key สั้นๆ จากส่วนประกอบใดๆ"""
+    raw = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()[:32]
+
+class _LocalLRU:
+    """cache ในหน่วยความจำแบบ LRU พร้อมอายุของแต่ละรายการ (thread-safe)"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max(1, max_entries)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, data, ttl):
+        with self._lock:
+            self._entries[key] = (data, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear_namespace(self, namespace):
+        prefix = f"{namespace}:"
+        with self._lock:
+            for key in [key for key in self._entries if key.startswith(prefix)]:
+                del self._entries[key]
+
+class RedisBackend:
+    """ที่เก็บร่วมผ่าน Redis (หรือเซิร์ฟเวอร์ที่ใช้โปรโตคอลเดียวกัน)"""
+
+    name = "redis"
+
+    def __init__(self, url=CACHE_REDIS_URL, client=None):
+        if client is None:
+            if redis is None:
+                raise RuntimeError("ต้องติดตั้ง redis เพื่อใช้ CACHE_BACKEND=redis")
+            client = redis.Redis.from_url(url)
+        self._client = client
+
+    def get(self, key):
+        return self._client.get(key)
+
+    def set(self, key, data, ttl):
+        self._client.set(key, data, px=max(1, int(ttl * 1000)))
+
+    def delete(self, key):
+        self._client.delete(key)
+
+    def get_counter(self, key):
+        value = self._client.get(key)
+        return int(value) if value is not None else 0
+
+    def increment(self, key):
+        return int(self._client.incr(key))
+
+    def acquire_lock(self, key, ttl):
+        token = uuid.uuid4().hex
+        if self._client.set(key, token, nx=True, px=max(1, int(ttl * 1000))):
+            return token
+        return None
+
+    def release_lock(self, key, token):
+        # ลบเฉพาะ lock ของตัวเอง (lock อาจหมดอายุและถูก worker อื่นถือแล้ว)
+        with self._client.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                value = pipe.get(key)
+                if value is not None and value.decode('utf-8') == token:
+                    pipe.multi()
+                    pipe.delete(key)
+                    pipe.execute()
+                else:
+                    pipe.unwatch()
+            except redis.WatchError:
+                pass
+
+class SQLiteBackend:
+    """ที่เก็บร่วมในไฟล์ SQLite (ใช้ได้เมื่อทุก worker อยู่บนเครื่องเดียวกัน) อ่านผ่าน memory-mapped I/O"""
+
+    name = "sqlite"
+
+    # ลบรายการที่หมดอายุทุกๆ จำนวนครั้งของการเขียนนี้
+    CLEANUP_EVERY = 500
+
+    def __init__(self, path=CACHE_SQLITE_PATH, mmap_size=CACHE_SQLITE_MMAP_SIZE):
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(f"PRAGMA mmap_size={int(mmap_size)}")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL)"
+            )
+
+    def get(self, key):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value FROM cache WHERE key = ? AND expires_at > ?", (key, time.time())
+            ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, data, ttl):
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)", (key, data, now + ttl)
+            )
+            self._writes += 1
+            if self._writes % self.CLEANUP_EVERY == 0:
+                self._connection.execute("DELETE FROM cache WHERE expires_at <= ?", (now,))
+
+    def delete(self, key):
+        with self._lock:
+            self._connection.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def get_counter(self, key):
+        value = self.get(key)
+        return int(value) if value is not None else 0
+
+    def increment(self, key):
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._connection.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+                value = int(row[0]) + 1 if row else 1
+                # ตัวนับไม่มีวันหมดอายุ
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)", (key, str(value), float('inf'))
+                )
+                self._connection.execute("COMMIT")
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+        return value
+
+    def acquire_lock(self, key, ttl):
+        token = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                self._connection.execute("DELETE FROM cache WHERE key = ? AND expires_at <= ?", (key, now))
+                cursor = self._connection.execute(
+                    "INSERT OR IGNORE INTO cache (key, value, expires_at) VALUES (?, ?, ?)", (key, token, now + ttl)
+                )
+                self._connection.execute("COMMIT")
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+        return token if cursor.rowcount == 1 else None
+
+    def release_lock(self, key, token):
+        with self._lock:
+            self._connection.execute("DELETE FROM cache WHERE key = ? AND value = ?", (key, token))
+
+class Cache:
+    """
+    cache สองชั้น: LRU ในหน่วยความจำของแต่ละ process และที่เก็บร่วมระหว่าง worker (Redis หรือ SQLite)
+
+    ข้อมูลแบ่งตาม namespace ซึ่งล้างได้ทั้งชุดด้วย invalidate() (เพิ่มเลข generation ของ namespace ในที่เก็บร่วม)
+    รายการในหน่วยความจำมีอายุไม่เกิน CACHE_LOCAL_TTL เมื่อมีที่เก็บร่วม การล้างจาก worker อื่นจึงมีผลภายในเวลานั้น
+    ค่าที่ได้เป็นสำเนาใหม่ทุกครั้ง แก้ไขได้โดยไม่กระทบ cache
+    """
+
+    def __init__(self, backend=None, local_max_entries=CACHE_LOCAL_MAX_ENTRIES, local_ttl=CACHE_LOCAL_TTL):
+        self.backend = backend
+        self.local_ttl = local_ttl
+        self._local = _LocalLRU(local_max_entries)
+        self._lock = threading.Lock()
+        self._generations = {}
+        self._key_locks = {}
+
+    def _count(self, namespace, event, value=1):
+        metrics.increment(f"cache.{namespace}.{event}", value)
+
+    def _generation(self, namespace):
+        """เลข generation ของ namespace (อ่านจากที่เก็บร่วมไม่เกินหนึ่งครั้งต่อ local_ttl)"""
+        with self._lock:
+            cached = self._generations.get(namespace)
+            if cached is not None and (self.backend is None or time.monotonic() - cached[1] < self.local_ttl):
+                return cached[0]
+        generation = cached[0] if cached else 0
+        if self.backend is not None:
+            try:
+                generation = self.backend.get_counter(self._shared_key(namespace, "generation"))
+            except Exception as e:
+                self._backend_error(namespace, e)
+        with self._lock:
+            self._generations[namespace] = (generation, time.monotonic())
+        return generation
+
+    def _shared_key(self, *parts):
+        return ":".join([CACHE_KEY_PREFIX, *map(str, parts)])
+
+    def _keys(self, namespace, key):
+        if not isinstance(key, str):
+            key = make_cache_key(*key)
+        generation = self._generation(namespace)
+        return f"{namespace}:{generation}:{key}", self._shared_key(namespace, generation, key)
+
+    def _backend_error(self, namespace, error):
+        # ที่เก็บร่วมใช้งานไม่ได้ชั่วคราวยังทำงานต่อได้ด้วย cache ในหน่วยความจำ
+        self._count(namespace, "errors")
+        logger.warning(f"เกิดข้อผิดพลาดกับ cache ({self.backend.name}): {str(error)}")
+
+    def _local_ttl(self, ttl):
+        return ttl if self.backend is None else min(ttl, self.local_ttl)
+
+    def _lookup(self, namespace, local_key, shared_key):
+        """คืนค่า bytes จากชั้นที่พบก่อน หรือ None"""
+        data = self._local.get(local_key)
+        if data is not None:
+            self._count(namespace, "hits_local")
+            return data
+        if self.backend is not None:
+            try:
+                data = self.backend.get(shared_key)
+            except Exception as e:
+                self._backend_error(namespace, e)
+                data = None
+            if data is not None:
+                self._count(namespace, "hits_shared")
+                self._local.set(local_key, data, self.local_ttl)
+                return data
+        return None
+
+    def get(self, namespace, key, default=None):
+        """อ่านค่าจาก cache (key เป็น str หรือ tuple ของส่วนประกอบ)"""
+        local_key, shared_key = self._keys(namespace, key)
+        data = self._lookup(namespace, local_key, shared_key)
+        if data is None:
+            self._count(namespace, "misses")
+            return default
+        return deserialize(data)
+
+    def set(self, namespace, key, value, ttl=None):
+        """เก็บค่าลง cache ทั้งสองชั้น"""
+        local_key, shared_key = self._keys(namespace, key)
+        self._store(namespace, local_key, shared_key, serialize(value), ttl or CACHE_DEFAULT_TTL)
+
+    def _store(self, namespace, local_key, shared_key, data, ttl):
+        self._local.set(local_key, data, self._local_ttl(ttl))
+        if self.backend is not None:
+            try:
+                self.backend.set(shared_key, data, ttl)
+            except Exception as e:
+                self._backend_error(namespace, e)
+        self._count(namespace, "sets")
+
+    def delete(self, namespace, key):
+        local_key, shared_key = self._keys(namespace, key)
+        self._local.delete(local_key)
+        if self.backend is not None:
+            try:
+                self.backend.delete(shared_key)
+            except Exception as e:
+                self._backend_error(namespace, e)
+
+    def _key_lock(self, local_key):
+        with self._lock:
+            entry = self._key_locks.get(local_key)
+            if entry is None:
+                entry = self._key_locks[local_key] = [threading.Lock(), 0]
+            entry[1] += 1
+            return entry
+
+    def _release_key_lock(self, local_key, entry):
+        with self._lock:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._key_locks.pop(local_key, None)
+
+    def get_or_set(self, namespace, key, compute, ttl=None):
+        """
+        อ่านค่าจาก cache หรือคำนวณด้วย compute() แล้วเก็บไว้
+
+        ป้องกันการคำนวณซ้ำพร้อมกัน (cache stampede): ภายใน process ใช้ lock ต่อ key
+        ระหว่าง worker ใช้ lock ในที่เก็บร่วม worker ที่ไม่ได้ lock จะรอผลลัพธ์ไม่เกิน CACHE_LOCK_TIMEOUT
+        ถ้า compute() เกิดข้อผิดพลาดจะไม่เก็บค่าและส่งต่อข้อผิดพลาดให้ผู้เรียก
+        """
+        ttl = ttl or CACHE_DEFAULT_TTL
+        local_key, shared_key = self._keys(namespace, key)
+        data = self._lookup(namespace, local_key, shared_key)
+        if data is not None:
+            return deserialize(data)
+
+        entry = self._key_lock(local_key)
+        try:
+            with entry[0]:
+                # thread อื่นอาจคำนวณเสร็จระหว่างรอ lock
+                data = self._local.get(local_key)
+                if data is not None:
+                    self._count(namespace, "hits_local")
+                    return deserialize(data)
+                self._count(namespace, "misses")
+                return self._compute_shared(namespace, local_key, shared_key, compute, ttl)
+        finally:
+            self._release_key_lock(local_key, entry)
+
+    def _compute_shared(self, namespace, local_key, shared_key, compute, ttl):
+        lock_key = f"{shared_key}:lock"
+        token = None
+        if self.backend is not None:
+            try:
+                token = self.backend.acquire_lock(lock_key, CACHE_LOCK_TIMEOUT)
+                if token is None:
+                    # worker อื่นกำลังคำนวณค่าเดียวกัน รอผลลัพธ์จากที่เก็บร่วม
+                    self._count(namespace, "lock_waits")
+                    deadline = time.monotonic() + CACHE_LOCK_TIMEOUT
+                    while time.monotonic() < deadline:
+                        time.sleep(LOCK_POLL_INTERVAL)
+                        data = self.backend.get(shared_key)
+                        if data is not None:
+                            self._local.set(local_key, data, self.local_ttl)
+                            return deserialize(data)
+            except Exception as e:
+                self._backend_error(namespace, e)
+        try:
+            started = time.perf_counter()
+            value = compute()
+            metrics.observe(f"cache.{namespace}.compute", (time.perf_counter() - started) * 1000)
+            self._store(namespace, local_key, shared_key, serialize(value), ttl)
+            return value
+        finally:
+            if token is not None:
+                try:
+                    self.backend.release_lock(lock_key, token)
+                except Exception as e:
+                    self._backend_error(namespace, e)
+
+    def invalidate(self, namespace):
+        """ล้างทุกรายการของ namespace (ทุก worker เมื่อมีที่เก็บร่วม)"""
+        self._local.clear_namespace(namespace)
+        with self._lock:
+            generation = self._generations.get(namespace, (0, 0))[0] + 1
+        if self.backend is not None:
+            try:
+                generation = self.backend.increment(self._shared_key(namespace, "generation"))
+            except Exception as e:
+                self._backend_error(namespace, e)
+        with self._lock:
+            self._generations[namespace] = (generation, time.monotonic())
+        self._count(namespace, "invalidations")
+
+    def stats(self):
+        """สถิติของแต่ละ namespace (hit ในหน่วยความจำ/ที่เก็บร่วม, miss, การรอ lock และ hit rate)"""
+        snapshot = metrics.snapshot()
+        result = {}
+        for name, value in snapshot["counters"].items():
+            if not name.startswith("cache."):
+                continue
+            namespace, _, event = name[len("cache."):].rpartition(".")
+            result.setdefault(namespace, {})[event] = value
+        for namespace, entry in result.items():
+            hits = entry.get("hits_local", 0) + entry.get("hits_shared", 0)
+            lookups = hits + entry.get("misses", 0)
+            entry["hit_rate"] = round(hits / lookups, 3) if lookups else None
+            entry["compute"] = snapshot["timings"].get(f"cache.{namespace}.compute")
+        return {"backend": self.backend.name if self.backend else "memory", "namespaces": result}
+
+def _create_backend():
+    """สร้างที่เก็บร่วมตาม CACHE_BACKEND (ถ้าสร้างไม่ได้จะใช้ cache ในหน่วยความจำอย่างเดียว)"""
+    try:
+        if CACHE_BACKEND == "redis":
+            return RedisBackend()
+        if CACHE_BACKEND == "sqlite":
+            return SQLiteBackend()
+    except Exception as e:
+        logger.error(f"ไม่สามารถใช้ cache แบบ {CACHE_BACKEND} ได้ ใช้ cache ในหน่วยความจำแทน: {str(e)}")
+        return None
+    if CACHE_BACKEND != "memory":
+        logger.warning(f"ไม่รู้จัก CACHE_BACKEND={CACHE_BACKEND} ใช้ cache ในหน่วยความจำแทน")
+    return None
+
+# instance กลางที่ใช้ร่วมกันทั้งแอปพลิเคชัน
+app_cache = Cache(_create_backend())
@@ -0,0 +1,224 @@
+import os
+import time
+import queue
+import logging
+import threading
+from datetime import datetime
+from dotenv import load_dotenv
+from sqlalchemy import select, and_, or_
+from database import db_manager, ChatHistory, encode_page_cursor, decode_page_cursor
+from metrics import metrics
+
+# ตั้งค่าการบันทึกล็อก
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# โหลดค่าจากไฟล์ .env
+load_dotenv()
+
+# เปิด/ปิดการบันทึกประวัติการสนทนาลงฐานข้อมูล
+CHAT_HISTORY_ENABLED = os.getenv("CHAT_HISTORY_ENABLED", "true").lower() == "true"
+# จำนวนรายการสูงสุดที่รอเขียนในหน่วยความจำ (เกินแล้วจะทิ้งรายการใหม่)
+CHAT_HISTORY_QUEUE_SIZE = int(os.getenv("CHAT_HISTORY_QUEUE_SIZE", "10000"))
+# จำนวนรายการต่อการเขียนหนึ่งครั้ง และเวลารอรวบรวมรายการก่อนเขียน (วินาที)
+CHAT_HISTORY_BATCH_SIZE = int(os.getenv("CHAT_HISTORY_BATCH_SIZE", "200"))
+CHAT_HISTORY_FLUSH_INTERVAL = float(os.getenv("CHAT_HISTORY_FLUSH_INTERVAL", "0.5"))
+# ชื่อ collection สำหรับ MongoDB
+CHAT_HISTORY_COLLECTION = os.getenv("CHAT_HISTORY_COLLECTION", "chat_history")
+
+def _decode_history_cursor(cursor):
+    """แปลง cursor กลับเป็น (timestamp, id) ของรายการสุดท้ายในหน้าก่อนหน้า"""
+    after = decode_page_cursor(cursor).get('k')
+    if not isinstance(after, list) or len(after) != 2 or not isinstance(after[0], str):
+        raise ValueError("cursor ไม่ถูกต้อง")
+    try:
+        return datetime.fromisoformat(after[0]), after[1]
+    except ValueError:
+        raise ValueError("cursor ไม่ถูกต้อง")
+
+class ChatHistoryWriter:
+    """
+    บันทึกประวัติการสนทนาลงตาราง chat_history แบบ write-behind
+
+    คำขอเพียงใส่รายการลงคิว (ไม่รอฐานข้อมูล) แล้ว thread เบื้องหลังจะรวบรวมเป็นชุด
+    และเขียนครั้งเดียวด้วย executemany (SQL) หรือ insert_many (MongoDB)
+    คิวมีขนาดจำกัด ถ้าเต็มจะทิ้งรายการใหม่แทนการบล็อกคำขอ
+    """
+
+    def __init__(self, max_queue_size=CHAT_HISTORY_QUEUE_SIZE, batch_size=CHAT_HISTORY_BATCH_SIZE,
+                 flush_interval=CHAT_HISTORY_FLUSH_INTERVAL):
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._stopping = threading.Event()
+        self._thread = None
+        self._prepared = set()
+
+    def start(self):
+        """เริ่ม thread สำหรับเขียนข้อมูล"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="chat-history-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10):
+        """หยุด thread หลังจากเขียนรายการที่ค้างอยู่ในคิวทั้งหมด"""
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                logger.warning(f"เขียนประวัติการสนทนาไม่ทันก่อนปิดแอปพลิเคชัน ค้างอยู่ {self._queue.qsize()} รายการ")
+            self._thread = None
+
+    def record(self, user_id, user_message, bot_response):
+        """ใส่รายการลงคิวเพื่อเขียนในเบื้องหลัง (ไม่บล็อก)"""
+        if not CHAT_HISTORY_ENABLED:
+            return False
+        try:
+            self._queue.put_nowait({
+                'user_id': user_id,
+                'user_message': user_message,
+                'bot_response': bot_response,
+                'timestamp': datetime.now()
+            })
+            metrics.increment("chat_history.enqueued")
+            return True
+        except queue.Full:
+            metrics.increment("chat_history.dropped")
+            logger.warning("คิวประวัติการสนทนาเต็ม ทิ้งรายการใหม่")
+            return False
+
+    def pending(self):
+        """จำนวนรายการที่รอเขียน"""
+        return self._queue.qsize()
+
+    def _next_batch(self):
+        """รอรายการแรก แล้วรวบรวมรายการต่อไปจนครบชุดหรือหมดเวลา"""
+        try:
+            first = self._queue.get(timeout=self.flush_interval)
+        except queue.Empty:
+            return []
+        batch = [first]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                # ตอนกำลังปิดหรือหมดเวลาแล้ว เอาเฉพาะรายการที่ค้างอยู่ในคิว
+                if remaining <= 0 or self._stopping.is_set():
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch:
+                self._write_batch(batch)
+            elif self._stopping.is_set():
+                break
+
+    def _write_batch(self, batch):
+        started = time.perf_counter()
+        try:
+            if db_manager.db_type.lower() == 'mongodb':
+                self._write_mongodb(batch)
+            else:
+                self._write_sql(batch)
+            metrics.increment("chat_history.written", len(batch))
+            metrics.observe("chat_history.batch_write", (time.perf_counter() - started) * 1000)
+        except Exception as e:
+            metrics.increment("chat_history.failed", len(batch))
+            logger.error(f"เกิดข้อผิดพลาดในการบันทึกประวัติการสนทนา {len(batch)} รายการ: {str(e)}")
+
+    def _write_sql(self, batch):
+        engine = db_manager.engine
+        if engine is None:
+            raise ValueError("ยังไม่ได้เชื่อมต่อกับฐานข้อมูล SQL")
+        if id(engine) not in self._prepared:
+            # สร้างตาราง chat_history ถ้ายังไม่มี (ครั้งเดียวต่อการเชื่อมต่อ)
+            ChatHistory.metadata.create_all(engine, tables=[ChatHistory.__table__])
+            self._prepared.add(id(engine))
+        with engine.begin() as connection:
+            # ส่ง list ของ dict ทำให้ SQLAlchemy ใช้ executemany
+            connection.execute(ChatHistory.__table__.insert(), batch)
+
+    def _write_mongodb(self, batch):
+        if db_manager.mongo_db is None:
+            raise ValueError("ยังไม่ได้เชื่อมต่อกับฐานข้อมูล MongoDB")
+        collection = db_manager.mongo_db[CHAT_HISTORY_COLLECTION]
+        if id(db_manager.mongo_db) not in self._prepared:
+            collection.create_index([('user_id', 1), ('timestamp', -1), ('_id', -1)])
+            self._prepared.add(id(db_manager.mongo_db))
+        # ใช้สำเนาเพื่อไม่ให้ insert_many เพิ่ม _id ลงใน dict เดิม
+        collection.insert_many([dict(item) for item in batch], ordered=False)
+
+def get_chat_history(user_id, limit=50, cursor=None):
+    """
+    อ่านประวัติการสนทนาของผู้ใช้ เรียงจากล่าสุดก่อน แบบ keyset pagination ด้วย (timestamp, id)
+
+    Args:
+        user_id (str): รหัสผู้ใช้
+        limit (int): จำนวนรายการต่อหน้า
+        cursor (str, optional): cursor จากหน้าก่อนหน้า
+
+    Returns:
+        dict: items และ next_cursor (None ถ้าไม่มีหน้าถัดไป)
+    """
+    after = _decode_history_cursor(cursor) if cursor else None
+    if db_manager.db_type.lower() == 'mongodb':
+        rows = _read_mongodb(user_id, limit + 1, after)
+    else:
+        rows = _read_sql(user_id, limit + 1, after)
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_page_cursor({'k': [rows[-1]['timestamp'], rows[-1]['id']]})
+    return {'items': rows, 'next_cursor': next_cursor}
+
+def _read_sql(user_id, limit, after):
+    if db_manager.engine is None:
+        raise ValueError("ยังไม่ได้เชื่อมต่อกับฐานข้อมูล SQL")
+    table = ChatHistory.__table__
+    query = select(table).where(table.c.user_id == user_id)
+    if after:
+        timestamp, row_id = after
+        if not isinstance(row_id, int) or isinstance(row_id, bool):
+            raise ValueError("cursor ไม่ถูกต้อง")
+        query = query.where(or_(
+            table.c.timestamp < timestamp,
+            and_(table.c.timestamp == timestamp, table.c.id < row_id)
+        ))
+    query = query.order_by(table.c.timestamp.desc(), table.c.id.desc()).limit(limit)
+    with db_manager.engine.connect() as connection:
+        return [dict(row._mapping) for row in connection.execute(query)]
+
+def _read_mongodb(user_id, limit, after):
+    from bson import ObjectId
+
+    if db_manager.mongo_db is None:
+        raise ValueError("ยังไม่ได้เชื่อมต่อกับฐานข้อมูล MongoDB")
+    filter_query = {'user_id': user_id}
+    if after:
+        timestamp, row_id = after
+        # cursor ที่ถูกแก้ไขอาจมี id ที่ไม่ใช่ ObjectId ให้ถือเป็น cursor ไม่ถูกต้อง (400) ไม่ใช่ 500
+        if not isinstance(row_id, str) or not ObjectId.is_valid(row_id):
+            raise ValueError("cursor ไม่ถูกต้อง")
+        filter_query['$or'] = [
+            {'timestamp': {'$lt': timestamp}},
+            {'timestamp': timestamp, '_id': {'$lt': ObjectId(row_id)}}
+        ]
+    cursor = db_manager.mongo_db[CHAT_HISTORY_COLLECTION].find(filter_query) \
+        .sort([('timestamp', -1), ('_id', -1)]).limit(limit)
+    rows = []
+    for document in cursor:
+        document['id'] = str(document.pop('_id'))
+        rows.append(document)
+    return rows
+
+# instance กลางที่ใช้ร่วมกันทั้งแอปพลิเคชัน
+chat_history_writer = ChatHistoryWriter()
@@ -0,0 +1,192 @@
+import os
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from metrics import metrics
+
+# ตั้งค่าการบันทึกล็อก
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# โหลดค่าจากไฟล์ .env
+load_dotenv()
+
+# จำนวน token สูงสุดของประวัติการสนทนาล่าสุดที่ส่งให้ AI แบบเต็มข้อความ
+CHAT_HISTORY_TOKEN_BUDGET = int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", "2000"))
+# ความยาวสูงสุดของบทสรุปการสนทนาก่อนหน้า (token)
+CHAT_SUMMARY_MAX_TOKENS = int(os.getenv("CHAT_SUMMARY_MAX_TOKENS", "400"))
+# อายุของ session ที่ไม่มีการใช้งาน (วินาที) และจำนวน session สูงสุดในหน่วยความจำ
+CHAT_SESSION_TTL = int(os.getenv("CHAT_SESSION_TTL", "3600"))
+CHAT_MAX_SESSIONS = int(os.getenv("CHAT_MAX_SESSIONS", "10000"))
+
+def estimate_tokens(text):
+    """
+    ประมาณจำนวน token แบบไม่ต้องใช้ tokenizer
+
+    ตัวอักษรภาษาอังกฤษประมาณ 4 ตัวต่อ token ส่วนภาษาไทยและอักษรอื่นประมาณ 2 ตัวต่อ token
+    """
+    if not text:
+        return 0
+    ascii_chars = sum(1 for char in text if ord(char) < 128)
+    return ascii_chars // 4 + (len(text) - ascii_chars) // 2 + 4
+
+def _message_tokens(message):
+    return estimate_tokens(message.get('content', ''))
+
+class ChatSession:
+    """สถานะของการสนทนาหนึ่ง session: บทสรุปของข้อความเก่า และข้อความล่าสุดที่ยังไม่ได้สรุป"""
+
+    def __init__(self, session_id, messages=None):
+        self.id = session_id
+        self.summary = ""
+        self.messages = list(messages or [])
+        self.last_access = time.time()
+        self.compacting = False
+        self.lock = threading.Lock()
+
+class ChatSessionStore:
+    """
+    เก็บ session การสนทนาไว้ฝั่ง server
+
+    ประวัติที่ส่งให้ AI ในแต่ละรอบ = บทสรุปของข้อความเก่า + ข้อความล่าสุดที่อยู่ใน token budget
+    ข้อความที่หลุดออกจาก budget จะถูกสรุปต่อจากบทสรุปเดิมใน thread เบื้องหลัง
+    ทำให้ขนาด prompt ต่อรอบคงที่ไม่ว่าการสนทนาจะยาวแค่ไหน
+
+    session อยู่ในหน่วยความจำของแต่ละ process (ไม่ได้แชร์ข้าม worker)
+    เมื่อรันหลาย worker ต้องให้ load balancer ส่งคำขอของ session เดียวกันไปที่ worker เดิม
+    มิฉะนั้น worker อื่นจะสร้าง session ใหม่จาก conversation_history ที่ client ส่งมา
+    """
+
+    def __init__(self, history_budget=CHAT_HISTORY_TOKEN_BUDGET, ttl=CHAT_SESSION_TTL, max_sessions=CHAT_MAX_SESSIONS):
+        self.history_budget = history_budget
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="chat-summary")
+
+    def get_or_create(self, session_id=None, seed_history=None):
+        """ดึง session ตาม id หรือสร้างใหม่ (ใช้ประวัติที่ client ส่งมาเป็นข้อมูลเริ่มต้น)"""
+        with self._lock:
+            self._evict_expired()
+            session = self._sessions.get(session_id) if session_id else None
+            if session is None:
+                session = ChatSession(session_id or uuid.uuid4().hex, seed_history)
+                self._sessions[session.id] = session
+                metrics.increment("chat_session.created")
+            session.last_access = time.time()
+            return session
+
+    def _evict_expired(self):
+        now = time.time()
+        expired = [key for key, session in self._sessions.items() if now - session.last_access > self.ttl]
+        for key in expired:
+            del self._sessions[key]
+        # ถ้ายังเกินจำนวนสูงสุด ให้ลบ session ที่ไม่ได้ใช้นานที่สุด
+        overflow = len(self._sessions) - self.max_sessions
+        if overflow > 0:
+            for key in sorted(self._sessions, key=lambda k: self._sessions[k].last_access)[:overflow]:
+                del self._sessions[key]
+
+    def _split_recent(self, messages):
+        """แบ่งข้อความเป็น (ข้อความเก่าที่เกิน budget, ข้อความล่าสุดที่อยู่ใน budget)"""
+        used = 0
+        index = len(messages)
+        while index > 0:
+            tokens = _message_tokens(messages[index - 1])
+            if used + tokens > self.history_budget and index < len(messages):
+                break
+            used += tokens
+            index -= 1
+        return messages[:index], messages[index:]
+
+    def build_context(self, session):
+        """
+        คืนค่า (summary, recent_messages) สำหรับส่งให้ AI
+
+        ข้อความเก่าที่เกิน budget แต่ยังสรุปไม่เสร็จจะถูกส่งไปด้วยแบบเต็มข้อความ
+        (ข้อความจะถูกตัดออกจาก session ก็ต่อเมื่อรวมเข้าไปในบทสรุปแล้ว) จึงไม่มีข้อความใดหายไป
+        """
+        with session.lock:
+            messages = list(session.messages)
+            summary = session.summary
+        metrics.observe("chat_session.context_tokens", estimate_tokens(summary) + sum(_message_tokens(m) for m in messages))
+        return summary, messages
+
+    def compact_now(self, session, summarize):
+        """
+        สรุปข้อความเก่าที่เกิน budget ทันทีใน thread ปัจจุบัน
+
+        ใช้ก่อนส่งคำถาม เช่น session ที่เพิ่งสร้างจาก conversation_history ยาวๆ
+        เพื่อไม่ให้ prompt รอบแรกเกิน budget ถ้ากำลังสรุปอยู่ในเบื้องหลังจะไม่ทำซ้ำ
+        """
+        with session.lock:
+            older, _ = self._split_recent(session.messages)
+            if not older or session.compacting:
+                return False
+            session.compacting = True
+        self._compact(session, summarize)
+        return True
+
+    def append_turn(self, session, user_message, assistant_message):
+        """บันทึกข้อความของผู้ใช้และคำตอบของ AI ลงใน session"""
+        with session.lock:
+            session.messages.append({"role": "user", "content": user_message})
+            session.messages.append({"role": "assistant", "content": assistant_message})
+            session.last_access = time.time()
+
+    def schedule_compaction(self, session, summarize):
+        """สรุปข้อความเก่าที่เกิน budget ต่อจากบทสรุปเดิมใน thread เบื้องหลัง"""
+        with session.lock:
+            older, _ = self._split_recent(session.messages)
+            if not older or session.compacting:
+                return False
+            session.compacting = True
+        self._executor.submit(self._compact, session, summarize)
+        return True
+
+    def _compact(self, session, summarize):
+        try:
+            with session.lock:
+                older, _ = self._split_recent(session.messages)
+                previous_summary = session.summary
+            if not older:
+                return
+            started = time.perf_counter()
+            new_summary = summarize(previous_summary, older)
+            metrics.observe("chat_session.summarize", (time.perf_counter() - started) * 1000)
+            with session.lock:
+                # ตัดข้อความที่สรุปแล้วออก (ข้อความใหม่ที่เพิ่มเข้ามาระหว่างสรุปยังอยู่ครบ)
+                if session.messages[:len(older)] == older:
+                    session.messages = session.messages[len(older):]
+                    session.summary = new_summary
+                    metrics.increment("chat_session.compactions")
+        except Exception as e:
+            logger.error(f"เกิดข้อผิดพลาดในการสรุปประวัติการสนทนา: {str(e)}")
+        finally:
+            session.compacting = False
+
+    def get_session_info(self, session_id):
+        """ข้อมูลของ session สำหรับตรวจสอบ"""
+        with self._lock:
+            session = self._sessions.get(session_id)
+        if session is None:
+            return None
+        with session.lock:
+            return {
+                'session_id': session.id,
+                'summary': session.summary,
+                'messages': len(session.messages),
+                'summary_tokens': estimate_tokens(session.summary)
+            }
+
+    def delete(self, session_id):
+        """ลบ session"""
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+# instance กลางที่ใช้ร่วมกันทั้งแอปพลิเคชัน
+chat_sessions = ChatSessionStore()
@@ -1,16 +1,23 @@
 import os
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, MetaData, Table, inspect, text
+from sqlalchemy import create_engine, event, select, Column, Integer, String, Text, DateTime, MetaData, Table, Index, inspect, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from dotenv import load_dotenv
 import pandas as pd
-from datetime import datetime
+from datetime import datetime, date
+import re
 import json
+import base64
 import decimal
 import logging
+import importlib.util
 import pymongo
 from pymongo import MongoClient
 import urllib.parse
+import time
+from concurrent.futures import ThreadPoolExecutor
+from cache import app_cache
+from metrics import metrics
 
 # ตั้งค่าการบันทึกล็อก
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -28,6 +35,81 @@ DB_PASSWORD = os.getenv("DB_PASSWORD")
 DB_NAME = os.getenv("DB_NAME")
 MONGODB_URI = os.getenv("MONGODB_URI")
 
+# การวิเคราะห์โครงสร้าง MongoDB: จำนวนเอกสารตัวอย่างต่อ collection, อายุของ cache (วินาที),
+# จำนวน collection ที่วิเคราะห์พร้อมกัน และความลึกสูงสุดของฟิลด์ซ้อน
+MONGODB_SCHEMA_SAMPLE_SIZE = int(os.getenv("MONGODB_SCHEMA_SAMPLE_SIZE", "100"))
+MONGODB_SCHEMA_CACHE_TTL = int(os.getenv("MONGODB_SCHEMA_CACHE_TTL", "300"))
+MONGODB_SCHEMA_WORKERS = int(os.getenv("MONGODB_SCHEMA_WORKERS", "8"))
+MONGODB_SCHEMA_MAX_DEPTH = int(os.getenv("MONGODB_SCHEMA_MAX_DEPTH", "5"))
+# อายุของ cache โครงสร้างฐานข้อมูล SQL (วินาที, 0 = อ่านใหม่ทุกครั้ง)
+SQL_SCHEMA_CACHE_TTL = int(os.getenv("SQL_SCHEMA_CACHE_TTL", "300"))
+
+# จำนวนเอกสารต่อ batch ที่ดึงจาก MongoDB, อนุญาตให้ aggregate ใช้ดิสก์ และจำนวนแถวต่อ chunk ของโหมด streaming
+MONGODB_BATCH_SIZE = int(os.getenv("MONGODB_BATCH_SIZE", "1000"))
+MONGODB_ALLOW_DISK_USE = os.getenv("MONGODB_ALLOW_DISK_USE", "true").lower() == "true"
+QUERY_STREAM_CHUNK_SIZE = int(os.getenv("QUERY_STREAM_CHUNK_SIZE", "500"))
+# จำนวนรายการต่อหน้าเริ่มต้นและสูงสุดของการแบ่งหน้าข้อมูลใน data_source
+DATA_PAGE_SIZE = int(os.getenv("DATA_PAGE_SIZE", "100"))
+DATA_PAGE_MAX_SIZE = int(os.getenv("DATA_PAGE_MAX_SIZE", "1000"))
+# จำนวนแถวต่อ chunk เมื่ออ่าน data_source เป็น DataFrame
+DATAFRAME_CHUNK_SIZE = int(os.getenv("DATAFRAME_CHUNK_SIZE", "10000"))
+# dtype backend ของ DataFrame: pyarrow (ใช้หน่วยความจำน้อยกว่าสำหรับข้อความ ต้องติดตั้ง pyarrow) หรือ numpy_nullable
+DATAFRAME_DTYPE_BACKEND = os.getenv("DATAFRAME_DTYPE_BACKEND", "pyarrow")
+if DATAFRAME_DTYPE_BACKEND == "pyarrow" and importlib.util.find_spec("pyarrow") is None:
+    logger.warning("ไม่พบแพ็กเกจ pyarrow จะใช้ dtype backend แบบ numpy_nullable แทน (ติดตั้งจาก requirements.txt)")
+    DATAFRAME_DTYPE_BACKEND = "numpy_nullable"
+
+# สร้าง JSONEncoder ที่สามารถจัดการกับ Decimal และวันที่ได้ (ใช้ร่วมกันทั้ง API และ OpenAI service)
+class CustomJSONEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, decimal.Decimal):
+            return float(obj)
+        elif isinstance(obj, (datetime, date)):
+            return obj.isoformat()
+        return super(CustomJSONEncoder, self).default(obj)
+
+# การแปลงชนิดข้อมูลของผลลัพธ์คำสั่ง SQL ที่ระดับ driver: DECIMAL/NUMERIC เป็น float และวันที่/เวลาเป็นข้อความ ISO 8601
+# แถวที่ได้จาก driver จึงแปลงเป็น JSON ได้ทันทีโดยไม่ต้องวนตรวจและแปลงทีละค่าใน Python
+# (pymysql ไม่เรียกฟังก์ชันเหล่านี้กับค่า NULL ส่วน psycopg2 ส่ง None และ cursor มาด้วย)
+def _decimal_to_float(value, cursor=None):
+    return None if value is None else float(value)
+
+def _datetime_to_iso(value, cursor=None):
+    # '2024-01-31 10:00:00' -> '2024-01-31T10:00:00' รูปแบบเดียวกับ datetime.isoformat()
+    return None if value is None else value.replace(' ', 'T', 1)
+
+def _keep_text(value, cursor=None):
+    return value
+
+def mysql_result_conversions():
+    """ตาราง conv ของ pymysql ที่คืนค่า DECIMAL เป็น float และวันที่/เวลาเป็นข้อความ"""
+    from pymysql.constants import FIELD_TYPE
+    from pymysql.converters import conversions
+    
+    conv = dict(conversions)
+    conv[FIELD_TYPE.DECIMAL] = _decimal_to_float
+    conv[FIELD_TYPE.NEWDECIMAL] = _decimal_to_float
+    conv[FIELD_TYPE.DATETIME] = _datetime_to_iso
+    conv[FIELD_TYPE.TIMESTAMP] = _datetime_to_iso
+    # DATE อยู่ในรูปแบบ ISO อยู่แล้ว ส่วน TIME ถ้าแปลงเป็น timedelta จะแปลงเป็น JSON ไม่ได้
+    conv[FIELD_TYPE.DATE] = _keep_text
+    conv[FIELD_TYPE.TIME] = _keep_text
+    return conv
+
+# (OID, ชื่อ, ฟังก์ชันแปลง) ของชนิดข้อมูล PostgreSQL ที่แปลงที่ระดับ driver
+POSTGRESQL_RESULT_TYPES = (
+    ((1700,), 'NUMERIC_AS_FLOAT', _decimal_to_float),
+    ((1114, 1184), 'TIMESTAMP_AS_ISO', _datetime_to_iso),
+    ((1082, 1083, 1266, 1186), 'TEMPORAL_AS_TEXT', _keep_text),
+)
+
+def _register_postgresql_result_types(dbapi_connection, connection_record):
+    """ลงทะเบียน typecaster ของ psycopg2 เฉพาะการเชื่อมต่อของ engine สำหรับคำสั่ง SQL"""
+    from psycopg2 import extensions
+    
+    for oids, name, caster in POSTGRESQL_RESULT_TYPES:
+        extensions.register_type(extensions.new_type(oids, name, caster), dbapi_connection)
+
 # สร้าง Base class สำหรับ SQLAlchemy
 Base = declarative_base()
 
@@ -41,6 +123,11 @@ class ChatHistory(Base):
     bot_response = Column(Text)
     timestamp = Column(DateTime, default=datetime.now)
 
+    # index สำหรับอ่านประวัติของผู้ใช้แบบ keyset pagination (ล่าสุดก่อน)
+    __table_args__ = (
+        Index('ix_chat_history_user_timestamp', 'user_id', 'timestamp', 'id'),
+    )
+
 class DataSource(Base):
     __tablename__ = "data_source"
 
@@ -51,6 +138,9 @@ class DataSource(Base):
     created_at = Column(DateTime, default=datetime.now)
     updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
 
+    # สำหรับการแบ่งหน้าแบบ keyset ตาม updated_at (ตารางที่สร้างไว้แล้วต้องสร้าง index นี้เอง)
+    __table_args__ = (Index('ix_data_source_updated_at_id', 'updated_at', 'id'),)
+
 # คลาสสำหรับจัดการการเชื่อมต่อฐานข้อมูล
 class DatabaseManager:
     _instance = None
@@ -64,6 +154,7 @@ class DatabaseManager:
     def initialize(self):
         self.db_type = DB_TYPE
         self.engine = None
+        self.query_engine = None
         self.session_local = None
         self.mongo_client = None
         self.mongo_db = None
@@ -101,12 +192,17 @@ class DatabaseManager:
         connection_string = f"mysql+pymysql://{self.connection_params['user']}:{self.connection_params['password']}@{self.connection_params['host']}:{self.connection_params['port']}/{self.connection_params['database']}"
         self.engine = create_engine(connection_string)
         self.session_local = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+        # engine แยกสำหรับคำสั่ง SQL ที่ผู้ใช้/AI สร้าง เพื่อให้ model ของ SQLAlchemy ยังได้ datetime ตามปกติ
+        self.query_engine = create_engine(connection_string, connect_args={'conv': mysql_result_conversions()})
     
     def _connect_postgresql(self):
         """เชื่อมต่อกับฐานข้อมูล PostgreSQL"""
         connection_string = f"postgresql+psycopg2://{self.connection_params['user']}:{self.connection_params['password']}@{self.connection_params['host']}:{self.connection_params['port']}/{self.connection_params['database']}"
         self.engine = create_engine(connection_string)
         self.session_local = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+        # engine แยกสำหรับคำสั่ง SQL ที่ผู้ใช้/AI สร้าง เพื่อให้ model ของ SQLAlchemy ยังได้ datetime ตามปกติ
+        self.query_engine = create_engine(connection_string)
+        event.listen(self.query_engine, 'connect', _register_postgresql_result_types)
     
     def _connect_mongodb(self):
         """เชื่อมต่อกับฐานข้อมูล MongoDB"""
@@ -135,6 +231,7 @@ class DatabaseManager:
         
         # ปิดการเชื่อมต่อเดิม
         self.close_connection()
+        invalidate_schema_cache()
         
         # เชื่อมต่อใหม่
         return self.connect()
@@ -150,6 +247,7 @@ class DatabaseManager:
             # สำหรับ SQLAlchemy ไม่จำเป็นต้องปิด engine โดยตรง
             # แต่เราจะตั้งค่าเป็น None เพื่อให้สามารถสร้างใหม่ได้
             self.engine = None
+            self.query_engine = None
             self.session_local = None
             
             logger.info("ปิดการเชื่อมต่อฐานข้อมูลเรียบร้อย")
@@ -289,97 +387,407 @@ def _get_data_from_mongodb(category=None):
         logger.error(f"เกิดข้อผิดพลาดในการดึงข้อมูลจาก MongoDB: {str(e)}")
         return []
 
+def encode_page_cursor(state):
+    """แปลงสถานะการแบ่งหน้าเป็น cursor แบบ opaque (base64url ของ JSON)"""
+    raw = json.dumps(state, cls=CustomJSONEncoder, ensure_ascii=False, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_page_cursor(cursor):
+    """
+    แปลง cursor กลับเป็นสถานะการแบ่งหน้า
+    
+    Raises:
+        ValueError: ถ้า cursor ไม่ถูกต้อง
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        state = json.loads(raw.decode('utf-8'))
+    except Exception:
+        raise ValueError("cursor ไม่ถูกต้อง")
+    if not isinstance(state, dict):
+        raise ValueError("cursor ไม่ถูกต้อง")
+    return state
+
+# ลำดับที่ใช้แบ่งหน้าได้ (คอลัมน์ที่เรียงต่อกันเป็น key ที่ไม่ซ้ำ)
+DATA_PAGE_ORDERS = ('id', 'updated_at')
+
+def get_data_page(category=None, cursor=None, limit=None, order_by='id'):
+    """
+    ดึงข้อมูลจาก data_source ทีละหน้าแบบ keyset (ใช้ค่า key ของรายการสุดท้ายแทน OFFSET)
+    
+    เวลาและหน่วยความจำต่อหน้าคงที่ไม่ว่าจะอยู่หน้าไหน และไม่ข้ามหรือซ้ำรายการเมื่อมีข้อมูลเพิ่มระหว่างเลื่อนหน้า
+    
+    Args:
+        category (str, optional): หมวดหมู่ที่ต้องการ
+        cursor (str, optional): cursor จากหน้าก่อนหน้า (ไม่ระบุ = หน้าแรก)
+        limit (int, optional): จำนวนรายการต่อหน้า
+        order_by (str): 'id' หรือ 'updated_at' (เรียงจากน้อยไปมาก ไม่รวมรายการที่ไม่มี updated_at)
+    
+    Returns:
+        tuple: (รายการในหน้านี้, cursor ของหน้าถัดไป หรือ None ถ้าเป็นหน้าสุดท้าย)
+    
+    Raises:
+        ValueError: ถ้า cursor หรือ order_by ไม่ถูกต้อง
+    """
+    limit = min(max(1, limit or DATA_PAGE_SIZE), DATA_PAGE_MAX_SIZE)
+    after = None
+    if cursor:
+        state = decode_page_cursor(cursor)
+        # cursor ใช้ได้กับเงื่อนไขเดียวกับที่สร้างขึ้นเท่านั้น
+        order_by, category = state.get('o'), state.get('c')
+        after = state.get('k')
+        if not isinstance(after, list) or len(after) != (2 if order_by == 'updated_at' else 1):
+            raise ValueError("cursor ไม่ถูกต้อง")
+    if order_by not in DATA_PAGE_ORDERS:
+        raise ValueError(f"order_by ต้องเป็นหนึ่งใน {', '.join(DATA_PAGE_ORDERS)}")
+    
+    db_type = db_manager.db_type.lower()
+    if db_type in ['mysql', 'postgresql']:
+        items = _get_sql_data_page(category, after, limit, order_by)
+    elif db_type == 'mongodb':
+        items = _get_mongodb_data_page(category, after, limit, order_by)
+    else:
+        raise ValueError(f"ไม่รองรับฐานข้อมูลประเภท {db_manager.db_type}")
+    
+    next_cursor = None
+    if len(items) == limit:
+        last = items[-1]
+        key = [last['id']] if order_by == 'id' else [last.get('updated_at'), last['id']]
+        next_cursor = encode_page_cursor({'o': order_by, 'c': category, 'k': key})
+    return items, next_cursor
+
+def _get_sql_data_page(category, after, limit, order_by):
+    from sqlalchemy import tuple_
+    
+    db = db_manager.get_session()
+    try:
+        query = db.query(DataSource)
+        if category:
+            query = query.filter(DataSource.category == category)
+        if order_by == 'id':
+            if after:
+                query = query.filter(DataSource.id > int(after[0]))
+            query = query.order_by(DataSource.id)
+        else:
+            query = query.filter(DataSource.updated_at.isnot(None))
+            if after:
+                updated_at = datetime.fromisoformat(after[0])
+                query = query.filter(tuple_(DataSource.updated_at, DataSource.id) > (updated_at, int(after[1])))
+            query = query.order_by(DataSource.updated_at, DataSource.id)
+        return [
+            {
+                'id': item.id,
+                'title': item.title,
+                'content': item.content,
+                'category': item.category,
+                'created_at': item.created_at,
+                'updated_at': item.updated_at
+            } for item in query.limit(limit)
+        ]
+    finally:
+        db.close()
+
+def _get_mongodb_data_page(category, after, limit, order_by):
+    from bson import ObjectId
+    from bson.errors import InvalidId
+    
+    def document_id(value):
+        # _id ที่สร้างโดย MongoDB เป็น ObjectId ส่วน _id ที่กำหนดเองใช้ค่าเดิม
+        try:
+            return ObjectId(value)
+        except (InvalidId, TypeError):
+            return value
+    
+    collection = db_manager.mongo_db['data_source']
+    query = {}
+    if category:
+        query['category'] = category
+    if order_by == 'id':
+        if after:
+            query['_id'] = {'$gt': document_id(after[0])}
+        sort = [('_id', pymongo.ASCENDING)]
+    else:
+        if after:
+            updated_at = datetime.fromisoformat(after[0])
+            query['$or'] = [
+                {'updated_at': {'$gt': updated_at}},
+                {'updated_at': updated_at, '_id': {'$gt': document_id(after[1])}}
+            ]
+        else:
+            query['updated_at'] = {'$ne': None}
+        sort = [('updated_at', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)]
+    
+    items = list(collection.find(query).sort(sort).limit(limit))
+    for item in items:
+        item['id'] = str(item.pop('_id'))
+    return items
+
 # ฟังก์ชันสำหรับดึงข้อมูลในรูปแบบ DataFrame
-def get_data_as_dataframe(category=None):
-    """ดึงข้อมูลในรูปแบบ DataFrame"""
-    data = get_data_from_database(category)
-    df = pd.DataFrame(data)
-    return df
+# คอลัมน์ของ data_source ที่อ่านเป็น DataFrame ได้
+DATA_SOURCE_COLUMNS = ('id', 'title', 'content', 'category', 'created_at', 'updated_at')
 
-# ฟังก์ชันสำหรับดึงโครงสร้างฐานข้อมูล
-def get_database_schema():
-    """ดึงโครงสร้างฐานข้อมูล"""
+def iter_data_frames(category=None, columns=None, chunk_size=None):
+    """
+    อ่าน data_source เป็น DataFrame ทีละ chunk โดยตรงจาก cursor (ไม่สร้าง object ของ ORM หรือ dict ต่อแถว)
+    
+    Args:
+        category (str, optional): หมวดหมู่ที่ต้องการ
+        columns (iterable, optional): คอลัมน์ที่ต้องการอ่าน (ค่าเริ่มต้นคือทุกคอลัมน์ใน DATA_SOURCE_COLUMNS)
+        chunk_size (int, optional): จำนวนแถวต่อ chunk
+    
+    Yields:
+        DataFrame: แถวหนึ่ง chunk ที่ใช้ dtype ตาม DATAFRAME_DTYPE_BACKEND และคอลัมน์ category เป็น dtype category
+    
+    Raises:
+        ValueError: ถ้าระบุคอลัมน์ที่ไม่มีอยู่ หรือไม่รองรับฐานข้อมูลประเภทนี้
+    """
+    columns = list(columns or DATA_SOURCE_COLUMNS)
+    unknown = set(columns) - set(DATA_SOURCE_COLUMNS)
+    if unknown:
+        raise ValueError(f"ไม่มีคอลัมน์ {', '.join(sorted(unknown))} ใน data_source")
+    chunk_size = chunk_size or DATAFRAME_CHUNK_SIZE
+    
     if db_manager.db_type.lower() in ['mysql', 'postgresql']:
-        return _get_sql_schema()
+        frames = _iter_sql_data_frames(category, columns, chunk_size)
     elif db_manager.db_type.lower() == 'mongodb':
-        return _get_mongodb_schema()
+        frames = _iter_mongodb_data_frames(category, columns, chunk_size)
+    else:
+        raise ValueError(f"ไม่รองรับฐานข้อมูลประเภท {db_manager.db_type}")
+    
+    for frame in frames:
+        if 'category' in frame:
+            # หมวดหมู่มีค่าซ้ำกันมาก เก็บเป็นรหัสตัวเลขแทนข้อความทุกแถว
+            frame['category'] = frame['category'].astype('category')
+        yield frame
+
+def _iter_sql_data_frames(category, columns, chunk_size):
+    """อ่าน data_source ด้วย pd.read_sql ผ่าน server-side cursor ทีละ chunk"""
+    if not db_manager.engine:
+        raise ValueError("ยังไม่ได้เชื่อมต่อกับฐานข้อมูล SQL")
+    table = DataSource.__table__
+    statement = select(*[table.c[column] for column in columns])
+    if category:
+        statement = statement.where(table.c.category == category)
+    
+    with db_manager.engine.connect() as connection:
+        connection = connection.execution_options(stream_results=True, max_row_buffer=chunk_size)
+        yield from pd.read_sql(statement, connection, chunksize=chunk_size, dtype_backend=DATAFRAME_DTYPE_BACKEND)
+
+def _iter_mongodb_data_frames(category, columns, chunk_size):
+    """อ่าน collection data_source เฉพาะฟิลด์ที่ต้องการทีละ batch"""
+    projection = {column: 1 for column in columns if column != 'id'}
+    projection['_id'] = 1 if 'id' in columns else 0
+    query = {'category': category} if category else {}
+    cursor = db_manager.mongo_db['data_source'].find(query, projection).batch_size(min(chunk_size, MONGODB_BATCH_SIZE))
+    
+    batch = []
+    for document in cursor:
+        if '_id' in document:
+            document['id'] = str(document.pop('_id'))
+        batch.append(document)
+        if len(batch) >= chunk_size:
+            yield _documents_to_frame(batch, columns)
+            batch = []
+    if batch:
+        yield _documents_to_frame(batch, columns)
+
+def _documents_to_frame(documents, columns):
+    return pd.DataFrame.from_records(documents, columns=columns).convert_dtypes(dtype_backend=DATAFRAME_DTYPE_BACKEND)
+
+def get_data_as_dataframe(category=None, columns=None):
+    """ดึงข้อมูลในรูปแบบ DataFrame (อ่านทีละ chunk แล้วรวมกัน)"""
+    columns = list(columns or DATA_SOURCE_COLUMNS)
+    try:
+        frames = list(iter_data_frames(category, columns))
+    except Exception as e:
+        logger.error(f"เกิดข้อผิดพลาดในการดึงข้อมูลเป็น DataFrame: {str(e)}")
+        frames = []
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    df = pd.concat(frames, ignore_index=True)
+    if 'category' in df:
+        # chunk ที่มีหมวดหมู่ต่างกันจะกลายเป็น object เมื่อรวมกัน จึงแปลงกลับเป็น category อีกครั้ง
+        df['category'] = df['category'].astype('category')
+    return df
+
+class PartialSchemaError(Exception):
+    """วิเคราะห์โครงสร้างได้ไม่ครบ (บาง collection ผิดพลาด) เก็บโครงสร้างเท่าที่ได้ไว้ใน schema"""
+
+    def __init__(self, schema, failed):
+        super().__init__(f"วิเคราะห์โครงสร้างไม่สำเร็จ: {', '.join(failed)}")
+        self.schema = schema
+        self.failed = failed
+
+# ฟังก์ชันสำหรับดึงโครงสร้างฐานข้อมูล
+def get_database_schema(refresh=False):
+    """
+    ดึงโครงสร้างฐานข้อมูล (เก็บใน cache ที่ใช้ร่วมกันระหว่าง worker)
+    
+    Args:
+        refresh (bool): ไม่ใช้ cache และวิเคราะห์โครงสร้างใหม่
+    """
+    db_type = db_manager.db_type.lower()
+    if db_type in ['mysql', 'postgresql']:
+        infer, ttl = _infer_sql_schema, SQL_SCHEMA_CACHE_TTL
+    elif db_type == 'mongodb':
+        infer, ttl = _infer_mongodb_schema, MONGODB_SCHEMA_CACHE_TTL
     else:
         logger.error(f"ไม่รองรับฐานข้อมูลประเภท {db_manager.db_type}")
         return {}
-
-def _get_sql_schema():
-    """ดึงโครงสร้างฐานข้อมูล SQL"""
+    
+    params = db_manager.connection_params
+    cache_key = (db_type, params.get('mongodb_uri'), params.get('host'), params.get('port'), params.get('database'))
     try:
-        inspector = inspect(db_manager.engine)
-        schema = {}
-        
-        for table_name in inspector.get_table_names():
-            columns = []
-            for column in inspector.get_columns(table_name):
-                columns.append({
-                    'name': column['name'],
-                    'type': str(column['type']),
-                    'nullable': column['nullable']
-                })
-            
-            # ดึง primary key columns
-            pk_constraint = inspector.get_pk_constraint(table_name)
-            pk_columns = pk_constraint.get('constrained_columns', []) if pk_constraint else []
-            
-            # ดึง foreign keys
-            foreign_keys = []
-            for fk in inspector.get_foreign_keys(table_name):
-                foreign_keys.append({
-                    'referred_table': fk['referred_table'],
-                    'referred_columns': fk['referred_columns'],
-                    'constrained_columns': fk['constrained_columns']
-                })
-            
-            schema[table_name] = {
-                'columns': columns,
-                'primary_keys': pk_columns,
-                'foreign_keys': foreign_keys
-            }
-        
-        return schema
+        if ttl <= 0:
+            return infer()
+        if refresh:
+            schema = infer()
+            app_cache.set("schema", cache_key, schema, ttl)
+            return schema
+        return app_cache.get_or_set("schema", cache_key, infer, ttl)
+    except PartialSchemaError as e:
+        # ใช้โครงสร้างเท่าที่ได้ในคำขอนี้ แต่ไม่เก็บลง cache เพื่อให้คำขอถัดไปวิเคราะห์ใหม่
+        logger.warning(f"{str(e)} (ไม่เก็บลง cache)")
+        metrics.increment("schema.partial")
+        return e.schema
     except Exception as e:
-        logger.error(f"เกิดข้อผิดพลาดในการดึงโครงสร้างฐานข้อมูล SQL: {str(e)}")
+        logger.error(f"เกิดข้อผิดพลาดในการดึงโครงสร้างฐานข้อมูล {db_manager.db_type}: {str(e)}")
         return {}
 
-def _get_mongodb_schema():
-    """ดึงโครงสร้างฐานข้อมูล MongoDB"""
+def _infer_sql_schema():
+    """อ่านโครงสร้างฐานข้อมูล SQL"""
+    inspector = inspect(db_manager.engine)
+    schema = {}
+    
+    for table_name in inspector.get_table_names():
+        columns = []
+        for column in inspector.get_columns(table_name):
+            columns.append({
+                'name': column['name'],
+                'type': str(column['type']),
+                'nullable': column['nullable']
+            })
+        
+        # ดึง primary key columns
+        pk_constraint = inspector.get_pk_constraint(table_name)
+        pk_columns = pk_constraint.get('constrained_columns', []) if pk_constraint else []
+        
+        # ดึง foreign keys
+        foreign_keys = []
+        for fk in inspector.get_foreign_keys(table_name):
+            foreign_keys.append({
+                'referred_table': fk['referred_table'],
+                'referred_columns': fk['referred_columns'],
+                'constrained_columns': fk['constrained_columns']
+            })
+        
+        schema[table_name] = {
+            'columns': columns,
+            'primary_keys': pk_columns,
+            'foreign_keys': foreign_keys
+        }
+    
+    return schema
+
+def _infer_mongodb_schema():
+    """วิเคราะห์โครงสร้างฐานข้อมูล MongoDB จากเอกสารตัวอย่าง"""
+    started = time.perf_counter()
+    # ดึงรายชื่อ collections
+    collections = db_manager.mongo_db.list_collection_names()
+    
+    # วิเคราะห์แต่ละ collection พร้อมกัน
+    schema = {}
+    if collections:
+        with ThreadPoolExecutor(max_workers=min(MONGODB_SCHEMA_WORKERS, len(collections))) as executor:
+            for collection_name, collection_schema in zip(
+                collections,
+                executor.map(lambda name: _infer_collection_schema(db_manager.mongo_db[name]), collections)
+            ):
+                schema[collection_name] = collection_schema
+    
+    logger.info(f"วิเคราะห์โครงสร้าง MongoDB {len(collections)} collections ใน {(time.perf_counter() - started) * 1000:.0f} ms")
+    failed = [name for name, collection_schema in schema.items() if 'error' in collection_schema]
+    if failed:
+        raise PartialSchemaError(schema, failed)
+    return schema
+
+def _collect_field_types(document, prefix, found, depth=0):
+    """เก็บ path ของทุกฟิลด์ (รวมฟิลด์ซ้อนในรูปแบบ a.b) และประเภทข้อมูลที่พบในเอกสารหนึ่งฉบับ"""
+    for field, value in document.items():
+        if not prefix and field == '_id':  # ข้ามฟิลด์ _id
+            continue
+        path = f"{prefix}{field}"
+        if isinstance(value, list):
+            found.setdefault(path, set()).add('array')
+            if depth < MONGODB_SCHEMA_MAX_DEPTH:
+                for item in value:
+                    if isinstance(item, dict):
+                        _collect_field_types(item, f"{path}.", found, depth + 1)
+        elif isinstance(value, dict):
+            found.setdefault(path, set()).add('object')
+            if depth < MONGODB_SCHEMA_MAX_DEPTH:
+                _collect_field_types(value, f"{path}.", found, depth + 1)
+        else:
+            found.setdefault(path, set()).add(type(value).__name__)
+
+def _infer_collection_schema(collection):
+    """วิเคราะห์โครงสร้างของ collection จากเอกสารตัวอย่างแบบสุ่ม และดึงข้อมูล index"""
     try:
-        schema = {}
+        try:
+            documents = collection.aggregate([{"$sample": {"size": MONGODB_SCHEMA_SAMPLE_SIZE}}])
+        except Exception:
+            # บาง collection (เช่น view) ใช้ $sample ไม่ได้
+            documents = collection.find().limit(MONGODB_SCHEMA_SAMPLE_SIZE)
         
-        # ดึงรายชื่อ collections
-        collections = db_manager.mongo_db.list_collection_names()
+        # นับจำนวนเอกสารที่มีแต่ละฟิลด์ และจำนวนครั้งของแต่ละประเภทข้อมูล
+        presence = {}
+        type_counts = {}
+        sampled = 0
+        for document in documents:
+            sampled += 1
+            found = {}
+            _collect_field_types(document, "", found)
+            for path, types in found.items():
+                presence[path] = presence.get(path, 0) + 1
+                counts = type_counts.setdefault(path, {})
+                for type_name in types:
+                    counts[type_name] = counts.get(type_name, 0) + 1
         
-        for collection_name in collections:
-            # ดึงตัวอย่างเอกสารเพื่อวิเคราะห์โครงสร้าง
-            sample = db_manager.mongo_db[collection_name].find_one()
-            
-            if sample:
-                # วิเคราะห์โครงสร้างจากตัวอย่างเอกสาร
-                fields = []
-                for field, value in sample.items():
-                    if field != '_id':  # ข้ามฟิลด์ _id
-                        fields.append({
-                            'name': field,
-                            'type': type(value).__name__
-                        })
-                
-                schema[collection_name] = {
-                    'fields': fields
-                }
-            else:
-                schema[collection_name] = {
-                    'fields': []
-                }
+        fields = []
+        for path in presence:
+            counts = type_counts[path]
+            # ประเภทหลักคือประเภทที่พบบ่อยที่สุด (ไม่นับค่า null)
+            non_null = {name: count for name, count in counts.items() if name != 'NoneType'} or counts
+            fields.append({
+                'name': path,
+                'type': max(non_null, key=non_null.get),
+                'types': counts,
+                'frequency': round(presence[path] / sampled, 3)
+            })
         
-        return schema
+        indexes = []
+        for name, info in collection.index_information().items():
+            indexes.append({
+                'name': name,
+                'keys': [[key, direction] for key, direction in info.get('key', [])],
+                'unique': bool(info.get('unique', False))
+            })
+        
+        return {
+            'fields': fields,
+            'indexes': indexes,
+            'sampled_documents': sampled
+        }
     except Exception as e:
-        logger.error(f"เกิดข้อผิดพลาดในการดึงโครงสร้างฐานข้อมูล MongoDB: {str(e)}")
-        return {}
+        logger.error(f"เกิดข้อผิดพลาดในการวิเคราะห์โครงสร้าง collection {collection.name}: {str(e)}")
+        return {
+            'fields': [],
+            'error': str(e)
+        }
+
+def invalidate_schema_cache():
+    """ล้าง cache ของโครงสร้างฐานข้อมูล (เช่น เมื่อเปลี่ยนการเชื่อมต่อ)"""
+    app_cache.invalidate("schema")
 
 # ฟังก์ชันสำหรับ execute คำสั่ง SQL หรือ MongoDB query
 def execute_sql_query(query):
@@ -393,41 +801,137 @@ def execute_sql_query(query):
         logger.error(error_message)
         raise Exception(error_message)
 
-def _execute_sql(sql_query):
-    """Execute คำสั่ง SQL"""
-    db = db_manager.get_session()
+# คำสั่ง MongoDB ที่ _execute_mongodb_query รองรับ
+MONGODB_OPERATIONS = ('find', 'insert', 'update', 'delete', 'aggregate')
+
+def validate_sql_query(query):
+    """
+    ตรวจสอบคำสั่ง SQL หรือ MongoDB query แบบเบาๆ ก่อนรันจริง
+    
+    SQL: ตรวจสอบไวยากรณ์เบื้องต้น (วงเล็บ/เครื่องหมายคำพูด) แล้วใช้ EXPLAIN กับคำสั่งอ่านข้อมูล
+    MongoDB: แปลง JSON และตรวจสอบว่ามี collection และคำสั่งที่รองรับ
+    
+    Raises:
+        ValueError: ถ้าคำสั่งไม่ถูกต้อง
+    """
+    if not query or not query.strip():
+        raise ValueError("คำสั่งว่างเปล่า")
+    
+    if db_manager.db_type.lower() == 'mongodb':
+        try:
+            parsed = json.loads(query)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"รูปแบบ JSON ไม่ถูกต้อง: {str(e)}")
+        if not isinstance(parsed, dict) or 'collection' not in parsed:
+            raise ValueError("ต้องระบุ 'collection' ในคำสั่ง MongoDB")
+        if not any(operation in parsed for operation in MONGODB_OPERATIONS):
+            raise ValueError("ไม่รองรับคำสั่ง MongoDB นี้")
+        return True
+    
+    _check_sql_syntax(query)
+    
+    # ใช้ EXPLAIN เฉพาะคำสั่งอ่านข้อมูล เพื่อให้ฐานข้อมูลตรวจสอบชื่อตาราง/คอลัมน์โดยไม่ต้องรันจริง
+    if query.strip().upper().startswith(('SELECT', 'WITH')):
+        if not db_manager.engine:
+            raise ValueError("ยังไม่ได้เชื่อมต่อกับฐานข้อมูล SQL")
+        try:
+            with db_manager.engine.connect() as connection:
+                connection.execute(text(f"EXPLAIN {query.strip().rstrip(';')}"))
+        except Exception as e:
+            raise ValueError(f"EXPLAIN ไม่ผ่าน: {str(e)}")
+    return True
+
+def _check_sql_syntax(sql_query):
+    """
+    ตรวจสอบไวยากรณ์ SQL เบื้องต้น: เครื่องหมายคำพูดและวงเล็บต้องครบคู่
+    
+    เครื่องหมายคำพูดซ้อน ('') และ backslash escape ของ MySQL (\\') ไม่ถือเป็นการปิดข้อความ
+    และข้ามคอมเมนต์ -- และ /* */ (ข้อผิดพลาดอื่นปล่อยให้ EXPLAIN ตรวจสอบ)
+    """
+    # PostgreSQL ถือ backslash เป็นตัวอักษรธรรมดาในข้อความ (standard_conforming_strings)
+    backslash_escapes = db_manager.db_type.lower() == 'mysql'
+    depth = 0
+    quote = None
+    i = 0
+    length = len(sql_query)
+    while i < length:
+        char = sql_query[i]
+        if quote:
+            if char == '\\' and backslash_escapes and quote != '`':
+                i += 2
+                continue
+            if char == quote:
+                if i + 1 < length and sql_query[i + 1] == quote:
+                    i += 2
+                    continue
+                quote = None
+        elif char in ("'", '"', '`'):
+            quote = char
+        elif sql_query.startswith('--', i):
+            newline = sql_query.find('\n', i)
+            i = length if newline < 0 else newline + 1
+            continue
+        elif sql_query.startswith('/*', i):
+            end = sql_query.find('*/', i + 2)
+            i = length if end < 0 else end + 2
+            continue
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+            if depth < 0:
+                raise ValueError("วงเล็บไม่ครบคู่")
+        i += 1
+    if quote:
+        raise ValueError("เครื่องหมายคำพูดไม่ครบคู่")
+    if depth != 0:
+        raise ValueError("วงเล็บไม่ครบคู่")
+
+def execute_sql_rows(query):
+    """
+    Execute คำสั่ง SQL และคืนค่าผลลัพธ์เป็นหัวคอลัมน์ร่วมกับแถวแบบ tuple (ไม่สร้าง dict ต่อแถว)
+    
+    Returns:
+        tuple: (tuple ของชื่อคอลัมน์, list ของ tuple) สำหรับคำสั่งอ่านข้อมูล
+        dict: ข้อความผลการทำงานสำหรับคำสั่ง INSERT, UPDATE, DELETE
+    
+    Raises:
+        ValueError: ถ้าฐานข้อมูลปัจจุบันไม่ใช่ SQL
+    """
+    if db_manager.db_type.lower() not in ['mysql', 'postgresql']:
+        raise ValueError("ผลลัพธ์แบบหัวคอลัมน์และแถวรองรับเฉพาะฐานข้อมูล SQL")
+    return _execute_sql_rows(query)
+
+def _execute_sql_rows(sql_query):
     try:
+        if not db_manager.query_engine:
+            raise ValueError("ยังไม่ได้เชื่อมต่อกับฐานข้อมูล SQL")
         logger.info(f"กำลัง execute คำสั่ง SQL: {sql_query}")
-        result = db.execute(text(sql_query))
-        
-        if sql_query.strip().upper().startswith(('SELECT', 'SHOW')):
-            # สำหรับคำสั่ง SELECT หรือ SHOW
-            columns = result.keys()
-            rows = []
-            for row in result:
-                # แปลงค่า Decimal เป็น float
-                processed_row = {}
-                for i, column in enumerate(columns):
-                    value = row[i]
-                    if isinstance(value, decimal.Decimal):
-                        processed_row[column] = float(value)
-                    else:
-                        processed_row[column] = value
-                rows.append(processed_row)
+        with db_manager.query_engine.connect() as connection:
+            result = connection.execute(text(sql_query))
             
-            logger.info(f"พบข้อมูล {len(rows)} รายการ")
-            return rows
-        else:
-            # สำหรับคำสั่ง INSERT, UPDATE, DELETE
-            db.commit()
+            if sql_query.strip().upper().startswith(('SELECT', 'SHOW')):
+                # สำหรับคำสั่ง SELECT หรือ SHOW (driver แปลง DECIMAL และวันที่ไว้แล้ว)
+                columns = tuple(result.keys())
+                rows = [tuple(row) for row in result]
+                logger.info(f"พบข้อมูล {len(rows)} รายการ")
+                return columns, rows
+            
+            # สำหรับคำสั่ง INSERT, UPDATE, DELETE (ถ้าเกิดข้อผิดพลาด การเชื่อมต่อจะ rollback เมื่อปิด)
+            connection.commit()
             return {"message": "คำสั่ง SQL ทำงานสำเร็จ"}
     except Exception as e:
-        db.rollback()
         error_message = f"เกิดข้อผิดพลาดในการ execute คำสั่ง SQL: {str(e)}"
         logger.error(error_message)
         raise Exception(error_message)
-    finally:
-        db.close()
+
+def _execute_sql(sql_query):
+    """Execute คำสั่ง SQL"""
+    result = _execute_sql_rows(sql_query)
+    if isinstance(result, dict):
+        return result
+    columns, rows = result
+    return [dict(zip(columns, row)) for row in rows]
 
 def _execute_mongodb_query(query_str):
     """Execute MongoDB query ในรูปแบบ JSON string"""
@@ -449,7 +953,7 @@ def _execute_mongodb_query(query_str):
             projection = query.get('projection', None)
             limit = query.get('limit', 0)
             
-            cursor = collection.find(filter_query, projection)
+            cursor = collection.find(filter_query, projection).batch_size(MONGODB_BATCH_SIZE)
             if limit > 0:
                 cursor = cursor.limit(limit)
             
@@ -498,7 +1002,7 @@ def _execute_mongodb_query(query_str):
         elif 'aggregate' in query:
             # คำสั่ง aggregate
             pipeline = query['aggregate']
-            result = list(collection.aggregate(pipeline))
+            result = list(collection.aggregate(pipeline, allowDiskUse=MONGODB_ALLOW_DISK_USE, batchSize=MONGODB_BATCH_SIZE))
             
             # แปลง ObjectId เป็น string
             for item in result:
@@ -519,6 +1023,140 @@ def _execute_mongodb_query(query_str):
         logger.error(error_message)
         raise Exception(error_message)
 
+def stream_query_results(query, chunk_size=None, offset=0):
+    """
+    รันคำสั่งอ่านข้อมูลแบบ streaming และคืนผลลัพธ์ทีละ chunk โดยไม่เก็บผลลัพธ์ทั้งหมดไว้ในหน่วยความจำ
+    
+    Args:
+        query (str): คำสั่ง SELECT หรือ MongoDB query (find/aggregate) ในรูปแบบ JSON
+        chunk_size (int, optional): จำนวนแถวต่อ chunk
+        offset (int): จำนวนแถวแรกที่ข้าม (ใช้เมื่อเปิด cursor ต่อจากตำแหน่งเดิม)
+    
+    Yields:
+        tuple: (จำนวนแถวใน chunk, JSON array ของแถวใน chunk)
+    """
+    chunk_size = chunk_size or QUERY_STREAM_CHUNK_SIZE
+    if db_manager.db_type.lower() in ['mysql', 'postgresql']:
+        return _stream_sql_query(query, chunk_size, offset)
+    elif db_manager.db_type.lower() == 'mongodb':
+        return _stream_mongodb_query(query, chunk_size, offset)
+    raise ValueError(f"ไม่รองรับฐานข้อมูลประเภท {db_manager.db_type}")
+
+def _stream_sql_query(sql_query, chunk_size, offset=0):
+    """รันคำสั่ง SQL ด้วย server-side cursor และแปลงผลลัพธ์เป็น JSON ทีละ chunk"""
+    if not sql_query.strip().upper().startswith(('SELECT', 'WITH', 'SHOW')):
+        raise ValueError("โหมด streaming รองรับเฉพาะคำสั่งอ่านข้อมูล")
+    if not db_manager.query_engine:
+        raise ValueError("ยังไม่ได้เชื่อมต่อกับฐานข้อมูล SQL")
+    
+    with db_manager.query_engine.connect() as connection:
+        connection = connection.execution_options(stream_results=True, max_row_buffer=chunk_size)
+        result = connection.execute(text(sql_query))
+        columns = list(result.keys())
+        # ข้ามแถวแรกทีละ chunk โดยไม่แปลงเป็น JSON (ใช้หน่วยความจำเท่ากับ chunk เดียว)
+        while offset > 0:
+            skipped = len(result.fetchmany(min(offset, chunk_size)))
+            if not skipped:
+                return
+            offset -= skipped
+        for partition in result.partitions(chunk_size):
+            rows = [dict(zip(columns, row)) for row in partition]
+            yield len(rows), json.dumps(rows, cls=CustomJSONEncoder, ensure_ascii=False)
+
+# คำสั่ง SELECT จากตารางเดียว (มี alias และ WHERE ได้) ที่เรียงใหม่ตาม id ได้โดยผลลัพธ์ไม่เปลี่ยน
+_KEYSET_QUERY = re.compile(r'^\s*SELECT\s.+?\sFROM\s+[\w.`"]+(\s+(AS\s+)?\w+)?(\s+WHERE\s.+)?$', re.IGNORECASE | re.DOTALL)
+# ลำดับหรือจำนวนแถวถูกกำหนดโดยคำสั่งเอง หรือ id อาจซ้ำกัน
+_KEYSET_UNSAFE = re.compile(
+    r'\b(ORDER\s+BY|LIMIT|OFFSET|FETCH|JOIN|UNION|INTERSECT|EXCEPT|GROUP\s+BY|DISTINCT|AS\s+id)\b', re.IGNORECASE
+)
+
+def stream_sql_keyset_pages(sql_query, page_size, after=None):
+    """
+    อ่านผลลัพธ์ของคำสั่ง SQL ทีละหน้าแบบ keyset (เรียงตาม id และอ่านต่อจาก id ของแถวสุดท้าย)
+    
+    การเปิดอ่านต่อจากตำแหน่งใดก็ใช้เวลาเท่ากับหน้าแรก ต่างจากการข้ามแถวที่ช้าลงตามตำแหน่ง
+    ใช้ได้เฉพาะคำสั่ง SELECT จากตารางเดียวที่มีคอลัมน์ id (primary key) และไม่ได้กำหนดลำดับหรือจำนวนแถวเอง
+    
+    Args:
+        sql_query (str): คำสั่ง SELECT
+        page_size (int): จำนวนแถวต่อหน้า
+        after (optional): id ของแถวสุดท้ายที่อ่านไปแล้ว (None = เริ่มจากแถวแรก)
+    
+    Returns:
+        generator ของ (จำนวนแถว, JSON array ของแถว, id ของแถวสุดท้าย) หรือ None ถ้าคำสั่งนี้ใช้ keyset ไม่ได้
+    """
+    if db_manager.db_type.lower() not in ['mysql', 'postgresql'] or not db_manager.query_engine:
+        return None
+    sql_query = sql_query.strip().rstrip(';')
+    if not _KEYSET_QUERY.match(sql_query) or _KEYSET_UNSAFE.search(sql_query):
+        return None
+    source = f"SELECT * FROM ({sql_query}) AS _keyset_source"
+    try:
+        # ตรวจว่ามีคอลัมน์ id เพียงคอลัมน์เดียว (ไม่ดึงแถวข้อมูล)
+        with db_manager.query_engine.connect() as connection:
+            connection.execute(text(f"SELECT id FROM ({sql_query}) AS _keyset_source WHERE 1 = 0")).close()
+    except Exception:
+        return None
+    if after is None:
+        return _stream_sql_keyset(text(f"{source} ORDER BY id"), {}, page_size)
+    return _stream_sql_keyset(text(f"{source} WHERE id > :after ORDER BY id"), {'after': after}, page_size)
+
+def _stream_sql_keyset(statement, params, page_size):
+    with db_manager.query_engine.connect() as connection:
+        connection = connection.execution_options(stream_results=True, max_row_buffer=page_size)
+        result = connection.execute(statement, params)
+        columns = list(result.keys())
+        for partition in result.partitions(page_size):
+            rows = [dict(zip(columns, row)) for row in partition]
+            yield len(rows), json.dumps(rows, cls=CustomJSONEncoder, ensure_ascii=False), rows[-1]['id']
+
+def _stream_mongodb_query(query_str, chunk_size, offset=0):
+    """
+    รันคำสั่ง find/aggregate ของ MongoDB แบบ streaming
+    
+    เอกสารถูกดึงเป็น RawBSONDocument (เก็บเป็น bytes จนกว่าจะแปลงเป็น JSON) และแปลงด้วย bson.json_util
+    ทำให้ใช้หน่วยความจำเท่ากับ batch ปัจจุบันเท่านั้น (ObjectId และวันที่จะอยู่ในรูปแบบ Extended JSON)
+    """
+    from bson import json_util
+    from bson.codec_options import CodecOptions
+    from bson.raw_bson import RawBSONDocument
+    
+    try:
+        query = json.loads(query_str)
+    except json.JSONDecodeError:
+        raise ValueError("รูปแบบ JSON ไม่ถูกต้อง")
+    if 'collection' not in query:
+        raise ValueError("ต้องระบุ 'collection' ในคำสั่ง MongoDB")
+    
+    collection = db_manager.mongo_db[query['collection']].with_options(
+        codec_options=CodecOptions(document_class=RawBSONDocument)
+    )
+    if 'find' in query:
+        cursor = collection.find(query.get('find', {}), query.get('projection', None)).batch_size(MONGODB_BATCH_SIZE)
+        if offset:
+            cursor = cursor.skip(offset)
+        if query.get('limit', 0) > 0:
+            if query['limit'] <= offset:
+                return
+            cursor = cursor.limit(query['limit'] - offset)
+    elif 'aggregate' in query:
+        pipeline = list(query['aggregate']) + ([{'$skip': offset}] if offset else [])
+        cursor = collection.aggregate(pipeline, allowDiskUse=MONGODB_ALLOW_DISK_USE, batchSize=MONGODB_BATCH_SIZE)
+    else:
+        raise ValueError("โหมด streaming รองรับเฉพาะคำสั่ง find และ aggregate")
+    
+    try:
+        chunk = []
+        for document in cursor:
+            chunk.append(json_util.dumps(document, json_options=json_util.RELAXED_JSON_OPTIONS))
+            if len(chunk) >= chunk_size:
+                yield len(chunk), '[' + ','.join(chunk) + ']'
+                chunk = []
+        if chunk:
+            yield len(chunk), '[' + ','.join(chunk) + ']'
+    finally:
+        cursor.close()
+
 # เมื่อรันไฟล์นี้โดยตรง
 if __name__ == "__main__":
     print("เริ่มต้นโมดูลฐานข้อมูล") 
\ No newline at end of file
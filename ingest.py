@@ -0,0 +1,200 @@
+import io
+import os
+import csv
+import json
+import time
+import logging
+from datetime import datetime
+from dotenv import load_dotenv
+from pydantic import TypeAdapter, ValidationError
+from typing import List
+from database import db_manager, DataSource
+from models import Data
+from metrics import metrics
+
+# ตั้งค่าการบันทึกล็อก
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# โหลดค่าจากไฟล์ .env
+load_dotenv()
+
+# จำนวนแถวต่อการตรวจสอบและเขียนหนึ่งครั้ง
+INGEST_CHUNK_SIZE = int(os.getenv("INGEST_CHUNK_SIZE", "5000"))
+# จำนวนข้อผิดพลาดสูงสุดที่รายงานกลับ
+INGEST_MAX_REPORTED_ERRORS = int(os.getenv("INGEST_MAX_REPORTED_ERRORS", "100"))
+# เวลาสูงสุดที่รอข้อมูลส่วนถัดไปจาก client (วินาที)
+INGEST_READ_TIMEOUT = float(os.getenv("INGEST_READ_TIMEOUT", "60"))
+
+INGEST_FORMATS = ('ndjson', 'csv')
+
+_data_batch_adapter = TypeAdapter(List[Data])
+
+class _ChunkReader(io.RawIOBase):
+    """file-like object ที่อ่านข้อมูลจากฟังก์ชันที่คืนค่า bytes ทีละส่วน (b'' เมื่อหมด)"""
+
+    def __init__(self, next_chunk):
+        self._next_chunk = next_chunk
+        self._buffer = b''
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, target):
+        while not self._buffer and not self._eof:
+            chunk = self._next_chunk()
+            if not chunk:
+                self._eof = True
+            else:
+                self._buffer = chunk
+        size = min(len(target), len(self._buffer))
+        target[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+def detect_format(content_type=None, requested=None):
+    """เลือกรูปแบบข้อมูลจากพารามิเตอร์ที่ระบุ หรือจาก Content-Type"""
+    if requested:
+        requested = requested.lower()
+        if requested not in INGEST_FORMATS:
+            raise ValueError(f"ไม่รองรับรูปแบบข้อมูล {requested} (รองรับ: {', '.join(INGEST_FORMATS)})")
+        return requested
+    content_type = (content_type or '').lower()
+    if 'csv' in content_type:
+        return 'csv'
+    if 'ndjson' in content_type or 'jsonlines' in content_type or 'json' in content_type:
+        return 'ndjson'
+    raise ValueError("กรุณาระบุรูปแบบข้อมูล (format=ndjson หรือ csv) หรือ Content-Type")
+
+class _ErrorLog:
+    """นับแถวที่ไม่ผ่าน และเก็บรายละเอียดไว้ไม่เกิน INGEST_MAX_REPORTED_ERRORS รายการ"""
+
+    def __init__(self, limit=INGEST_MAX_REPORTED_ERRORS):
+        self.limit = limit
+        self.count = 0
+        self.items = []
+
+    def append(self, error):
+        self.count += 1
+        if len(self.items) < self.limit:
+            self.items.append(error)
+
+def _iter_records(text_stream, data_format, errors):
+    """อ่านข้อมูลทีละแถว คืนค่า (หมายเลขแถว, dict) โดยแถวที่อ่านไม่ได้จะเป็น (หมายเลขแถว, None) และถูกเก็บไว้ใน errors"""
+    if data_format == 'csv':
+        reader = csv.DictReader(text_stream, restkey='_extra')
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for line_number, line in enumerate(text_stream, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            errors.append({'line': line_number, 'error': f"JSON ไม่ถูกต้อง: {str(e)}"})
+            yield line_number, None
+            continue
+        if not isinstance(record, dict):
+            errors.append({'line': line_number, 'error': "แต่ละบรรทัดต้องเป็น JSON object"})
+            yield line_number, None
+            continue
+        yield line_number, record
+
+def _validate_batch(batch, errors):
+    """ตรวจสอบข้อมูลทั้ง batch ด้วย Pydantic ครั้งเดียว และตัดแถวที่ไม่ผ่านออก"""
+    records = [record for _, record in batch]
+    try:
+        return _data_batch_adapter.validate_python(records)
+    except ValidationError as e:
+        invalid = {}
+        for error in e.errors():
+            index = error['loc'][0]
+            field = '.'.join(str(part) for part in error['loc'][1:])
+            invalid.setdefault(index, []).append(f"{field}: {error['msg']}" if field else error['msg'])
+        for index, messages in invalid.items():
+            errors.append({'line': batch[index][0], 'error': '; '.join(messages)})
+        valid_records = [record for index, record in enumerate(records) if index not in invalid]
+        return _data_batch_adapter.validate_python(valid_records)
+
+def _write_sql(items):
+    engine = db_manager.engine
+    if engine is None:
+        raise ValueError("ยังไม่ได้เชื่อมต่อกับฐานข้อมูล SQL")
+    now = datetime.now()
+    rows = [{**item.model_dump(), 'created_at': now, 'updated_at': now} for item in items]
+    with engine.begin() as connection:
+        # ส่ง list ของ dict ทำให้ driver เขียนแบบ executemany / multi-row INSERT
+        connection.execute(DataSource.__table__.insert(), rows)
+
+def _write_mongodb(items):
+    if db_manager.mongo_db is None:
+        raise ValueError("ยังไม่ได้เชื่อมต่อกับฐานข้อมูล MongoDB")
+    now = datetime.now()
+    documents = [{**item.model_dump(), 'created_at': now, 'updated_at': now} for item in items]
+    db_manager.mongo_db['data_source'].insert_many(documents, ordered=False)
+
+def ingest_data_source(next_chunk, data_format, chunk_size=None):
+    """
+    นำเข้าข้อมูลจำนวนมากลงตาราง data_source (หรือ collection ใน MongoDB)
+
+    อ่านข้อมูลแบบ streaming ตรวจสอบด้วย Pydantic ทีละ chunk และเขียนทีละ chunk
+    ทำให้ใช้หน่วยความจำเท่ากับหนึ่ง chunk ไม่ว่าไฟล์จะใหญ่แค่ไหน
+
+    Args:
+        next_chunk (callable): ฟังก์ชันที่คืนค่าข้อมูล (bytes) ส่วนถัดไป หรือ b'' เมื่อหมด
+        data_format (str): 'ndjson' หรือ 'csv'
+        chunk_size (int, optional): จำนวนแถวต่อการเขียนหนึ่งครั้ง
+
+    Returns:
+        dict: จำนวนแถวที่อ่าน/เขียน/ไม่ผ่านการตรวจสอบ ข้อผิดพลาด และ rows_per_second
+    """
+    chunk_size = max(1, chunk_size or INGEST_CHUNK_SIZE)
+    is_mongodb = db_manager.db_type.lower() == 'mongodb'
+    if not is_mongodb:
+        if db_manager.engine is None:
+            raise ValueError("ยังไม่ได้เชื่อมต่อกับฐานข้อมูล SQL")
+        DataSource.metadata.create_all(db_manager.engine, tables=[DataSource.__table__])
+    write = _write_mongodb if is_mongodb else _write_sql
+
+    started = time.perf_counter()
+    errors = _ErrorLog()
+    received = 0
+    inserted = 0
+    text_stream = io.TextIOWrapper(io.BufferedReader(_ChunkReader(next_chunk)), encoding='utf-8-sig', newline='')
+
+    def flush(batch):
+        nonlocal inserted
+        items = _validate_batch(batch, errors)
+        if items:
+            write_started = time.perf_counter()
+            write(items)
+            metrics.observe("ingest.batch_write", (time.perf_counter() - write_started) * 1000)
+            inserted += len(items)
+
+    batch = []
+    for line_number, record in _iter_records(text_stream, data_format, errors):
+        received += 1
+        if record is None:
+            continue
+        batch.append((line_number, record))
+        if len(batch) >= chunk_size:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+
+    elapsed = time.perf_counter() - started
+    metrics.increment("ingest.rows_inserted", inserted)
+    metrics.increment("ingest.rows_invalid", errors.count)
+    logger.info(f"นำเข้าข้อมูล {inserted}/{received} แถวใน {elapsed:.2f} วินาที")
+    return {
+        'rows_received': received,
+        'rows_inserted': inserted,
+        'rows_invalid': errors.count,
+        'errors': errors.items,
+        'elapsed_seconds': round(elapsed, 3),
+        'rows_per_second': round(inserted / elapsed, 1) if elapsed > 0 else 0.0
+    }
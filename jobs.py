@@ -0,0 +1,412 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import sqlite3
+import logging
+import threading
+import itertools
+from dotenv import load_dotenv
+from database import CustomJSONEncoder
+from metrics import metrics
+
+# ตั้งค่าการบันทึกล็อก
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# โหลดค่าจากไฟล์ .env
+load_dotenv()
+
+# ไฟล์ SQLite สำหรับเก็บสถานะและผลลัพธ์ของงาน
+JOBS_DB_PATH = os.getenv("JOBS_DB_PATH", "jobs.db")
+# อายุของผลลัพธ์หลังงานเสร็จ (วินาที)
+JOB_RESULT_TTL = int(os.getenv("JOB_RESULT_TTL", "86400"))
+# จำนวนงานที่รันพร้อมกันต่อประเภท (กำหนดแยกได้ด้วย JOB_CONCURRENCY_<TYPE>)
+JOB_DEFAULT_CONCURRENCY = int(os.getenv("JOB_DEFAULT_CONCURRENCY", "2"))
+# ระยะเวลาระหว่างการลบงานที่หมดอายุ (วินาที)
+JOB_CLEANUP_INTERVAL = int(os.getenv("JOB_CLEANUP_INTERVAL", "300"))
+# ระยะเวลาระหว่างการแจ้งว่า process ยังทำงานอยู่ (วินาที) ถ้าขาดเกิน 3 รอบถือว่า process หยุดทำงานแล้ว
+JOB_HEARTBEAT_INTERVAL = int(os.getenv("JOB_HEARTBEAT_INTERVAL", "30"))
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_COMPLETED = "completed"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+FINISHED_STATUSES = (JOB_COMPLETED, JOB_FAILED, JOB_CANCELLED)
+
+# id ของ process นี้ (PID ถูกนำกลับมาใช้ใหม่ได้หลังรีสตาร์ท container จึงใช้ PID อย่างเดียวไม่ได้)
+BOOT_ID = uuid.uuid4().hex
+
+def _process_alive(pid):
+    """ตรวจสอบว่า process ยังทำงานอยู่หรือไม่"""
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class JobNotFound(Exception):
+    """ไม่พบงานตาม id ที่ระบุ"""
+
+class JobStore:
+    """เก็บสถานะ ความคืบหน้า และผลลัพธ์ของงานใน SQLite (คงอยู่หลังรีสตาร์ทแอปพลิเคชัน)"""
+
+    def __init__(self, path=JOBS_DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    type TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    priority INTEGER NOT NULL DEFAULT 0,
+                    progress REAL NOT NULL DEFAULT 0,
+                    message TEXT,
+                    payload TEXT,
+                    result TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL,
+                    expires_at REAL,
+                    worker_pid INTEGER,
+                    worker_boot_id TEXT
+                )
+            """)
+            # ไฟล์จากเวอร์ชันก่อนยังไม่มีคอลัมน์ worker_boot_id
+            columns = [row['name'] for row in self._connection.execute("PRAGMA table_info(jobs)")]
+            if 'worker_boot_id' not in columns:
+                self._connection.execute("ALTER TABLE jobs ADD COLUMN worker_boot_id TEXT")
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS job_workers (
+                    boot_id TEXT PRIMARY KEY,
+                    pid INTEGER,
+                    heartbeat_at REAL NOT NULL
+                )
+            """)
+            self._connection.execute("CREATE INDEX IF NOT EXISTS ix_jobs_status ON jobs (status, created_at)")
+            self._connection.commit()
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            cursor = self._connection.execute(sql, params)
+            self._connection.commit()
+            return cursor
+
+    def create(self, job_id, job_type, payload, priority):
+        self._execute(
+            "INSERT INTO jobs (id, type, status, priority, payload, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (job_id, job_type, JOB_QUEUED, priority, json.dumps(payload, cls=CustomJSONEncoder, ensure_ascii=False), time.time())
+        )
+
+    def update(self, job_id, expected_status=None, **fields):
+        """อัปเดตงาน (ถ้าระบุ expected_status จะอัปเดตเฉพาะเมื่องานยังอยู่ในสถานะนั้น)"""
+        if 'result' in fields:
+            fields['result'] = json.dumps(fields['result'], cls=CustomJSONEncoder, ensure_ascii=False)
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        if expected_status is None:
+            self._execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+        else:
+            self._execute(f"UPDATE jobs SET {assignments} WHERE id = ? AND status = ?", (*fields.values(), job_id, expected_status))
+
+    def claim(self, job_id):
+        """เปลี่ยนสถานะงานจาก queued เป็น running (สำเร็จเพียง process เดียว เมื่อหลาย worker ใช้ไฟล์เดียวกัน)"""
+        cursor = self._execute(
+            "UPDATE jobs SET status = ?, started_at = ?, worker_pid = ?, worker_boot_id = ? WHERE id = ? AND status = ?",
+            (JOB_RUNNING, time.time(), os.getpid(), BOOT_ID, job_id, JOB_QUEUED)
+        )
+        return cursor.rowcount == 1
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def list(self, status=None, job_type=None, limit=50):
+        query = "SELECT * FROM jobs"
+        conditions = []
+        params = []
+        if status:
+            conditions.append("status = ?")
+            params.append(status)
+        if job_type:
+            conditions.append("type = ?")
+            params.append(job_type)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY created_at DESC LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            rows = self._connection.execute(query, params).fetchall()
+        return [self._to_dict(row, include_result=False) for row in rows]
+
+    def pending(self):
+        """งานที่ยังไม่เสร็จจากการทำงานครั้งก่อน"""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT * FROM jobs WHERE status IN (?, ?) ORDER BY created_at", (JOB_QUEUED, JOB_RUNNING)
+            ).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def delete_expired(self):
+        self._execute("DELETE FROM job_workers WHERE heartbeat_at < ?", (time.time() - JOB_HEARTBEAT_INTERVAL * 3,))
+        return self._execute("DELETE FROM jobs WHERE expires_at IS NOT NULL AND expires_at < ?", (time.time(),)).rowcount
+
+    def heartbeat(self, boot_id=BOOT_ID):
+        """บันทึกว่า process ยังทำงานอยู่"""
+        self._execute(
+            "INSERT OR REPLACE INTO job_workers (boot_id, pid, heartbeat_at) VALUES (?, ?, ?)",
+            (boot_id, os.getpid(), time.time())
+        )
+
+    def remove_worker(self, boot_id=BOOT_ID):
+        self._execute("DELETE FROM job_workers WHERE boot_id = ?", (boot_id,))
+
+    def live_workers(self):
+        """boot id ของ process ที่แจ้งว่ายังทำงานอยู่ภายใน 3 รอบ heartbeat ล่าสุด"""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT boot_id FROM job_workers WHERE heartbeat_at >= ?", (time.time() - JOB_HEARTBEAT_INTERVAL * 3,)
+            ).fetchall()
+        return {row['boot_id'] for row in rows}
+
+    def _to_dict(self, row, include_result=True):
+        job = dict(row)
+        job['payload'] = json.loads(job['payload']) if job['payload'] else None
+        if include_result:
+            job['result'] = json.loads(job['result']) if job['result'] else None
+        else:
+            job.pop('result', None)
+        return job
+
+class JobContext:
+    """ข้อมูลที่ handler ใช้รายงานความคืบหน้าของงาน"""
+
+    def __init__(self, manager, job_id):
+        self._manager = manager
+        self.job_id = job_id
+
+    async def report(self, progress, message=None):
+        """
+        รายงานความคืบหน้า (0.0 - 1.0) และข้อความสถานะ
+
+        ถ้างานถูกยกเลิกจาก process อื่น จะหยุดงานที่จุดนี้
+        """
+        store = self._manager.store
+        await asyncio.to_thread(store.update, self.job_id, JOB_RUNNING, progress=round(progress, 3), message=message)
+        job = await asyncio.to_thread(store.get, self.job_id)
+        if job is None or job['status'] == JOB_CANCELLED:
+            raise asyncio.CancelledError()
+
+class JobManager:
+    """
+    คิวงานเบื้องหลังสำหรับงานที่ใช้เวลานาน
+
+    แต่ละประเภทงานมีคิวตามลำดับความสำคัญ (priority มากทำก่อน) และ worker ตามจำนวนที่กำหนด
+    สถานะและผลลัพธ์เก็บใน JobStore ส่วนคิวและ worker อยู่ในแต่ละ process
+    """
+
+    def __init__(self, store=None):
+        self._store = store
+        self._handlers = {}
+        self._queues = {}
+        self._workers = []
+        self._running = {}
+        self._sequence = itertools.count()
+        self._cleanup_task = None
+        self._heartbeat_task = None
+        self._stopping = False
+
+    @property
+    def store(self):
+        # สร้างไฟล์ฐานข้อมูลเมื่อใช้งานครั้งแรก
+        if self._store is None:
+            self._store = JobStore()
+        return self._store
+
+    def register(self, job_type, handler, concurrency=None):
+        """
+        ลงทะเบียนประเภทงาน
+
+        Args:
+            job_type (str): ชื่อประเภทงาน
+            handler (callable): async def handler(payload, context) ที่คืนค่าผลลัพธ์ (ต้องแปลงเป็น JSON ได้)
+            concurrency (int, optional): จำนวนงานที่รันพร้อมกัน (ค่าเริ่มต้นจาก JOB_CONCURRENCY_<TYPE>)
+        """
+        if concurrency is None:
+            concurrency = int(os.getenv(f"JOB_CONCURRENCY_{job_type.upper()}", str(JOB_DEFAULT_CONCURRENCY)))
+        self._handlers[job_type] = (handler, max(1, concurrency))
+
+    async def start(self):
+        """เริ่ม worker ของทุกประเภทงาน และนำงานที่ค้างจากการทำงานครั้งก่อนกลับเข้าคิว"""
+        self._stopping = False
+        for job_type, (handler, concurrency) in self._handlers.items():
+            self._queues[job_type] = asyncio.PriorityQueue()
+            for _ in range(concurrency):
+                self._workers.append(asyncio.create_task(self._worker(job_type, handler)))
+
+        await asyncio.to_thread(self.store.heartbeat)
+        live_workers = await asyncio.to_thread(self.store.live_workers)
+        for job in await asyncio.to_thread(self.store.pending):
+            if job['status'] == JOB_RUNNING:
+                # งานที่กำลังรันใน process ที่หยุดทำงานไปโดยไม่ได้ปิดตามปกติ ไม่สามารถทำต่อได้
+                if not self._worker_alive(job, live_workers):
+                    await asyncio.to_thread(self._finish, job['id'], JOB_FAILED, error="งานถูกขัดจังหวะเนื่องจากแอปพลิเคชันหยุดทำงาน")
+            elif job['type'] in self._queues:
+                # ถ้ามีหลาย process งานจะถูกรันโดย process ที่ claim ได้ก่อนเท่านั้น
+                self._enqueue(job['id'], job['type'], job['payload'], job['priority'])
+
+        self._cleanup_task = asyncio.create_task(self._cleanup_loop())
+        self._heartbeat_task = asyncio.create_task(self._heartbeat_loop())
+
+    @staticmethod
+    def _worker_alive(job, live_workers):
+        """process ที่รันงานยังทำงานอยู่หรือไม่ (เทียบ boot id เพราะ PID อาจเป็นของ process ใหม่ที่ได้ PID ซ้ำ)"""
+        if job.get('worker_boot_id'):
+            return job['worker_boot_id'] != BOOT_ID and job['worker_boot_id'] in live_workers
+        # งานจากเวอร์ชันก่อนที่ยังไม่มี boot id: PID ของ process นี้เองแปลว่า process เดิมหยุดไปแล้ว
+        return job['worker_pid'] != os.getpid() and _process_alive(job['worker_pid'])
+
+    async def stop(self):
+        """หยุด worker ทั้งหมด (งานที่อยู่ในคิวหรือกำลังรันจะถูกนำกลับมาทำเมื่อเริ่มใหม่)"""
+        self._stopping = True
+        tasks = self._workers + [task for task in (self._cleanup_task, self._heartbeat_task) if task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._workers = []
+        self._cleanup_task = None
+        self._heartbeat_task = None
+        try:
+            await asyncio.to_thread(self.store.remove_worker)
+        except Exception as e:
+            logger.error(f"เกิดข้อผิดพลาดในการลบข้อมูล process ของงาน: {str(e)}")
+
+    def _enqueue(self, job_id, job_type, payload, priority):
+        self._queues[job_type].put_nowait((-priority, next(self._sequence), job_id, payload))
+
+    async def submit(self, job_type, payload, priority=0):
+        """
+        ส่งงานเข้าคิว
+
+        Returns:
+            str: job id
+
+        Raises:
+            ValueError: ถ้าไม่รู้จักประเภทงาน
+        """
+        if job_type not in self._handlers:
+            raise ValueError(f"ไม่รู้จักประเภทงาน: {job_type} (รองรับ: {', '.join(self._handlers)})")
+        job_id = uuid.uuid4().hex
+        await asyncio.to_thread(self.store.create, job_id, job_type, payload, priority)
+        self._enqueue(job_id, job_type, payload, priority)
+        metrics.increment(f"jobs.{job_type}.submitted")
+        return job_id
+
+    async def get(self, job_id):
+        job = await asyncio.to_thread(self.store.get, job_id)
+        if job is None:
+            raise JobNotFound(job_id)
+        return job
+
+    async def list(self, status=None, job_type=None, limit=50):
+        return await asyncio.to_thread(self.store.list, status, job_type, limit)
+
+    async def cancel(self, job_id):
+        """
+        ยกเลิกงาน (งานในคิวจะถูกข้าม ส่วนงานที่กำลังรันจะถูกหยุด)
+
+        Returns:
+            bool: False ถ้างานเสร็จไปแล้ว
+        """
+        job = await self.get(job_id)
+        if job['status'] in FINISHED_STATUSES:
+            return False
+        running = self._running.get(job_id)
+        if running is not None:
+            running[1].cancel()
+        else:
+            await asyncio.to_thread(self._finish, job_id, JOB_CANCELLED)
+        return True
+
+    def _finish(self, job_id, status, result=None, error=None):
+        now = time.time()
+        fields = {'status': status, 'finished_at': now, 'expires_at': now + JOB_RESULT_TTL, 'error': error}
+        if status == JOB_COMPLETED:
+            fields.update(result=result, progress=1.0)
+        # งานที่รันอยู่ต้องไม่เขียนทับสถานะ cancelled ที่ถูกตั้งจาก process อื่น
+        expected_status = JOB_RUNNING if status in (JOB_COMPLETED, JOB_FAILED) and self._running.get(job_id) else None
+        self.store.update(job_id, expected_status, **fields)
+
+    async def _worker(self, job_type, handler):
+        queue = self._queues[job_type]
+        while True:
+            _, _, job_id, payload = await queue.get()
+            if not await asyncio.to_thread(self.store.claim, job_id):
+                # งานถูกยกเลิก ลบ หรือถูก process อื่นรับไปแล้วระหว่างรอในคิว
+                continue
+
+            started = time.perf_counter()
+            task = asyncio.create_task(handler(payload, JobContext(self, job_id)))
+            self._running[job_id] = (job_type, task)
+            try:
+                result = await task
+                await asyncio.to_thread(self._finish, job_id, JOB_COMPLETED, result)
+                metrics.increment(f"jobs.{job_type}.completed")
+            except asyncio.CancelledError:
+                if self._stopping:
+                    # ปิดแอปพลิเคชัน: คืนงานกลับเข้าคิวเพื่อทำใหม่เมื่อเริ่มครั้งถัดไป
+                    await asyncio.to_thread(self.store.update, job_id, status=JOB_QUEUED, progress=0, message=None, worker_pid=None, worker_boot_id=None)
+                    raise
+                await asyncio.to_thread(self._finish, job_id, JOB_CANCELLED)
+                metrics.increment(f"jobs.{job_type}.cancelled")
+            except Exception as e:
+                error = getattr(e, 'detail', None) or str(e)
+                logger.error(f"งาน {job_id} ({job_type}) ล้มเหลว: {error}")
+                await asyncio.to_thread(self._finish, job_id, JOB_FAILED, error=str(error))
+                metrics.increment(f"jobs.{job_type}.failed")
+            finally:
+                self._running.pop(job_id, None)
+                metrics.observe(f"jobs.{job_type}.duration", (time.perf_counter() - started) * 1000)
+
+    async def _cleanup_loop(self):
+        while True:
+            await asyncio.sleep(JOB_CLEANUP_INTERVAL)
+            try:
+                deleted = await asyncio.to_thread(self.store.delete_expired)
+                if deleted:
+                    logger.info(f"ลบงานที่หมดอายุ {deleted} รายการ")
+            except Exception as e:
+                logger.error(f"เกิดข้อผิดพลาดในการลบงานที่หมดอายุ: {str(e)}")
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(JOB_HEARTBEAT_INTERVAL)
+            try:
+                await asyncio.to_thread(self.store.heartbeat)
+            except Exception as e:
+                logger.error(f"เกิดข้อผิดพลาดในการบันทึก heartbeat ของงาน: {str(e)}")
+
+    def status(self):
+        """จำนวนงานที่รอในคิวและกำลังรันของแต่ละประเภท"""
+        return {
+            job_type: {
+                'queued': self._queues[job_type].qsize() if job_type in self._queues else 0,
+                'running': sum(1 for running_type, _ in self._running.values() if running_type == job_type),
+                'concurrency': concurrency
+            }
+            for job_type, (_, concurrency) in self._handlers.items()
+        }
+
+# instance กลางที่ใช้ร่วมกันทั้งแอปพลิเคชัน
+job_manager = JobManager()
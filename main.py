@@ -1,5 +1,131 @@
+import os
+import argparse
+import importlib
+import importlib.util
+import logging
 import uvicorn
+from dotenv import load_dotenv
+
+# ตั้งค่าการบันทึกล็อก
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# โหลดค่าจากไฟล์ .env
+load_dotenv()
+
+# โหมดการรัน: dev (worker เดียว + auto reload) หรือ prod (หลาย worker)
+SERVER_MODE = os.getenv("SERVER_MODE", "dev")
+SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.getenv("SERVER_PORT", "8000"))
+# จำนวน worker ในโหมด prod (0 = เท่ากับจำนวน CPU core)
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", "0"))
+# เวลาที่เก็บการเชื่อมต่อ keep-alive ไว้ (วินาที) ควรนานกว่า idle timeout ของ load balancer ด้านหน้า
+SERVER_KEEP_ALIVE = int(os.getenv("SERVER_KEEP_ALIVE", "75"))
+# ขนาดคิวการเชื่อมต่อที่รอ accept ของ socket
+SERVER_BACKLOG = int(os.getenv("SERVER_BACKLOG", "2048"))
+# เวลาที่รอให้คำขอที่ค้างอยู่ (รวมถึง SSE/WebSocket) ทำงานจบก่อนปิด worker (วินาที)
+SERVER_GRACEFUL_TIMEOUT = int(os.getenv("SERVER_GRACEFUL_TIMEOUT", "120"))
+# โหลด library ขนาดใหญ่ไว้ใน master process ก่อน fork worker
+SERVER_PRELOAD = os.getenv("SERVER_PRELOAD", "true").lower() == "true"
+
+APP = "api:app"
+
+# library ที่ import ช้าและไม่เปิดการเชื่อมต่อใดๆ ตอน import จึงโหลดใน master แล้วแชร์หน่วยความจำกับ worker ได้
+# ไม่ preload ตัว api เองเพราะเปิดการเชื่อมต่อฐานข้อมูลตอน import ซึ่งใช้ร่วมกันข้าม fork ไม่ได้
+PRELOAD_MODULES = ("pandas", "sqlalchemy", "pymysql", "psycopg2", "pymongo", "openai", "httpx", "pydantic", "fastapi", "jinja2")
+
+def _has_module(name):
+    return importlib.util.find_spec(name) is not None
+
+# ใช้ uvloop และ httptools เมื่อติดตั้งไว้ (pip install uvicorn[standard])
+LOOP = "uvloop" if _has_module("uvloop") else "asyncio"
+HTTP = "httptools" if _has_module("httptools") else "h11"
+
+def default_workers():
+    return SERVER_WORKERS or os.cpu_count() or 1
+
+def preload_modules():
+    """import library ขนาดใหญ่ล่วงหน้าเพื่อให้ worker ที่ fork ออกไปไม่ต้องโหลดซ้ำ"""
+    for name in PRELOAD_MODULES:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            logger.warning(f"ไม่สามารถ preload โมดูล {name}")
+
+def run_dev(args):
+    """worker เดียวพร้อม auto reload สำหรับการพัฒนา"""
+    uvicorn.run(APP, host=args.host, port=args.port, reload=True)
+
+def run_gunicorn(args):
+    """รันด้วย gunicorn + UvicornWorker ซึ่งรองรับ graceful reload ด้วยสัญญาณ HUP"""
+    from gunicorn.app.base import BaseApplication
+
+    class ProductionServer(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"{args.host}:{args.port}")
+            self.cfg.set("workers", args.workers)
+            self.cfg.set("worker_class", "main.ProductionUvicornWorker")
+            self.cfg.set("keepalive", args.keep_alive)
+            self.cfg.set("backlog", args.backlog)
+            # worker เก่าได้รับ SIGTERM แล้วรอ stream ที่ค้างอยู่ได้นานเท่านี้ ก่อนถูกบังคับปิด
+            self.cfg.set("graceful_timeout", args.graceful_timeout)
+            # worker แบบ async ส่ง heartbeat จาก event loop จึงไม่ถูก kill ระหว่าง stream ยาวๆ
+            self.cfg.set("timeout", max(args.graceful_timeout, 30))
+
+        def load(self):
+            # import app ใน worker แต่ละตัวหลัง fork ทำให้ HUP โหลดโค้ดใหม่ได้โดยไม่ปิด socket
+            import api
+            return api.app
+
+    ProductionServer().run()
+
+def run_uvicorn_workers(args):
+    """รันหลาย worker ด้วยตัวจัดการ process ของ uvicorn เมื่อไม่ได้ติดตั้ง gunicorn"""
+    uvicorn.run(
+        APP,
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        loop=LOOP,
+        http=HTTP,
+        backlog=args.backlog,
+        timeout_keep_alive=args.keep_alive,
+        timeout_graceful_shutdown=args.graceful_timeout
+    )
+
+def run_prod(args):
+    logger.info(f"เริ่มเซิร์ฟเวอร์โหมด prod: {args.workers} worker, loop={LOOP}, http={HTTP}")
+    if _has_module("gunicorn"):
+        if SERVER_PRELOAD:
+            preload_modules()
+        run_gunicorn(args)
+    else:
+        # uvicorn สร้าง worker ด้วย spawn จึง preload ใน master ไม่ได้
+        logger.warning("ไม่พบ gunicorn จะใช้ตัวจัดการ worker ของ uvicorn แทน (ไม่รองรับ graceful reload)")
+        run_uvicorn_workers(args)
+
+if _has_module("gunicorn"):
+    from uvicorn.workers import UvicornWorker
+
+    class ProductionUvicornWorker(UvicornWorker):
+        """UvicornWorker ที่เลือก event loop และ HTTP parser ตัวที่เร็วที่สุดที่ติดตั้งไว้"""
+        CONFIG_KWARGS = {"loop": LOOP, "http": HTTP}
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="รันเซิร์ฟเวอร์ AI Database Assistant")
+    parser.add_argument("--mode", choices=("dev", "prod"), default=SERVER_MODE)
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--workers", type=int, default=default_workers(), help="จำนวน worker ในโหมด prod")
+    parser.add_argument("--keep-alive", type=int, default=SERVER_KEEP_ALIVE, help="keep-alive timeout (วินาที)")
+    parser.add_argument("--backlog", type=int, default=SERVER_BACKLOG)
+    parser.add_argument("--graceful-timeout", type=int, default=SERVER_GRACEFUL_TIMEOUT, help="เวลารอคำขอที่ค้างอยู่ก่อนปิด worker (วินาที)")
+    return parser.parse_args(argv)
 
 if __name__ == "__main__":
     # รันแอปพลิเคชัน
-    uvicorn.run("api:app", host="0.0.0.0", port=8000, reload=True) 
\ No newline at end of file
+    args = parse_args()
+    if args.mode == "prod":
+        run_prod(args)
+    else:
+        run_dev(args)
@@ -0,0 +1,77 @@
+import threading
+import time
+from collections import defaultdict, deque
+
+# จำนวนตัวอย่างล่าสุดที่เก็บไว้สำหรับคำนวณ percentile ของแต่ละ timing
+TIMING_WINDOW = 1000
+
+class MetricsRegistry:
+    """เก็บตัวนับและเวลาที่ใช้ของแต่ละการทำงานไว้ในหน่วยความจำ (thread-safe)"""
+
+    def __init__(self, window=TIMING_WINDOW):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(int)
+        self._timings = defaultdict(lambda: deque(maxlen=window))
+        self._timing_counts = defaultdict(int)
+        self._timing_totals = defaultdict(float)
+        self.started_at = time.time()
+
+    def increment(self, name, value=1):
+        """เพิ่มค่าตัวนับ"""
+        with self._lock:
+            self._counters[name] += value
+
+    def observe(self, name, value_ms):
+        """บันทึกเวลาที่ใช้ (มิลลิวินาที)"""
+        with self._lock:
+            self._timings[name].append(value_ms)
+            self._timing_counts[name] += 1
+            self._timing_totals[name] += value_ms
+
+    def get_counter(self, name):
+        """ดึงค่าตัวนับปัจจุบัน"""
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def percentile(self, name, percent):
+        """คำนวณ percentile จากตัวอย่างล่าสุด คืนค่า None ถ้ายังไม่มีข้อมูล"""
+        with self._lock:
+            samples = sorted(self._timings.get(name, ()))
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(round(percent / 100 * (len(samples) - 1))))
+        return samples[index]
+
+    def ratio(self, numerator, denominator):
+        """คำนวณอัตราส่วนระหว่างตัวนับสองตัว"""
+        with self._lock:
+            total = self._counters.get(denominator, 0)
+            if not total:
+                return None
+            return round(self._counters.get(numerator, 0) / total, 4)
+
+    def snapshot(self):
+        """คืนค่าข้อมูล metrics ทั้งหมดในรูปแบบ dict"""
+        with self._lock:
+            counters = dict(self._counters)
+            timings = {}
+            for name, samples in self._timings.items():
+                ordered = sorted(samples)
+                if not ordered:
+                    continue
+                count = self._timing_counts[name]
+                timings[name] = {
+                    'count': count,
+                    'avg_ms': round(self._timing_totals[name] / count, 2),
+                    'p50_ms': round(ordered[len(ordered) // 2], 2),
+                    'p95_ms': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 2),
+                    'max_ms': round(ordered[-1], 2)
+                }
+        return {
+            'uptime_seconds': round(time.time() - self.started_at, 1),
+            'counters': counters,
+            'timings': timings
+        }
+
+# instance กลางที่ใช้ร่วมกันทั้งแอปพลิเคชัน
+metrics = MetricsRegistry()
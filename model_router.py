@@ -0,0 +1,232 @@
+import os
+import re
+import json
+import logging
+import threading
+from dotenv import load_dotenv
+from metrics import metrics
+from chat_session import estimate_tokens
+
+# ตั้งค่าการบันทึกล็อก
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# โหลดค่าจากไฟล์ .env
+load_dotenv()
+
+# model สำหรับงานง่าย (เร็วและถูก) และงานยาก
+MODEL_FAST = os.getenv("MODEL_FAST", "gpt-4o-mini")
+MODEL_STRONG = os.getenv("MODEL_STRONG", "gpt-4o")
+# ราคาต่อ 1 ล้าน token (USD) ในรูปแบบ JSON {"model": [input, output]} สำหรับประมาณค่าใช้จ่าย
+MODEL_PRICES = json.loads(os.getenv("MODEL_PRICES", "{}") or "{}")
+# สัดส่วนราคาของ input token ที่ได้จาก prompt cache ของ OpenAI เทียบกับราคาปกติ
+MODEL_CACHED_INPUT_PRICE_RATIO = float(os.getenv("MODEL_CACHED_INPUT_PRICE_RATIO", "0.5"))
+
+DEFAULT_MODEL_PRICES = {
+    "gpt-4o": [2.50, 10.00],
+    "gpt-4o-mini": [0.15, 0.60]
+}
+
+# งานแต่ละประเภท: mode (auto = เลือกตามความซับซ้อน, fast, strong หรือชื่อ model) และเกณฑ์ความซับซ้อน (token)
+DEFAULT_ROUTES = {
+    "sql_generation": {"mode": "auto", "threshold": 1500},
+    "sql_repair": {"mode": "strong", "threshold": 0},
+    "sql_analysis": {"mode": "auto", "threshold": 2500},
+    "analysis": {"mode": "auto", "threshold": 2500},
+    "chat": {"mode": "auto", "threshold": 1500},
+    "summary": {"mode": "fast", "threshold": 0}
+}
+
+# คำที่บ่งบอกว่าคำถามต้องใช้การคิดหลายขั้น (เช่น join, เปรียบเทียบ, แนวโน้ม)
+COMPLEX_QUESTION_PATTERN = re.compile(
+    r"join|compare|comparison|trend|growth|ratio|percent|correlat|rank|versus|\bvs\b|"
+    r"เปรียบเทียบ|แนวโน้ม|อัตรา|เติบโต|สัดส่วน|เปอร์เซ็นต์|ร้อยละ|อันดับ|ความสัมพันธ์|เทียบ",
+    re.IGNORECASE
+)
+# คะแนนที่บวกเพิ่มต่อคำที่บ่งบอกความซับซ้อนหนึ่งคำ (token)
+COMPLEX_KEYWORD_WEIGHT = 500
+
+def _routes_from_env():
+    """โหลดการตั้งค่าแต่ละงานจาก MODEL_ROUTE_<TASK> และ MODEL_ROUTE_<TASK>_THRESHOLD"""
+    routes = {}
+    for task, defaults in DEFAULT_ROUTES.items():
+        prefix = f"MODEL_ROUTE_{task.upper()}"
+        routes[task] = {
+            "mode": os.getenv(prefix, defaults["mode"]),
+            "threshold": int(os.getenv(f"{prefix}_THRESHOLD", str(defaults["threshold"])))
+        }
+    return routes
+
+def usage_value(usage, name):
+    """
+    อ่านค่าจาก usage ซึ่งอาจเป็น object หรือ dict
+
+    openai==1.3.5 ยังไม่มีฟิลด์ usage ใน ChatCompletionChunk จึงเก็บ usage ของ stream ไว้เป็น dict
+    """
+    if isinstance(usage, dict):
+        return usage.get(name)
+    return getattr(usage, name, None)
+
+def cached_prompt_tokens(usage):
+    """จำนวน input token ที่ได้จาก prompt cache (usage.prompt_tokens_details.cached_tokens)"""
+    return usage_value(usage_value(usage, "prompt_tokens_details"), "cached_tokens") or 0
+
+class ModelRoute:
+    """ผลการเลือก model สำหรับการเรียก API หนึ่งครั้ง"""
+
+    def __init__(self, task, tier, model, score):
+        self.task = task
+        self.tier = tier
+        self.model = model
+        self.score = score
+
+    @property
+    def name(self):
+        return f"{self.task}.{self.tier}"
+
+class ModelRouter:
+    """
+    เลือก model ตามประเภทงานและความซับซ้อนที่ประมาณได้
+
+    ความซับซ้อนวัดเป็นจำนวน token ของข้อมูลที่ส่งให้ AI (เช่น โครงสร้างฐานข้อมูล ผลลัพธ์ ประวัติการสนทนา)
+    บวกคะแนนของคำที่บ่งบอกว่าคำถามยาก งานที่คะแนนต่ำกว่าเกณฑ์จะใช้ model ที่เร็วกว่า
+    """
+
+    def __init__(self, fast_model=MODEL_FAST, strong_model=MODEL_STRONG, routes=None):
+        self._lock = threading.Lock()
+        self.models = {"fast": fast_model, "strong": strong_model}
+        self.routes = routes or _routes_from_env()
+        self.prices = {**DEFAULT_MODEL_PRICES, **MODEL_PRICES}
+
+    def estimate_complexity(self, question="", *context):
+        """ประมาณความซับซ้อนเป็นจำนวน token ของคำถามและข้อมูลประกอบ"""
+        score = estimate_tokens(question or "")
+        for part in context:
+            if not part:
+                continue
+            if not isinstance(part, str):
+                part = json.dumps(part, ensure_ascii=False, default=str)
+            score += estimate_tokens(part)
+        score += COMPLEX_KEYWORD_WEIGHT * len(COMPLEX_QUESTION_PATTERN.findall(question or ""))
+        return score
+
+    def route(self, task, question="", *context):
+        """
+        เลือก model สำหรับงาน
+
+        Args:
+            task (str): ประเภทงาน (sql_generation, sql_repair, sql_analysis, analysis, chat, summary)
+            question (str): คำถามหรือข้อความของผู้ใช้
+            *context: ข้อมูลประกอบที่ส่งให้ AI (str, dict หรือ list)
+
+        Returns:
+            ModelRoute
+        """
+        with self._lock:
+            config = self.routes.get(task) or {"mode": "strong", "threshold": 0}
+            models = dict(self.models)
+        mode = config["mode"]
+        score = None
+        if mode == "auto":
+            score = self.estimate_complexity(question, *context)
+            tier = "strong" if score >= config["threshold"] else "fast"
+            model = models[tier]
+        elif mode in models:
+            tier = mode
+            model = models[mode]
+        else:
+            # ระบุชื่อ model โดยตรง
+            tier = "custom"
+            model = mode
+        metrics.increment(f"model_route.{task}.{tier}")
+        return ModelRoute(task, tier, model, score)
+
+    def record(self, route, latency_ms, usage=None):
+        """บันทึกเวลาและจำนวน token ที่ใช้ของแต่ละเส้นทาง"""
+        metrics.observe(f"model_route.{route.name}.latency", latency_ms)
+        if usage is not None:
+            self.record_usage(route, usage)
+
+    def record_usage(self, route, usage):
+        """บันทึกจำนวน token (รวมถึง token ที่ได้จาก prompt cache) และค่าใช้จ่ายโดยประมาณ"""
+        prompt_tokens = usage_value(usage, "prompt_tokens") or 0
+        completion_tokens = usage_value(usage, "completion_tokens") or 0
+        cached_tokens = cached_prompt_tokens(usage)
+        metrics.increment(f"model_route.{route.name}.prompt_tokens", prompt_tokens)
+        metrics.increment(f"model_route.{route.name}.cached_tokens", cached_tokens)
+        metrics.increment(f"model_route.{route.name}.completion_tokens", completion_tokens)
+        input_price, output_price = self.prices.get(route.model, [0, 0])
+        # เก็บค่าใช้จ่ายเป็นหน่วยไมโครดอลลาร์เพื่อให้เป็นจำนวนเต็ม
+        uncached_tokens = prompt_tokens - cached_tokens
+        cost = (
+            uncached_tokens * input_price
+            + cached_tokens * input_price * MODEL_CACHED_INPUT_PRICE_RATIO
+            + completion_tokens * output_price
+        )
+        metrics.increment(f"model_route.{route.name}.cost_microusd", int(round(cost)))
+
+    def get_config(self):
+        """การตั้งค่าปัจจุบัน"""
+        with self._lock:
+            return {
+                "models": dict(self.models),
+                "routes": {task: dict(config) for task, config in self.routes.items()}
+            }
+
+    def update_config(self, models=None, routes=None):
+        """
+        อัปเดตการตั้งค่าขณะทำงาน (มีผลกับ worker ปัจจุบันเท่านั้น)
+
+        Raises:
+            ValueError: ถ้าระบุประเภทงานที่ไม่รู้จัก หรือ mode/threshold ไม่ถูกต้อง
+        """
+        with self._lock:
+            new_models = dict(self.models)
+            for tier, model in (models or {}).items():
+                if tier not in new_models:
+                    raise ValueError(f"ไม่รู้จักระดับ model: {tier}")
+                if not model:
+                    raise ValueError(f"ต้องระบุชื่อ model สำหรับ {tier}")
+                new_models[tier] = model
+            new_routes = {task: dict(config) for task, config in self.routes.items()}
+            for task, config in (routes or {}).items():
+                if task not in new_routes:
+                    raise ValueError(f"ไม่รู้จักประเภทงาน: {task}")
+                if "mode" in config:
+                    if not config["mode"]:
+                        raise ValueError(f"ต้องระบุ mode สำหรับ {task}")
+                    new_routes[task]["mode"] = config["mode"]
+                if "threshold" in config:
+                    threshold = int(config["threshold"])
+                    if threshold < 0:
+                        raise ValueError("threshold ต้องไม่ติดลบ")
+                    new_routes[task]["threshold"] = threshold
+            self.models = new_models
+            self.routes = new_routes
+        logger.info(f"อัปเดตการเลือก model: {self.get_config()}")
+        return self.get_config()
+
+    def get_metrics(self):
+        """สรุปจำนวนครั้ง เวลา token สัดส่วน token จาก prompt cache และค่าใช้จ่ายโดยประมาณของแต่ละเส้นทาง"""
+        snapshot = metrics.snapshot()
+        result = {}
+        for name, value in snapshot["counters"].items():
+            if not name.startswith("model_route."):
+                continue
+            parts = name[len("model_route."):].split(".")
+            route_name = ".".join(parts[:2])
+            entry = result.setdefault(route_name, {"calls": 0})
+            if len(parts) == 2:
+                entry["calls"] = value
+            elif parts[2] == "cost_microusd":
+                entry["cost_usd"] = round(value / 1_000_000, 6)
+            else:
+                entry[parts[2]] = value
+        for route_name, entry in result.items():
+            entry["latency"] = snapshot["timings"].get(f"model_route.{route_name}.latency")
+            prompt_tokens = entry.get("prompt_tokens", 0)
+            entry["cached_token_ratio"] = round(entry.get("cached_tokens", 0) / prompt_tokens, 3) if prompt_tokens else None
+        return result
+
+# instance กลางที่ใช้ร่วมกันทั้งแอปพลิเคชัน
+model_router = ModelRouter()
@@ -3,10 +3,18 @@ from openai import OpenAI
 from dotenv import load_dotenv
 import pandas as pd
 import json
-from database import get_data_as_dataframe, get_data_from_database, get_database_schema, execute_sql_query
+from database import iter_data_frames, get_data_from_database, get_database_schema, execute_sql_query, CustomJSONEncoder
 import httpx
 import logging
 import re
+from prompt_store import PromptStore, PROMPTS_FILE
+from resilience import resilient_caller
+from chat_session import CHAT_SUMMARY_MAX_TOKENS
+from model_router import model_router, usage_value
+from admission import admission_controller
+from analysis_cache import analysis_cache
+import time
+import asyncio
 
 # ตั้งค่าการบันทึกล็อก
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -15,30 +23,82 @@ logger = logging.getLogger(__name__)
 # โหลดค่าจากไฟล์ .env
 load_dotenv()
 
-# สร้าง OpenAI client โดยไม่ใช้ proxies
+# การตั้งค่า connection pool ของ HTTP client ที่ใช้เรียก OpenAI API
+OPENAI_HTTP2 = os.getenv("OPENAI_HTTP2", "true").lower() == "true"
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "200"))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "100"))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "60"))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "5"))
+OPENAI_READ_TIMEOUT = float(os.getenv("OPENAI_READ_TIMEOUT", "60"))
+OPENAI_POOL_TIMEOUT = float(os.getenv("OPENAI_POOL_TIMEOUT", "10"))
+# ขอ usage ของคำขอแบบ stream (ปิดได้ถ้าใช้ endpoint ที่เข้ากันได้กับ OpenAI แต่ไม่รองรับ stream_options)
+OPENAI_STREAM_USAGE = os.getenv("OPENAI_STREAM_USAGE", "true").lower() == "true"
+
+def _http2_available():
+    """HTTP/2 ต้องติดตั้งแพ็กเกจ h2"""
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def create_http_client():
+    """สร้าง httpx.Client ที่ใช้ connection pool ร่วมกันสำหรับทุกคำขอไปยัง OpenAI API"""
+    http2 = OPENAI_HTTP2 and _http2_available()
+    if OPENAI_HTTP2 and not http2:
+        logger.warning("ไม่พบแพ็กเกจ h2 จะใช้ HTTP/1.1 แทน HTTP/2")
+    return httpx.Client(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY
+        ),
+        timeout=httpx.Timeout(
+            OPENAI_READ_TIMEOUT,
+            connect=OPENAI_CONNECT_TIMEOUT,
+            pool=OPENAI_POOL_TIMEOUT
+        )
+    )
+
+# OpenAI client ตัวเดียวที่ใช้ร่วมกันทั้งแอปพลิเคชัน สร้างตอนเริ่มแอปพลิเคชัน (lifespan) ไม่ใช่ตอน import
 api_key = os.getenv("OPENAI_API_KEY")
-client = OpenAI(api_key=api_key)
+_http_client = None
+_client = None
 
-class OpenAIService:
-    def __init__(self):
-        self.model = "gpt-4o"
-        self.max_tokens = 1000
-        self.temperature = 0.7
-        self.top_p = 1.0
-        self.frequency_penalty = 0.0
-        self.presence_penalty = 0.0
-        
-        # ตรวจสอบว่า API key ถูกตั้งค่าหรือไม่
-        if not api_key:
-            logger.error("ไม่พบ OPENAI_API_KEY ในไฟล์ .env กรุณาตรวจสอบการตั้งค่า")
-            self.client = None
-        else:
-            # ใช้ client ที่สร้างไว้แล้วที่ระดับโมดูล
-            self.client = client
-            logger.info("กำหนดค่า OpenAI client สำเร็จ")
-        
-        # คำแนะนำเริ่มต้นสำหรับ AI
-        self.default_sql_analysis_prompt = """คุณเป็นผู้เชี่ยวชาญในการวิเคราะห์ข้อมูลและตอบคำถามจากผลลัพธ์ของคำสั่ง SQL
+def open_openai_client():
+    """
+    สร้าง OpenAI client และ connection pool (เรียกตอนเริ่มแอปพลิเคชัน)
+
+    Returns:
+        OpenAI client ที่สร้าง หรือ None ถ้าไม่ได้ตั้งค่า OPENAI_API_KEY
+    """
+    global _http_client, _client
+    if _client is None and api_key:
+        _http_client = create_http_client()
+        # ปิด retry ภายในของ SDK เพราะ resilience layer จัดการ retry เอง
+        _client = OpenAI(api_key=api_key, http_client=_http_client, max_retries=0)
+        logger.info("สร้าง connection pool ของ OpenAI client เรียบร้อย")
+    return _client
+
+def get_openai_client():
+    """คืนค่า OpenAI client ที่เปิดไว้ (None ถ้ายังไม่ได้เปิดหรือปิดไปแล้ว)"""
+    return _client
+
+def close_openai_client():
+    """ปิด connection pool ของ OpenAI client ตัวเดียวกับที่เปิดไว้ (เรียกตอนปิดแอปพลิเคชัน)"""
+    global _http_client, _client
+    http_client, _http_client, _client = _http_client, None, None
+    if http_client is None:
+        return
+    try:
+        http_client.close()
+        logger.info("ปิด connection pool ของ OpenAI client เรียบร้อย")
+    except Exception as e:
+        logger.error(f"เกิดข้อผิดพลาดในการปิด OpenAI client: {str(e)}")
+
+# คำแนะนำเริ่มต้นสำหรับ AI
+DEFAULT_SQL_ANALYSIS_PROMPT = """คุณเป็นผู้เชี่ยวชาญในการวิเคราะห์ข้อมูลและตอบคำถามจากผลลัพธ์ของคำสั่ง SQL
 คุณจะได้รับคำถามภาษาธรรมชาติ, คำสั่ง SQL ที่ใช้, และผลลัพธ์จากการ execute คำสั่ง SQL
 งานของคุณคือวิเคราะห์ผลลัพธ์และตอบคำถามให้ชัดเจน เข้าใจง่าย และมีรายละเอียดเชิงลึก
 
@@ -52,35 +112,108 @@ class OpenAIService:
 7. ถ้ามีหลายข้อมูล ให้สรุปประเด็นสำคัญให้เข้าใจง่าย และเรียงลำดับความสำคัญ
 8. ตอบให้ครบถ้วนและตรงประเด็นกับคำถามที่ถาม
 9. เพิ่มการวิเคราะห์เชิงลึกที่อาจเป็นประโยชน์ต่อผู้ใช้ เช่น แนวโน้มที่น่าสนใจ ข้อสังเกตพิเศษ หรือคำแนะนำที่เกี่ยวข้อง"""
+
+# ที่เก็บคำแนะนำในหน่วยความจำ ใช้ร่วมกันทุก instance ของ OpenAIService
+prompt_store = PromptStore(PROMPTS_FILE, {'sql_analysis_prompt': DEFAULT_SQL_ANALYSIS_PROMPT})
+prompt_store.start_watching()
+
+class SQLGenerationError(Exception):
+    """ไม่สามารถสร้างคำสั่ง SQL จากคำถามได้"""
+
+class OpenAIService:
+    def __init__(self):
+        # model เริ่มต้น (แต่ละงานจะเลือก model จริงผ่าน model_router)
+        self.model = model_router.models["strong"]
+        self.max_tokens = 1000
+        self.temperature = 0.7
+        self.top_p = 1.0
+        self.frequency_penalty = 0.0
+        self.presence_penalty = 0.0
         
-        # โหลดคำแนะนำจากฐานข้อมูลหรือไฟล์ (ถ้ามี)
-        self.load_prompts()
+        # ตรวจสอบว่า API key ถูกตั้งค่าหรือไม่
+        if not api_key:
+            logger.error("ไม่พบ OPENAI_API_KEY ในไฟล์ .env กรุณาตรวจสอบการตั้งค่า")
     
-    def load_prompts(self):
-        """โหลดคำแนะนำจากฐานข้อมูลหรือไฟล์"""
-        prompts = {'sql_analysis_prompt': self.default_sql_analysis_prompt}
-        try:
-            # ตรวจสอบว่ามีไฟล์ prompts.json หรือไม่
-            if os.path.exists('prompts.json'):
-                with open('prompts.json', 'r', encoding='utf-8') as f:
-                    loaded_prompts = json.load(f)
-                    if 'sql_analysis_prompt' in loaded_prompts:
-                        self.default_sql_analysis_prompt = loaded_prompts['sql_analysis_prompt']
-                        prompts['sql_analysis_prompt'] = loaded_prompts['sql_analysis_prompt']
-                        logger.info("โหลดคำแนะนำสำหรับ AI จากไฟล์ prompts.json สำเร็จ")
-        except Exception as e:
-            logger.error(f"เกิดข้อผิดพลาดในการโหลดคำแนะนำ: {str(e)}")
+    @property
+    def client(self):
+        """OpenAI client ที่ใช้ร่วมกัน (เปิดตอนเริ่มแอปพลิเคชันด้วย open_openai_client)"""
+        return _client
+    
+    def _create_completion(self, route=None, **kwargs):
+        """
+        เรียก chat.completions.create ผ่าน resilience layer (retry, circuit breaker, rate limit, hedging)
         
-        return prompts
+        ถ้าระบุ route (จาก model_router) จะใช้ model ของ route และบันทึกเวลา/token ของเส้นทางนั้น
+        สำหรับ stream เวลาที่บันทึกคือเวลาจนได้รับการตอบกลับครั้งแรก
+        """
+        if not self.client:
+            raise RuntimeError("OpenAI client ไม่ได้ถูกกำหนดค่า")
+        if route is not None:
+            kwargs['model'] = route.model
+        if kwargs.get('stream') and OPENAI_STREAM_USAGE:
+            # ให้ stream ส่ง usage (รวมถึง cached_tokens) มาใน chunk สุดท้าย
+            extra_body = dict(kwargs.get('extra_body') or {})
+            extra_body['stream_options'] = {'include_usage': True}
+            kwargs['extra_body'] = extra_body
+        # ประมาณจำนวน token คร่าวๆ (ประมาณ 4 ตัวอักษรต่อ token) สำหรับ token bucket
+        prompt_chars = sum(len(message.get('content') or '') for message in kwargs.get('messages', []))
+        estimated_tokens = prompt_chars // 4 + kwargs.get('max_tokens', self.max_tokens)
+        started = time.perf_counter()
+        response = resilient_caller.call(
+            lambda: self.client.chat.completions.create(**kwargs),
+            estimated_tokens=estimated_tokens,
+            hedge=not kwargs.get('stream', False),
+            stream=bool(kwargs.get('stream', False))
+        )
+        if kwargs.get('stream'):
+            if route is not None:
+                model_router.record(route, (time.perf_counter() - started) * 1000)
+            return self._stream_with_usage(response, route)
+        usage = getattr(response, 'usage', None)
+        if route is not None:
+            model_router.record(route, (time.perf_counter() - started) * 1000, usage)
+        self._charge_usage(usage)
+        return response
+    
+    def _charge_usage(self, usage):
+        if usage is not None:
+            # หักโควตา token ของผู้ใช้ที่ส่งคำขอนี้
+            admission_controller.charge_tokens(usage_value(usage, 'total_tokens') or 0)
+    
+    def _stream_with_usage(self, stream, route):
+        """
+        ส่งต่อ chunk ของ stream และบันทึก usage จาก chunk สุดท้าย
+        
+        chunk ที่มีแต่ usage จะไม่มี choices จึงไม่ถูกส่งต่อให้ผู้เรียก
+        """
+        for chunk in stream:
+            # usage เป็น dict ใน openai==1.3.5 (ดู usage_value)
+            usage = getattr(chunk, 'usage', None)
+            if usage is not None:
+                if route is not None:
+                    model_router.record_usage(route, usage)
+                self._charge_usage(usage)
+            if chunk.choices:
+                yield chunk
+    
+    @property
+    def default_sql_analysis_prompt(self):
+        """คำแนะนำสำหรับการวิเคราะห์ผลลัพธ์ SQL ที่ใช้อยู่ในปัจจุบัน"""
+        return prompt_store.get('sql_analysis_prompt', DEFAULT_SQL_ANALYSIS_PROMPT)
+    
+    @property
+    def prompt_version(self):
+        """เวอร์ชันของคำแนะนำที่ใช้อยู่ในปัจจุบัน"""
+        return prompt_store.version
+    
+    def load_prompts(self):
+        """ดึงคำแนะนำจาก prompt store ในหน่วยความจำ (ไม่มีการอ่านไฟล์)"""
+        return prompt_store.all()
     
     def save_prompts(self, sql_analysis_prompt):
-        """บันทึกคำแนะนำลงในไฟล์"""
+        """บันทึกคำแนะนำลงใน prompt store (เขียนลงไฟล์แบบ atomic)"""
         try:
-            prompts = {'sql_analysis_prompt': sql_analysis_prompt}
-            with open('prompts.json', 'w', encoding='utf-8') as f:
-                json.dump(prompts, f, ensure_ascii=False, indent=2)
-            self.default_sql_analysis_prompt = sql_analysis_prompt
-            logger.info("บันทึกคำแนะนำสำหรับ AI ลงในไฟล์ prompts.json สำเร็จ")
+            prompt_store.update(sql_analysis_prompt=sql_analysis_prompt)
             return True
         except Exception as e:
             logger.error(f"เกิดข้อผิดพลาดในการบันทึกคำแนะนำ: {str(e)}")
@@ -90,20 +223,27 @@ class OpenAIService:
         """
         ดึงข้อมูลจากฐานข้อมูลและเตรียมข้อมูลสำหรับส่งให้ OpenAI
         """
-        df = get_data_as_dataframe(category)
-        if df.empty:
+        # อ่านเฉพาะคอลัมน์ที่ส่งให้ AI ทีละ chunk และแปลงแต่ละ chunk เป็น JSON ในครั้งเดียว (ไม่วนทีละแถว)
+        parts = []
+        try:
+            for frame in iter_data_frames(category, columns=('title', 'content', 'category')):
+                if not frame.empty:
+                    parts.append(frame.to_json(orient='records', force_ascii=False)[1:-1])
+        except Exception as e:
+            logger.error(f"เกิดข้อผิดพลาดในการดึงข้อมูลจากฐานข้อมูล: {str(e)}")
+            parts = []
+        if not parts:
             return "ไม่พบข้อมูลในฐานข้อมูล"
         
-        # แปลงข้อมูลเป็น JSON เพื่อส่งให้ AI
-        data_list = []
-        for _, row in df.iterrows():
-            data_list.append({
-                'title': row['title'],
-                'content': row['content'],
-                'category': row['category']
-            })
-        
-        return json.dumps(data_list, ensure_ascii=False)
+        # ต่อ JSON ของแต่ละ chunk เป็น array เดียวเพื่อส่งให้ AI
+        return '[' + ','.join(parts) + ']'
+    
+    def build_database_context_messages(self, question, db_data):
+        """สร้างข้อความสำหรับตอบคำถามจากข้อมูลในฐานข้อมูล (ข้อมูลอยู่ใน system message ส่วนคำถามอยู่ท้ายสุด)"""
+        return [
+            {"role": "system", "content": f"คุณเป็นผู้ช่วยที่ช่วยดึงข้อมูลจาก Database\nข้อมูลที่ดึงมาจาก Database: {db_data}"},
+            {"role": "user", "content": f"User ถามว่า: {question}\nให้ AI สรุปคำตอบให้สั้นและชัดเจน:"}
+        ]
     
     def analyze_data(self, query, category=None, callback=None):
         """
@@ -120,22 +260,16 @@ class OpenAIService:
         # ดึงข้อมูลจากฐานข้อมูลในรูปแบบ JSON
         db_data = self.prepare_context_from_database(category)
         
-        # สร้าง prompt ในรูปแบบเดียวกับตัวอย่าง JavaScript
-        prompt = f"User ถามว่า: {query}\nข้อมูลที่ดึงมาจาก Database: {db_data}\nให้ AI สรุปคำตอบให้สั้นและชัดเจน:"
-        
-        system_prompt = "คุณเป็นผู้ช่วยที่ช่วยดึงข้อมูลจาก Database"
-        
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": prompt}
-        ]
+        # ข้อมูลจากฐานข้อมูลอยู่ใน system message ก่อนคำถาม เพื่อให้ส่วนต้นของ prompt เหมือนกันทุกคำถาม
+        messages = self.build_database_context_messages(query, db_data)
+        route = model_router.route("analysis", query, db_data)
         
         try:
             if callback:
                 # ถ้ามี callback ให้ใช้ stream mode
                 full_response = ""
-                stream = self.client.chat.completions.create(
-                    model=self.model,
+                stream = self._create_completion(
+                    route=route,
                     messages=messages,
                     max_tokens=self.max_tokens,
                     temperature=self.temperature,
@@ -154,8 +288,8 @@ class OpenAIService:
                 return full_response
             else:
                 # ถ้าไม่มี callback ให้ใช้ non-stream mode
-                response = self.client.chat.completions.create(
-                    model=self.model,
+                response = self._create_completion(
+                    route=route,
                     messages=messages,
                     max_tokens=self.max_tokens,
                     temperature=self.temperature,
@@ -172,7 +306,7 @@ class OpenAIService:
                 callback(error_message)
             return error_message
     
-    def chat_with_bot(self, user_message, conversation_history=None, callback=None):
+    def chat_with_bot(self, user_message, conversation_history=None, callback=None, summary=None):
         """
         สนทนากับ AI โดยใช้ประวัติการสนทนา
         
@@ -180,6 +314,7 @@ class OpenAIService:
             user_message: ข้อความจากผู้ใช้
             conversation_history: ประวัติการสนทนา (ไม่บังคับ)
             callback: ฟังก์ชันที่จะถูกเรียกเมื่อได้รับข้อความแต่ละส่วน
+            summary: บทสรุปของการสนทนาก่อนหน้าที่ไม่ได้ส่งมาแบบเต็มข้อความ (ไม่บังคับ)
         
         Returns:
             ข้อความตอบกลับจาก AI
@@ -193,19 +328,24 @@ class OpenAIService:
             {"role": "system", "content": system_prompt}
         ]
         
+        # เพิ่มบทสรุปของการสนทนาก่อนหน้า
+        if summary:
+            messages.append({"role": "system", "content": f"สรุปการสนทนาก่อนหน้า:\n{summary}"})
+        
         # เพิ่มประวัติการสนทนา
         for message in conversation_history:
             messages.append(message)
         
         # เพิ่มข้อความล่าสุดของผู้ใช้
         messages.append({"role": "user", "content": user_message})
+        route = model_router.route("chat", user_message, summary, conversation_history)
         
         try:
             if callback:
                 # ถ้ามี callback ให้ใช้ stream mode
                 full_response = ""
-                stream = self.client.chat.completions.create(
-                    model=self.model,
+                stream = self._create_completion(
+                    route=route,
                     messages=messages,
                     max_tokens=self.max_tokens,
                     temperature=self.temperature,
@@ -224,8 +364,8 @@ class OpenAIService:
                 return full_response
             else:
                 # ถ้าไม่มี callback ให้ใช้ non-stream mode
-                response = self.client.chat.completions.create(
-                    model=self.model,
+                response = self._create_completion(
+                    route=route,
                     messages=messages,
                     max_tokens=self.max_tokens,
                     temperature=self.temperature,
@@ -242,6 +382,37 @@ class OpenAIService:
                 callback(error_message)
             return error_message
             
+    def summarize_conversation(self, previous_summary, messages):
+        """
+        สรุปข้อความเก่าของการสนทนาต่อจากบทสรุปเดิม (ใช้กับการบีบอัดประวัติการสนทนา)
+        
+        Args:
+            previous_summary (str): บทสรุปเดิม (อาจว่างเปล่า)
+            messages (list): ข้อความที่ต้องการสรุปเพิ่ม
+        
+        Returns:
+            str: บทสรุปใหม่
+        """
+        transcript = "\n".join(f"{message.get('role')}: {message.get('content')}" for message in messages)
+        prompt = f"""บทสรุปการสนทนาเดิม:
+{previous_summary or '(ยังไม่มี)'}
+
+ข้อความเพิ่มเติม:
+{transcript}
+
+สรุปการสนทนาทั้งหมดให้กระชับ เก็บข้อเท็จจริง ชื่อ ตัวเลข และความต้องการของผู้ใช้ที่สำคัญไว้ให้ครบ:"""
+        
+        response = self._create_completion(
+            route=model_router.route("summary", "", transcript),
+            messages=[
+                {"role": "system", "content": "คุณเป็นผู้ช่วยที่สรุปบทสนทนาอย่างกระชับและแม่นยำ"},
+                {"role": "user", "content": prompt}
+            ],
+            max_tokens=CHAT_SUMMARY_MAX_TOKENS,
+            temperature=0.2
+        )
+        return response.choices[0].message.content.strip()
+    
     def ask_ai_with_db_data(self, question, category=None, callback=None):
         """
         ฟังก์ชันใหม่ที่ทำงานคล้ายกับ askAI ในตัวอย่าง JavaScript
@@ -276,18 +447,16 @@ class OpenAIService:
             logger.warning("ไม่พบข้อมูลในฐานข้อมูล")
         
         # สร้าง prompt
-        prompt = f"User ถามว่า: {question}\nข้อมูลที่ดึงมาจาก Database: {json.dumps(db_data, ensure_ascii=False)}\nให้ AI สรุปคำตอบให้สั้นและชัดเจน:"
+        messages = self.build_database_context_messages(question, json.dumps(db_data, ensure_ascii=False))
+        route = model_router.route("analysis", question, db_data)
         
         try:
             if callback:
                 # ถ้ามี callback ให้ใช้ stream mode
                 full_response = ""
-                stream = self.client.chat.completions.create(
-                    model=self.model,
-                    messages=[
-                        {"role": "system", "content": "คุณเป็นผู้ช่วยที่ช่วยดึงข้อมูลจาก Database"},
-                        {"role": "user", "content": prompt}
-                    ],
+                stream = self._create_completion(
+                    route=route,
+                    messages=messages,
                     max_tokens=self.max_tokens,
                     temperature=self.temperature,
                     stream=True
@@ -302,12 +471,9 @@ class OpenAIService:
                 return full_response
             else:
                 # ถ้าไม่มี callback ให้ใช้ non-stream mode
-                response = self.client.chat.completions.create(
-                    model=self.model,
-                    messages=[
-                        {"role": "system", "content": "คุณเป็นผู้ช่วยที่ช่วยดึงข้อมูลจาก Database"},
-                        {"role": "user", "content": prompt}
-                    ],
+                response = self._create_completion(
+                    route=route,
+                    messages=messages,
                     max_tokens=self.max_tokens,
                     temperature=self.temperature
                 )
@@ -319,92 +485,198 @@ class OpenAIService:
                 callback(error_message)
             return error_message
     
-    def generate_sql_from_question(self, question, schema, db_type="mysql"):
+    def build_sql_generation_messages(self, question, schema, db_type="mysql"):
         """
-        สร้างคำสั่ง SQL จากคำถามภาษาธรรมชาติ
+        สร้างข้อความสำหรับ AI ในการสร้างคำสั่ง SQL จากคำถาม
         
-        Args:
-            question (str): คำถามภาษาธรรมชาติ
-            schema (dict): โครงสร้างฐานข้อมูล
-            db_type (str): ประเภทฐานข้อมูล (mysql, postgresql, mongodb)
-            
-        Returns:
-            str: คำสั่ง SQL ที่สร้างขึ้น
+        คำแนะนำและโครงสร้างฐานข้อมูลซึ่งเหมือนกันทุกคำถามอยู่ใน system message ต้นสุด
+        เพื่อให้ OpenAI ใช้ prompt cache ได้ ส่วนคำถามอยู่ใน user message ท้ายสุด
         """
-        try:
-            logger.info(f"กำลังสร้างคำสั่ง SQL จากคำถาม: {question}")
-            logger.info(f"ประเภทฐานข้อมูล: {db_type}")
-            
-            if not self.client:
-                logger.error("OpenAI client ไม่ได้ถูกกำหนดค่า")
-                return "SELECT 'OpenAI client ไม่ได้ถูกกำหนดค่า' AS error"
-            
-            # สร้างคำแนะนำสำหรับแต่ละประเภทฐานข้อมูล
-            db_specific_instructions = ""
-            if db_type.lower() == "mysql":
-                db_specific_instructions = """
+        # สร้างคำแนะนำสำหรับแต่ละประเภทฐานข้อมูล
+        db_specific_instructions = ""
+        if db_type.lower() == "mysql":
+            db_specific_instructions = """
                 - ใช้ไวยากรณ์ SQL ที่เข้ากันได้กับ MySQL
                 - สามารถใช้ฟังก์ชันเฉพาะของ MySQL เช่น DATE_FORMAT, CONCAT_WS, GROUP_CONCAT ได้
                 - ใช้ backticks (`) สำหรับชื่อตาราง/คอลัมน์ที่เป็นคำสงวน
                 """
-            elif db_type.lower() == "postgresql":
-                db_specific_instructions = """
+        elif db_type.lower() == "postgresql":
+            db_specific_instructions = """
                 - ใช้ไวยากรณ์ SQL ที่เข้ากันได้กับ PostgreSQL
                 - สามารถใช้ฟังก์ชันเฉพาะของ PostgreSQL เช่น to_char, string_agg, array_agg ได้
                 - ใช้ double quotes (") สำหรับชื่อตาราง/คอลัมน์ที่เป็นคำสงวน
                 - ใช้ ILIKE แทน LIKE สำหรับการค้นหาแบบไม่คำนึงถึงตัวพิมพ์ใหญ่-เล็ก
                 """
-            elif db_type.lower() == "mongodb":
-                db_specific_instructions = """
+        elif db_type.lower() == "mongodb":
+            db_specific_instructions = """
                 - ใช้ MongoDB Query Language แทน SQL
                 - เขียนในรูปแบบ JavaScript เพื่อใช้กับ MongoDB
                 - ใช้ $match, $group, $sort, $project สำหรับการสร้างคำสั่ง aggregation
                 - ตัวอย่าง: db.collection.find({field: value}) หรือ db.collection.aggregate([{$match: {field: value}}, {$group: {_id: "$field", count: {$sum: 1}}}])
                 """
-            
-            # สร้างคำแนะนำสำหรับ AI
-            prompt = f"""คุณเป็นผู้เชี่ยวชาญในการสร้างคำสั่ง SQL จากคำถามภาษาธรรมชาติ
-            
-โครงสร้างฐานข้อมูล:
-{json.dumps(schema, indent=2, ensure_ascii=False)}
-
-คำถาม: {question}
-
-ประเภทฐานข้อมูล: {db_type}
-
-คำแนะนำเฉพาะสำหรับฐานข้อมูล {db_type}:
-{db_specific_instructions}
+        
+        # เรียง key ของโครงสร้างฐานข้อมูลเพื่อให้ข้อความเหมือนเดิมทุกครั้ง
+        system_prompt = f"""คุณเป็นผู้เชี่ยวชาญในการสร้างคำสั่ง SQL จากคำถามภาษาธรรมชาติ
 
 คำแนะนำทั่วไป:
-1. สร้างคำสั่ง SQL ที่ตอบคำถามข้างต้น
+1. สร้างคำสั่ง SQL ที่ตอบคำถามของผู้ใช้
 2. ใช้โครงสร้างฐานข้อมูลที่ให้มาเพื่อสร้างคำสั่ง SQL ที่ถูกต้อง
 3. ตรวจสอบความถูกต้องของชื่อตารางและคอลัมน์
 4. ใช้ JOIN เมื่อจำเป็นต้องเชื่อมโยงข้อมูลจากหลายตาราง
 5. ใช้ WHERE, GROUP BY, HAVING, ORDER BY ตามความเหมาะสม
 6. ตอบกลับเฉพาะคำสั่ง SQL เท่านั้น ไม่ต้องมีคำอธิบายหรือเครื่องหมาย ```
 
-สร้างคำสั่ง SQL (หรือ MongoDB Query) ที่เหมาะสมสำหรับคำถามนี้:"""
+ประเภทฐานข้อมูล: {db_type}
+
+คำแนะนำเฉพาะสำหรับฐานข้อมูล {db_type}:
+{db_specific_instructions}
+
+โครงสร้างฐานข้อมูล:
+{json.dumps(schema, indent=2, ensure_ascii=False, sort_keys=True)}"""
+        
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": f"คำถาม: {question}\n\nสร้างคำสั่ง SQL (หรือ MongoDB Query) ที่เหมาะสมสำหรับคำถามนี้:"}
+        ]
+    
+    def _clean_sql_response(self, content):
+        """ลบเครื่องหมาย ``` หรือ ```sql ออกจากคำตอบของ AI"""
+        return re.sub(r'^```sql\s*|^```\s*|```$', '', content.strip(), flags=re.MULTILINE).strip()
+    
+    def generate_sql_from_question(self, question, schema, db_type="mysql", temperature=0.1):
+        """
+        สร้างคำสั่ง SQL จากคำถามภาษาธรรมชาติ
+        
+        Args:
+            question (str): คำถามภาษาธรรมชาติ
+            schema (dict): โครงสร้างฐานข้อมูล
+            db_type (str): ประเภทฐานข้อมูล (mysql, postgresql, mongodb)
+            temperature (float): ค่า temperature ที่ใช้ในการสร้างคำสั่ง
+            
+        Returns:
+            str: คำสั่ง SQL ที่สร้างขึ้น
+        
+        Raises:
+            SQLGenerationError: ถ้าไม่สามารถสร้างคำสั่งได้ (ไม่คืนค่าคำสั่งปลอมที่จะถูกนำไปรันต่อ)
+        """
+        try:
+            logger.info(f"กำลังสร้างคำสั่ง SQL จากคำถาม: {question}")
+            logger.info(f"ประเภทฐานข้อมูล: {db_type}")
+            
+            if not self.client:
+                logger.error("OpenAI client ไม่ได้ถูกกำหนดค่า")
+                raise SQLGenerationError("OpenAI client ไม่ได้ถูกกำหนดค่า")
+            
+            # สร้างคำแนะนำสำหรับ AI
+            messages = self.build_sql_generation_messages(question, schema, db_type)
+            route = model_router.route("sql_generation", question, schema)
 
             # ส่งคำขอไปยัง OpenAI API
-            response = self.client.chat.completions.create(
-                model="gpt-4o",
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.1,
+            response = self._create_completion(
+                route=route,
+                messages=messages,
+                temperature=temperature,
                 max_tokens=500
             )
             
-            # ดึงคำตอบจาก API
-            sql_query = response.choices[0].message.content.strip()
-            
-            # ลบเครื่องหมาย ``` หรือ ```sql ถ้ามี
-            sql_query = re.sub(r'^```sql\s*|^```\s*|```$', '', sql_query, flags=re.MULTILINE).strip()
+            # ดึงคำตอบจาก API และลบเครื่องหมาย ``` หรือ ```sql ถ้ามี
+            sql_query = self._clean_sql_response(response.choices[0].message.content)
+            if not sql_query:
+                raise SQLGenerationError("AI ไม่ได้ส่งคำสั่ง SQL กลับมา")
             
             logger.info(f"สร้างคำสั่ง SQL สำเร็จ: {sql_query}")
             return sql_query
             
+        except SQLGenerationError:
+            raise
         except Exception as e:
             logger.error(f"เกิดข้อผิดพลาดในการสร้างคำสั่ง SQL: {str(e)}")
-            return f"SELECT 'เกิดข้อผิดพลาด: {str(e)}' AS error"
+            raise SQLGenerationError(f"ไม่สามารถสร้างคำสั่ง SQL ได้: {str(e)}") from e
+    
+    def repair_sql_query(self, question, schema, db_type, failed_sql, error_message):
+        """
+        ให้ AI แก้ไขคำสั่ง SQL ที่รันไม่ผ่าน โดยส่งข้อผิดพลาดจากฐานข้อมูลกลับไปให้
+        
+        Args:
+            question (str): คำถามภาษาธรรมชาติ
+            schema (dict): โครงสร้างฐานข้อมูล
+            db_type (str): ประเภทฐานข้อมูล
+            failed_sql (str): คำสั่ง SQL ที่รันไม่ผ่าน
+            error_message (str): ข้อผิดพลาดที่ได้รับจากฐานข้อมูล
+            
+        Returns:
+            str: คำสั่ง SQL ที่แก้ไขแล้ว
+        """
+        logger.info(f"กำลังแก้ไขคำสั่ง SQL ที่ผิดพลาด: {failed_sql}")
+        # ต่อท้ายบทสนทนาของการสร้างคำสั่ง จึงใช้ส่วนต้นของ prompt ร่วมกับการสร้างคำสั่งครั้งแรกได้
+        messages = self.build_sql_generation_messages(question, schema, db_type) + [
+            {"role": "assistant", "content": failed_sql},
+            {"role": "user", "content": f"""คำสั่งที่สร้างไว้ก่อนหน้านี้รันไม่ผ่าน
+
+ข้อผิดพลาดจากฐานข้อมูล:
+{error_message}
+
+กรุณาแก้ไขคำสั่งให้ถูกต้อง และตอบกลับเฉพาะคำสั่งที่แก้ไขแล้วเท่านั้น:"""}
+        ]
+        
+        response = self._create_completion(
+            route=model_router.route("sql_repair", question, schema, failed_sql),
+            messages=messages,
+            temperature=0.0,
+            max_tokens=500
+        )
+        sql_query = self._clean_sql_response(response.choices[0].message.content)
+        logger.info(f"แก้ไขคำสั่ง SQL สำเร็จ: {sql_query}")
+        return sql_query
+    
+    def get_analysis_db_instructions(self, db_type):
+        """คืนค่าคำแนะนำเฉพาะสำหรับแต่ละประเภทฐานข้อมูลที่ใช้ในการวิเคราะห์ผลลัพธ์"""
+        if db_type.lower() == "mysql":
+            return """
+                - คำนึงถึงว่าผลลัพธ์มาจากฐานข้อมูล MySQL
+                - ชื่อคอลัมน์อาจมีการใช้ backticks (`) ในคำสั่ง SQL
+                """
+        elif db_type.lower() == "postgresql":
+            return """
+                - คำนึงถึงว่าผลลัพธ์มาจากฐานข้อมูล PostgreSQL
+                - ชื่อคอลัมน์อาจมีการใช้ double quotes (") ในคำสั่ง SQL
+                """
+        elif db_type.lower() == "mongodb":
+            return """
+                - คำนึงถึงว่าผลลัพธ์มาจากฐานข้อมูล MongoDB
+                - ผลลัพธ์อาจมีรูปแบบที่แตกต่างจาก SQL ทั่วไป เนื่องจาก MongoDB เป็นฐานข้อมูลแบบ NoSQL
+                """
+        return ""
+    
+    def build_sql_analysis_system_prompt(self, db_type="mysql", prompt_template=None):
+        """
+        สร้าง system message สำหรับการวิเคราะห์ผลลัพธ์ (ส่วนที่ไม่ขึ้นกับคำถามและผลลัพธ์)
+        
+        ส่วนนี้เหมือนกันทุกคำขอที่ใช้ฐานข้อมูลประเภทเดียวกัน จึงอยู่ต้น prompt เพื่อให้ใช้ prompt cache ได้
+        """
+        if prompt_template is None:
+            prompt_template = self.default_sql_analysis_prompt
+        return f"""คุณเป็นผู้เชี่ยวชาญในการวิเคราะห์ข้อมูลและการตอบคำถามจากผลลัพธ์ SQL
+
+{prompt_template}
+
+ประเภทฐานข้อมูล: {db_type}
+
+คำแนะนำเฉพาะสำหรับฐานข้อมูล {db_type}:
+{self.get_analysis_db_instructions(db_type)}"""
+    
+    def build_sql_analysis_messages(self, system_prompt, question, sql_query, result_json):
+        """ต่อคำถาม คำสั่ง SQL และผลลัพธ์ไว้ท้าย system message ของการวิเคราะห์"""
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": f"""คำถาม: {question}
+
+คำสั่ง SQL ที่ใช้: {sql_query}
+
+ผลลัพธ์: {result_json}
+
+กรุณาวิเคราะห์ผลลัพธ์และตอบคำถามข้างต้น:"""}
+        ]
     
     def analyze_sql_result(self, question, sql_query, result_data, db_type="mysql", callback=None):
         """
@@ -432,58 +704,35 @@ class OpenAIService:
             # แปลงผลลัพธ์เป็น JSON
             result_json = json.dumps(result_data, ensure_ascii=False, cls=CustomJSONEncoder)
             
-            # สร้างคำแนะนำเฉพาะสำหรับแต่ละประเภทฐานข้อมูล
-            db_specific_instructions = ""
-            if db_type.lower() == "mysql":
-                db_specific_instructions = """
-                - คำนึงถึงว่าผลลัพธ์มาจากฐานข้อมูล MySQL
-                - ชื่อคอลัมน์อาจมีการใช้ backticks (`) ในคำสั่ง SQL
-                """
-            elif db_type.lower() == "postgresql":
-                db_specific_instructions = """
-                - คำนึงถึงว่าผลลัพธ์มาจากฐานข้อมูล PostgreSQL
-                - ชื่อคอลัมน์อาจมีการใช้ double quotes (") ในคำสั่ง SQL
-                """
-            elif db_type.lower() == "mongodb":
-                db_specific_instructions = """
-                - คำนึงถึงว่าผลลัพธ์มาจากฐานข้อมูล MongoDB
-                - ผลลัพธ์อาจมีรูปแบบที่แตกต่างจาก SQL ทั่วไป เนื่องจาก MongoDB เป็นฐานข้อมูลแบบ NoSQL
-                """
-            
             # โหลดคำแนะนำจากไฟล์
+            prompt_version = self.prompt_version
             prompt_template = self.load_prompts().get("sql_analysis_prompt", "")
             
             # สร้างคำแนะนำสำหรับ AI
-            prompt = f"""คุณเป็นผู้เชี่ยวชาญในการวิเคราะห์ข้อมูลและการตอบคำถามจากผลลัพธ์ SQL
-
-คำถาม: {question}
-
-คำสั่ง SQL ที่ใช้: {sql_query}
-
-ประเภทฐานข้อมูล: {db_type}
-
-คำแนะนำเฉพาะสำหรับฐานข้อมูล {db_type}:
-{db_specific_instructions}
-
-ผลลัพธ์: {result_json}
-
-{prompt_template}
-
-กรุณาวิเคราะห์ผลลัพธ์และตอบคำถามข้างต้น:"""
+            system_prompt = self.build_sql_analysis_system_prompt(db_type, prompt_template)
+            messages = self.build_sql_analysis_messages(system_prompt, question, sql_query, result_json)
+            route = model_router.route("sql_analysis", question, result_json)
+            cache_key = analysis_cache.make_key(question, result_json, db_type, prompt_version, route.model)
             
             # ส่งคำขอไปยัง OpenAI API
             if callback:
                 # ถ้ามี callback ให้ใช้ฟังก์ชัน analyze_sql_result_with_callback
-                return self.analyze_sql_result_with_callback(prompt, callback)
+                return self.analyze_sql_result_with_callback(messages, callback, route=route, cache_key=cache_key)
             else:
                 # ถ้าไม่มี callback ให้ใช้ non-streaming mode
-                response = self.client.chat.completions.create(
-                    model="gpt-4o",
-                    messages=[{"role": "user", "content": prompt}],
+                cached = analysis_cache.get(cache_key)
+                if cached is not None:
+                    logger.info("ใช้คำตอบการวิเคราะห์จาก cache")
+                    return cached
+                
+                response = self._create_completion(
+                    route=route,
+                    messages=messages,
                     temperature=0.7
                 )
                 
                 analysis = response.choices[0].message.content.strip()
+                analysis_cache.set(cache_key, analysis)
                 return analysis
             
         except Exception as e:
@@ -491,13 +740,15 @@ class OpenAIService:
             logger.error(error_message)
             return error_message
     
-    async def analyze_sql_result_with_callback(self, prompt, callback):
+    async def analyze_sql_result_with_callback(self, messages, callback, route=None, cache_key=None):
         """
         วิเคราะห์ผลลัพธ์จากการรันคำสั่ง SQL แบบ streaming และเรียกใช้ callback
         
         Args:
-            prompt (str): คำแนะนำสำหรับ AI
+            messages (list): ข้อความสำหรับ AI (จาก build_sql_analysis_messages)
             callback (callable): ฟังก์ชันที่จะถูกเรียกเมื่อได้รับข้อความแต่ละส่วน
+            route (ModelRoute, optional): model ที่เลือกไว้แล้ว (ถ้าไม่ระบุจะเลือกจากข้อความ)
+            cache_key (tuple, optional): key ของ analysis_cache สำหรับเก็บคำตอบเมื่อวิเคราะห์สำเร็จ
         
         Returns:
             str: การวิเคราะห์ผลลัพธ์
@@ -512,19 +763,30 @@ class OpenAIService:
                 
             # ถ้ามี callback ให้ใช้ streaming mode
             logger.info("เริ่มการวิเคราะห์ผลลัพธ์แบบ streaming")
-            stream = self.client.chat.completions.create(
-                model="gpt-4o",
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.7,
-                stream=True
-            )
+            loop = asyncio.get_running_loop()
+            if route is None:
+                route = model_router.route("sql_analysis", "", messages)
             
-            full_response = ""
-            for chunk in stream:
-                if chunk.choices[0].delta.content is not None:
-                    content = chunk.choices[0].delta.content
-                    full_response += content
-                    await callback(content)
+            # อ่าน stream ใน thread แยก เพื่อไม่ให้ event loop ถูกบล็อกระหว่างรอข้อความจาก OpenAI
+            def consume_stream():
+                stream = self._create_completion(
+                    route=route,
+                    messages=messages,
+                    temperature=0.7,
+                    stream=True
+                )
+                
+                full_response = ""
+                for chunk in stream:
+                    if chunk.choices[0].delta.content is not None:
+                        content = chunk.choices[0].delta.content
+                        full_response += content
+                        asyncio.run_coroutine_threadsafe(callback(content), loop).result()
+                # เก็บเฉพาะคำตอบที่ได้รับครบทั้งหมด
+                analysis_cache.set(cache_key, full_response)
+                return full_response
+            
+            full_response = await asyncio.to_thread(consume_stream)
             
             logger.info("การวิเคราะห์ผลลัพธ์แบบ streaming เสร็จสิ้น")
             return full_response
@@ -554,11 +816,12 @@ class OpenAIService:
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_message}
         ]
+        route = model_router.route("chat", user_message)
         
         try:
             full_response = ""
-            stream = self.client.chat.completions.create(
-                model=self.model,
+            stream = self._create_completion(
+                route=route,
                 messages=messages,
                 max_tokens=self.max_tokens,
                 temperature=self.temperature,
@@ -581,4 +844,14 @@ class OpenAIService:
             logger.error(error_message)
             if callback:
                 callback(error_message)
-            return error_message 
\ No newline at end of file
+            return error_message
+
+# instance กลางของ OpenAIService ที่ใช้ร่วมกันทุกคำขอ
+_shared_service = None
+
+def get_openai_service():
+    """คืนค่า OpenAIService ที่ใช้ร่วมกัน (สร้างครั้งแรกเมื่อถูกเรียก)"""
+    global _shared_service
+    if _shared_service is None:
+        _shared_service = OpenAIService()
+    return _shared_service
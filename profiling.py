@@ -0,0 +1,392 @@
+import os
+import re
+import json
+import hmac
+import time
+import uuid
+import random
+import asyncio
+import cProfile
+import pstats
+import logging
+import threading
+import contextvars
+import importlib.util
+from collections import deque
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from cache import app_cache
+from metrics import metrics
+
+# ตั้งค่าการบันทึกล็อก
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# โหลดค่าจากไฟล์ .env
+load_dotenv()
+
+# token ของผู้ดูแลสำหรับสั่ง profile (ว่าง = ปิดการ profile ตามคำขอและตามช่วงเวลา)
+PROFILING_ADMIN_TOKEN = os.getenv("PROFILING_ADMIN_TOKEN", "")
+# header ที่ส่ง token ของผู้ดูแล คำขอที่มี token ถูกต้องจะถูก profile และได้ชื่อไฟล์กลับมาใน X-Profile-Id
+PROFILING_HEADER = os.getenv("PROFILING_HEADER", "X-Profile-Token")
+# ตัว profile: pyinstrument (sampling, ค่าเริ่มต้นเมื่อติดตั้งไว้) หรือ cprofile
+PROFILING_BACKEND = os.getenv("PROFILING_BACKEND", "pyinstrument" if importlib.util.find_spec("pyinstrument") else "cprofile")
+# ระยะห่างของการเก็บตัวอย่าง stack ของ pyinstrument (วินาที)
+PROFILING_INTERVAL = float(os.getenv("PROFILING_INTERVAL", "0.001"))
+# โฟลเดอร์ที่เก็บไฟล์ profile และจำนวนไฟล์สูงสุด (ลบไฟล์เก่าที่สุดเมื่อเกิน)
+PROFILING_OUTPUT_DIR = os.getenv("PROFILING_OUTPUT_DIR", "profiles")
+PROFILING_MAX_FILES = int(os.getenv("PROFILING_MAX_FILES", "200"))
+# ช่วงเวลา profile นานสุดที่สั่งได้ต่อครั้ง (วินาที)
+PROFILING_MAX_WINDOW = int(os.getenv("PROFILING_MAX_WINDOW", "600"))
+# คำขอที่ใช้เวลานานกว่านี้ (มิลลิวินาที) จะถูกบันทึกล็อกเป็นคำขอช้า (0 = ปิด)
+SLOW_REQUEST_THRESHOLD_MS = float(os.getenv("SLOW_REQUEST_THRESHOLD_MS", "0"))
+# สัดส่วนของคำขอที่ถูก profile ไว้ก่อน และเก็บไฟล์เฉพาะเมื่อช้ากว่า SLOW_REQUEST_THRESHOLD_MS
+SLOW_REQUEST_PROFILE_RATE = float(os.getenv("SLOW_REQUEST_PROFILE_RATE", "0.05"))
+
+NAMESPACE = "profiling"
+# อ่านสถานะช่วงเวลา profile จาก cache ร่วมไม่เกินหนึ่งครั้งต่อช่วงนี้ (วินาที)
+WINDOW_CHECK_INTERVAL = 1.0
+
+# profile ของคำขอที่กำลังทำงานใน context ปัจจุบัน (task ลูกของคำขอได้รับค่าเดียวกัน)
+_current_profile = contextvars.ContextVar("request_profile", default=None)
+
+class _PyinstrumentBackend:
+    """sampling profiler ที่มีผลต่อความเร็วน้อย บันทึกเป็นไฟล์ speedscope (flame graph ที่ https://www.speedscope.app)"""
+    name = "pyinstrument"
+    extension = ".speedscope.json"
+    # profile หลายคำขอพร้อมกันใน event loop เดียวกันได้
+    concurrent = True
+
+    def start(self, in_thread):
+        from pyinstrument import Profiler
+        # บน event loop นับเวลาเฉพาะของคำขอนี้ (await จะแสดงเป็นเวลารอ) ส่วนใน thread นับทั้ง thread
+        profiler = Profiler(interval=PROFILING_INTERVAL, async_mode="disabled" if in_thread else "enabled")
+        profiler.start()
+        return profiler
+
+    def stop(self, profiler):
+        return profiler.stop()
+
+    def write(self, path, main, threads, title):
+        from pyinstrument.renderers import SpeedscopeRenderer
+        names = ["event loop"] + [f"thread {index}" for index in range(1, len(threads) + 1)]
+        documents = [json.loads(SpeedscopeRenderer().render(session)) for session in [main, *threads]]
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(_merge_speedscope(documents, names, title), f, ensure_ascii=False)
+
+class _CProfileBackend:
+    """
+    deterministic profiler ในไลบรารีมาตรฐาน บันทึกเป็นไฟล์ pstats (.prof) ซึ่งเปิดเป็น flame graph ได้ด้วย
+    snakeviz หรือ flameprof
+
+    cProfile นับทุกอย่างที่ทำงานใน thread ระหว่างเปิดอยู่ จึง profile ได้ครั้งละหนึ่งคำขอต่อ worker
+    """
+    name = "cprofile"
+    extension = ".prof"
+    concurrent = False
+
+    def start(self, in_thread):
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    def stop(self, profiler):
+        profiler.disable()
+        return profiler
+
+    def write(self, path, main, threads, title):
+        stats = pstats.Stats(main)
+        for profiler in threads:
+            stats.add(profiler)
+        stats.dump_stats(path)
+
+def _merge_speedscope(documents, names, title):
+    """รวมไฟล์ speedscope หลายไฟล์เป็นไฟล์เดียว (หนึ่ง profile ต่อ thread)"""
+    frames = []
+    profiles = []
+    for document, name in zip(documents, names):
+        offset = len(frames)
+        frames.extend(document['shared']['frames'])
+        for profile in document['profiles']:
+            profile = dict(profile, name=name)
+            profile['events'] = [dict(event, frame=event['frame'] + offset) for event in profile['events']]
+            profiles.append(profile)
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "name": title,
+        "activeProfileIndex": 0,
+        "exporter": "ai-database-assistant",
+        "shared": {"frames": frames},
+        "profiles": profiles
+    }
+
+class _RequestProfile:
+    """profile ของคำขอหนึ่งรายการ (event loop และงานใน thread ที่คำขอส่งไปทำ)"""
+
+    def __init__(self, backend, reason, method, path):
+        self.id = f"{datetime.now():%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:8]}"
+        self.backend = backend
+        self.reason = reason
+        self.method = method
+        self.path = path
+        self._lock = threading.Lock()
+        self._threads = []
+        self._finished = False
+        self.main = backend.start(False)
+
+    def run_in_thread(self, fn, *args, **kwargs):
+        """รันงานใน thread พร้อม profile และเก็บผลรวมกับคำขอ"""
+        profiler = self.backend.start(True)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            result = self.backend.stop(profiler)
+            with self._lock:
+                if not self._finished:
+                    self._threads.append(result)
+
+    def stop(self):
+        self.main = self.backend.stop(self.main)
+        with self._lock:
+            # งานใน thread ที่ยังไม่จบหลังคำขอจบแล้วจะไม่ถูกรวม
+            self._finished = True
+            return list(self._threads)
+
+class ProfilingExecutor(ThreadPoolExecutor):
+    """
+    ThreadPoolExecutor ที่ profile งานใน thread ด้วย เมื่องานถูกส่งมาจากคำขอที่กำลังถูก profile
+
+    asyncio.to_thread และ run_in_executor เรียก submit ใน context ของ task ที่เรียก จึงรู้ว่างานเป็นของคำขอใด
+    (endpoint แบบ def ธรรมดาทำงานใน thread pool ของ anyio ซึ่งไม่ผ่าน executor นี้)
+    """
+
+    def submit(self, fn, /, *args, **kwargs):
+        profile = _current_profile.get()
+        if profile is not None:
+            return super().submit(profile.run_in_thread, fn, *args, **kwargs)
+        return super().submit(fn, *args, **kwargs)
+
+class RequestProfiler:
+    """
+    profile คำขอตามที่ผู้ดูแลสั่ง และบันทึกคำขอที่ช้า
+
+    คำขอถูก profile เมื่อ:
+    - ส่ง token ของผู้ดูแลมาใน PROFILING_HEADER (เฉพาะคำขอนั้น)
+    - อยู่ในช่วงเวลาที่ผู้ดูแลเปิดไว้ (เก็บใน cache ร่วมจึงมีผลกับทุก worker)
+    - ถูกสุ่มไว้ตาม SLOW_REQUEST_PROFILE_RATE โดยเก็บไฟล์เฉพาะเมื่อใช้เวลาเกิน SLOW_REQUEST_THRESHOLD_MS
+    """
+
+    def __init__(self, admin_token=PROFILING_ADMIN_TOKEN, backend=PROFILING_BACKEND, output_dir=PROFILING_OUTPUT_DIR,
+                 max_files=PROFILING_MAX_FILES, slow_threshold_ms=SLOW_REQUEST_THRESHOLD_MS,
+                 slow_profile_rate=SLOW_REQUEST_PROFILE_RATE):
+        self.admin_token = admin_token
+        self.header = PROFILING_HEADER.lower().encode('latin-1')
+        if backend == "pyinstrument" and importlib.util.find_spec("pyinstrument") is None:
+            logger.warning("ไม่พบแพ็กเกจ pyinstrument จะใช้ cProfile แทน")
+            backend = "cprofile"
+        self.backend = _PyinstrumentBackend() if backend == "pyinstrument" else _CProfileBackend()
+        self.output_dir = output_dir
+        self.max_files = max(1, max_files)
+        self.slow_threshold_ms = slow_threshold_ms
+        self.slow_profile_rate = slow_profile_rate if slow_threshold_ms > 0 else 0.0
+        self._window = None
+        self._window_checked = 0.0
+        self._active = 0
+        self._lock = threading.Lock()
+        self._slow_requests = deque(maxlen=50)
+
+    @property
+    def enabled(self):
+        """ต้องตรวจสอบคำขอหรือไม่ (มี token ของผู้ดูแล หรือเปิดการบันทึกคำขอช้า)"""
+        return bool(self.admin_token) or self.slow_threshold_ms > 0
+
+    def authorize(self, token):
+        """ตรวจสอบ token ของผู้ดูแล"""
+        if not self.admin_token or not token:
+            return False
+        if isinstance(token, str):
+            token = token.encode('utf-8')
+        return hmac.compare_digest(token, self.admin_token.encode('utf-8'))
+
+    async def select(self, scope):
+        """เลือกว่าจะ profile คำขอนี้หรือไม่ คืนค่าเหตุผล (header, window, slow) หรือ None"""
+        path = scope.get('path', '')
+        if path.startswith('/api/profiling'):
+            return None
+        if self.admin_token:
+            for name, value in scope.get('headers', ()):
+                if name == self.header:
+                    if self.authorize(value):
+                        return "header"
+                    break
+            window = await self._current_window()
+            if window and path.startswith(window.get('path_prefix') or '/') and random.random() < window.get('sample_rate', 1.0):
+                return "window"
+        if self.slow_profile_rate and random.random() < self.slow_profile_rate:
+            return "slow"
+        return None
+
+    def begin(self, reason, scope):
+        """เริ่ม profile คำขอ คืนค่า None ถ้า profile พร้อมกันไม่ได้ (cProfile)"""
+        with self._lock:
+            if self._active and not self.backend.concurrent:
+                metrics.increment("profiling.skipped")
+                return None
+            self._active += 1
+        try:
+            return _RequestProfile(self.backend, reason, scope.get('method', ''), scope.get('path', ''))
+        except Exception as e:
+            with self._lock:
+                self._active -= 1
+            logger.error(f"ไม่สามารถเริ่ม profile คำขอ: {str(e)}")
+            return None
+
+    async def finish(self, profile, scope, duration_ms):
+        """บันทึกคำขอช้า และเขียนไฟล์ profile ที่ต้องเก็บ"""
+        slow = self.slow_threshold_ms > 0 and duration_ms >= self.slow_threshold_ms
+        if slow:
+            metrics.increment("profiling.slow_requests")
+            self._slow_requests.append({
+                "method": scope.get('method', ''),
+                "path": scope.get('path', ''),
+                "duration_ms": round(duration_ms, 1),
+                "at": datetime.now().isoformat(timespec='seconds'),
+                "profile": profile.id if profile is not None else None
+            })
+            logger.warning(f"คำขอช้า {scope.get('method', '')} {scope.get('path', '')} ใช้เวลา {duration_ms:.0f} ms")
+        if profile is None:
+            return
+        try:
+            threads = profile.stop()
+        finally:
+            with self._lock:
+                self._active -= 1
+        if profile.reason == "slow" and not slow:
+            metrics.increment("profiling.discarded")
+            return
+        await asyncio.to_thread(self._write, profile, threads, duration_ms)
+
+    def _write(self, profile, threads, duration_ms):
+        os.makedirs(self.output_dir, exist_ok=True)
+        slug = re.sub(r'[^A-Za-z0-9]+', '_', profile.path).strip('_') or 'root'
+        name = f"{profile.id}-{profile.method}-{slug[:60]}-{duration_ms:.0f}ms-{profile.reason}{self.backend.extension}"
+        title = f"{profile.method} {profile.path} ({duration_ms:.0f} ms)"
+        try:
+            self.backend.write(os.path.join(self.output_dir, name), profile.main, threads, title)
+        except Exception as e:
+            logger.error(f"ไม่สามารถบันทึกไฟล์ profile: {str(e)}")
+            return
+        metrics.increment(f"profiling.captured.{profile.reason}")
+        logger.info(f"บันทึก profile ของ {title} ที่ {name}")
+        self._prune()
+
+    def _prune(self):
+        """ลบไฟล์ profile เก่าที่สุดเมื่อเกินจำนวนที่กำหนด"""
+        profiles = self.list_profiles()
+        for entry in profiles[self.max_files:]:
+            try:
+                os.remove(os.path.join(self.output_dir, entry['name']))
+            except OSError:
+                pass
+
+    def list_profiles(self):
+        """ไฟล์ profile ที่เก็บไว้ (ใหม่สุดก่อน)"""
+        try:
+            entries = [entry for entry in os.scandir(self.output_dir) if entry.is_file()]
+        except FileNotFoundError:
+            return []
+        entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+        return [
+            {
+                "name": entry.name,
+                "size": entry.stat().st_size,
+                "created_at": datetime.fromtimestamp(entry.stat().st_mtime).isoformat(timespec='seconds')
+            } for entry in entries
+        ]
+
+    def profile_path(self, name):
+        """path ของไฟล์ profile จากชื่อไฟล์หรือ id (X-Profile-Id) หรือ None ถ้าไม่พบ"""
+        if not name or os.path.basename(name) != name:
+            return None
+        for entry in self.list_profiles():
+            if entry['name'] == name or entry['name'].startswith(f"{name}-"):
+                return os.path.join(self.output_dir, entry['name'])
+        return None
+
+    def start_window(self, duration_seconds, path_prefix=None, sample_rate=1.0):
+        """เปิดการ profile ทุกคำขอ (หรือตามสัดส่วน sample_rate) ที่ขึ้นต้นด้วย path_prefix เป็นเวลาที่กำหนด"""
+        duration_seconds = min(max(1, int(duration_seconds)), PROFILING_MAX_WINDOW)
+        window = {
+            "until": time.time() + duration_seconds,
+            "path_prefix": path_prefix or '/',
+            "sample_rate": min(max(0.0, float(sample_rate)), 1.0)
+        }
+        app_cache.set(NAMESPACE, "window", window, ttl=duration_seconds)
+        self._window = window
+        self._window_checked = time.monotonic()
+        logger.info(f"เปิดการ profile คำขอ {window['path_prefix']} เป็นเวลา {duration_seconds} วินาที")
+        return window
+
+    def stop_window(self):
+        """ปิดการ profile ตามช่วงเวลา"""
+        app_cache.delete(NAMESPACE, "window")
+        self._window = None
+        self._window_checked = time.monotonic()
+
+    async def _current_window(self):
+        if time.monotonic() - self._window_checked >= WINDOW_CHECK_INTERVAL:
+            self._window_checked = time.monotonic()
+            self._window = await asyncio.to_thread(app_cache.get, NAMESPACE, "window")
+        window = self._window
+        if window and window['until'] < time.time():
+            return None
+        return window
+
+    def status(self):
+        """การตั้งค่า ช่วงเวลาที่เปิดอยู่ และคำขอช้าล่าสุด"""
+        window = self._window if self._window and self._window['until'] >= time.time() else None
+        return {
+            "enabled": bool(self.admin_token),
+            "backend": self.backend.name,
+            "active": self._active,
+            "window": window,
+            "slow_request_threshold_ms": self.slow_threshold_ms,
+            "slow_request_profile_rate": self.slow_profile_rate,
+            "recent_slow_requests": list(self._slow_requests)
+        }
+
+class ProfilingMiddleware:
+    """ASGI middleware ที่ profile คำขอที่ถูกเลือก (รวมถึงเวลาส่ง stream จนจบ) และบันทึกคำขอที่ช้า"""
+
+    def __init__(self, app, profiler=None):
+        self.app = app
+        self.profiler = profiler or request_profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not self.profiler.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        reason = await self.profiler.select(scope)
+        profile = self.profiler.begin(reason, scope) if reason else None
+        context_token = _current_profile.set(profile) if profile is not None else None
+
+        async def send_with_profile_id(message):
+            if message['type'] == 'http.response.start' and profile is not None and profile.reason == "header":
+                message = dict(message, headers=[*message.get('headers', []), (b'x-profile-id', profile.id.encode('ascii'))])
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            if context_token is not None:
+                _current_profile.reset(context_token)
+            try:
+                await self.profiler.finish(profile, scope, (time.perf_counter() - started) * 1000)
+            except Exception as e:
+                logger.error(f"เกิดข้อผิดพลาดในการบันทึก profile: {str(e)}")
+
+# instance กลางที่ใช้ร่วมกันทั้งแอปพลิเคชัน
+request_profiler = RequestProfiler()
@@ -0,0 +1,131 @@
+import os
+import json
+import hashlib
+import logging
+import tempfile
+import threading
+from dotenv import load_dotenv
+
+# ตั้งค่าการบันทึกล็อก
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# โหลดค่าจากไฟล์ .env
+load_dotenv()
+
+# ไฟล์ที่ใช้เก็บคำแนะนำ และช่วงเวลา (วินาที) ในการตรวจสอบการเปลี่ยนแปลงของไฟล์
+PROMPTS_FILE = os.getenv("PROMPTS_FILE", "prompts.json")
+PROMPTS_RELOAD_INTERVAL = float(os.getenv("PROMPTS_RELOAD_INTERVAL", "2"))
+
+def _compute_version(prompts):
+    """คำนวณเวอร์ชันของคำแนะนำจากเนื้อหา (ใช้เป็นส่วนหนึ่งของ cache key ได้)"""
+    content = json.dumps(prompts, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()[:12]
+
+class PromptStore:
+    """
+    ที่เก็บคำแนะนำสำหรับ AI ในหน่วยความจำ
+
+    โหลดจากไฟล์ครั้งเดียว แล้วใช้ thread เบื้องหลังตรวจสอบ mtime ของไฟล์เป็นระยะ
+    เมื่อไฟล์เปลี่ยน (เช่น worker อื่นบันทึกคำแนะนำใหม่) จะโหลดใหม่และสลับ dict ทั้งก้อนแบบ atomic
+    การอ่านคำแนะนำจึงไม่มี file I/O บน request path
+    """
+
+    def __init__(self, path, defaults, reload_interval=PROMPTS_RELOAD_INTERVAL):
+        self.path = path
+        self.defaults = dict(defaults)
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._prompts = dict(self.defaults)
+        self._version = _compute_version(self._prompts)
+        self._mtime = None
+        self._stop_event = threading.Event()
+        self._watcher = None
+        self.reload()
+
+    @property
+    def version(self):
+        """เวอร์ชันของคำแนะนำปัจจุบัน"""
+        return self._version
+
+    def get(self, key, default=None):
+        """ดึงคำแนะนำตามชื่อ"""
+        return self._prompts.get(key, default)
+
+    def all(self):
+        """คืนค่าสำเนาของคำแนะนำทั้งหมด"""
+        return dict(self._prompts)
+
+    def _read_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def reload(self):
+        """โหลดคำแนะนำจากไฟล์และสลับเข้าไปแทนชุดเดิม"""
+        with self._lock:
+            mtime = self._read_mtime()
+            prompts = dict(self.defaults)
+            if mtime is not None:
+                try:
+                    with open(self.path, 'r', encoding='utf-8') as f:
+                        loaded_prompts = json.load(f)
+                    prompts.update({key: value for key, value in loaded_prompts.items() if isinstance(value, str)})
+                    logger.info(f"โหลดคำแนะนำสำหรับ AI จากไฟล์ {self.path} สำเร็จ")
+                except Exception as e:
+                    logger.error(f"เกิดข้อผิดพลาดในการโหลดคำแนะนำ: {str(e)}")
+                    return False
+            self._prompts = prompts
+            self._version = _compute_version(prompts)
+            self._mtime = mtime
+            return True
+
+    def update(self, **prompts):
+        """
+        อัปเดตคำแนะนำ: เขียนลงไฟล์แบบ atomic (เขียนไฟล์ชั่วคราวแล้ว rename) และสลับชุดในหน่วยความจำ
+        """
+        with self._lock:
+            new_prompts = dict(self._prompts)
+            new_prompts.update(prompts)
+            directory = os.path.dirname(os.path.abspath(self.path))
+            fd, temp_path = tempfile.mkstemp(prefix='.prompts-', suffix='.json', dir=directory)
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump(new_prompts, f, ensure_ascii=False, indent=2)
+                os.replace(temp_path, self.path)
+            except Exception:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+            self._prompts = new_prompts
+            self._version = _compute_version(new_prompts)
+            self._mtime = self._read_mtime()
+        logger.info(f"บันทึกคำแนะนำสำหรับ AI ลงในไฟล์ {self.path} สำเร็จ (เวอร์ชัน {self._version})")
+        return self._version
+
+    def check_for_changes(self):
+        """ตรวจสอบ mtime ของไฟล์ ถ้าเปลี่ยนให้โหลดใหม่"""
+        if self._read_mtime() != self._mtime:
+            logger.info(f"ตรวจพบการเปลี่ยนแปลงของไฟล์ {self.path} กำลังโหลดใหม่")
+            return self.reload()
+        return False
+
+    def start_watching(self):
+        """เริ่ม thread เบื้องหลังสำหรับตรวจสอบการเปลี่ยนแปลงของไฟล์"""
+        if self.reload_interval <= 0 or (self._watcher and self._watcher.is_alive()):
+            return
+        self._stop_event.clear()
+        self._watcher = threading.Thread(target=self._watch, name="prompt-store-watcher", daemon=True)
+        self._watcher.start()
+
+    def stop_watching(self):
+        """หยุด thread ตรวจสอบการเปลี่ยนแปลงของไฟล์"""
+        self._stop_event.set()
+
+    def _watch(self):
+        while not self._stop_event.wait(self.reload_interval):
+            try:
+                self.check_for_changes()
+            except Exception as e:
+                logger.error(f"เกิดข้อผิดพลาดในการตรวจสอบไฟล์คำแนะนำ: {str(e)}")
@@ -0,0 +1,271 @@
+import os
+import hmac
+import time
+import uuid
+import base64
+import hashlib
+import secrets
+import asyncio
+import logging
+import threading
+from dotenv import load_dotenv
+from database import stream_query_results, stream_sql_keyset_pages, encode_page_cursor, decode_page_cursor
+from metrics import metrics
+
+# ตั้งค่าการบันทึกล็อก
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# โหลดค่าจากไฟล์ .env
+load_dotenv()
+
+# จำนวนแถวต่อหน้าเริ่มต้นและสูงสุดของ cursor
+QUERY_CURSOR_PAGE_SIZE = int(os.getenv("QUERY_CURSOR_PAGE_SIZE", "500"))
+QUERY_CURSOR_MAX_PAGE_SIZE = int(os.getenv("QUERY_CURSOR_MAX_PAGE_SIZE", "10000"))
+# ปิด cursor ที่ไม่ถูกใช้งานนานเกินนี้ (วินาที) เพื่อคืนการเชื่อมต่อฐานข้อมูล
+QUERY_CURSOR_IDLE_TIMEOUT = float(os.getenv("QUERY_CURSOR_IDLE_TIMEOUT", "120"))
+# จำนวน cursor ที่เปิดค้างไว้ได้ต่อ worker (แต่ละ cursor ถือการเชื่อมต่อฐานข้อมูลหนึ่งเส้น)
+QUERY_CURSOR_MAX_SESSIONS = int(os.getenv("QUERY_CURSOR_MAX_SESSIONS", "16"))
+# กุญแจสำหรับลงลายมือชื่อ cursor (cursor มีคำสั่ง SQL อยู่ด้วย จึงต้องป้องกันการแก้ไข)
+# ทุก worker ต้องใช้ค่าเดียวกัน ถ้าไม่กำหนดจะสุ่มใหม่ทุก process และ cursor จะใช้ได้เฉพาะใน worker ที่สร้าง
+QUERY_CURSOR_SECRET = os.getenv("QUERY_CURSOR_SECRET", "")
+# อายุของ cursor ที่ส่งให้ client (วินาที) cursor ที่เก่ากว่านี้จะถูกปฏิเสธแม้ลายมือชื่อถูกต้อง
+QUERY_CURSOR_TOKEN_TTL = float(os.getenv("QUERY_CURSOR_TOKEN_TTL", "3600"))
+
+class _CursorSession:
+    """server-side cursor ที่เปิดค้างไว้ระหว่างการเลื่อนหน้า"""
+
+    def __init__(self, query, page_size, position, after=None):
+        self.id = uuid.uuid4().hex
+        self.query = query
+        self.page_size = page_size
+        self.position = position
+        self.last_used = time.monotonic()
+        # อ่านหน้าและปิด cursor ได้ทีละ thread
+        self.lock = threading.Lock()
+        self.closed = False
+        # cursor ที่เริ่มแบบ keyset จะอ่านต่อแบบ keyset เสมอ (ลำดับแถวต้องเหมือนเดิม)
+        self.pages = None
+        if position == 0 or after is not None:
+            self.pages = stream_sql_keyset_pages(query, page_size, after)
+        self.keyset = self.pages is not None
+        self.last_key = after
+        if self.pages is None:
+            self.pages = stream_query_results(query, page_size, position)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            # ปิด generator เพื่อปิด cursor และคืนการเชื่อมต่อให้ pool
+            if hasattr(self.pages, 'close'):
+                self.pages.close()
+
+class QueryCursorManager:
+    """
+    แบ่งหน้าผลลัพธ์ของคำสั่งอ่านข้อมูลใดๆ ด้วย server-side cursor ที่เปิดค้างไว้ระหว่างคำขอ
+
+    แต่ละหน้าอ่านต่อจาก cursor เดิม จึงใช้หน่วยความจำเท่ากับหน้าเดียวไม่ว่าผลลัพธ์จะใหญ่เท่าไร
+    cursor ที่ส่งให้ client เก็บคำสั่งและตำแหน่งไว้ด้วย ถ้า cursor ฝั่งเซิร์ฟเวอร์หมดอายุ ถูกปิด
+    หรือคำขออยู่คนละ worker จะเปิด cursor ใหม่ที่ตำแหน่งเดิม: คำสั่ง SQL ที่แบ่งหน้าแบบ keyset ได้
+    จะอ่านต่อจาก id ของแถวสุดท้าย ส่วนคำสั่งอื่นต้องข้ามแถวก่อนหน้า
+    cursor ลงลายมือชื่อด้วย HMAC-SHA256 ทำให้ client แก้ไขคำสั่งหรือตำแหน่งใน cursor ไม่ได้ และมีอายุตาม token_ttl
+    """
+
+    def __init__(self, page_size=QUERY_CURSOR_PAGE_SIZE, max_page_size=QUERY_CURSOR_MAX_PAGE_SIZE,
+                 idle_timeout=QUERY_CURSOR_IDLE_TIMEOUT, max_sessions=QUERY_CURSOR_MAX_SESSIONS,
+                 secret=QUERY_CURSOR_SECRET, token_ttl=QUERY_CURSOR_TOKEN_TTL):
+        self.page_size = page_size
+        self.token_ttl = token_ttl
+        self.max_page_size = max_page_size
+        self.idle_timeout = idle_timeout
+        if not secret:
+            logger.warning("ไม่ได้กำหนด QUERY_CURSOR_SECRET จะสุ่มกุญแจของ process นี้ (cursor ใช้ข้าม worker ไม่ได้)")
+            secret = secrets.token_hex(32)
+        self._secret = secret.encode('utf-8')
+        self.max_sessions = max(1, max_sessions)
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._cleanup_task = None
+
+    async def start(self):
+        """เริ่มงานปิด cursor ที่ไม่ถูกใช้งาน"""
+        self._cleanup_task = asyncio.create_task(self._cleanup_loop())
+
+    async def stop(self):
+        """หยุดงานเบื้องหลังและปิด cursor ทั้งหมด"""
+        if self._cleanup_task:
+            self._cleanup_task.cancel()
+            await asyncio.gather(self._cleanup_task, return_exceptions=True)
+            self._cleanup_task = None
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+        for session in sessions:
+            with session.lock:
+                session.close()
+
+    async def _cleanup_loop(self):
+        while True:
+            await asyncio.sleep(max(1.0, self.idle_timeout / 2))
+            try:
+                expired = await asyncio.to_thread(self.close_idle)
+                if expired:
+                    logger.info(f"ปิด cursor ที่ไม่ถูกใช้งาน {expired} รายการ")
+            except Exception as e:
+                logger.error(f"เกิดข้อผิดพลาดในการปิด cursor ที่หมดอายุ: {str(e)}")
+
+    def open(self, query, page_size=None):
+        """
+        รันคำสั่งและคืนค่าหน้าแรก
+
+        Returns:
+            dict: rows_json (JSON array ของแถว), row_count, offset และ next_cursor (None ถ้าเป็นหน้าสุดท้าย)
+        """
+        page_size = min(max(1, page_size or self.page_size), self.max_page_size)
+        metrics.increment("query_cursor.opened")
+        return self._read_page(self._create(query, page_size, 0), 0)
+
+    def fetch(self, cursor):
+        """
+        คืนค่าหน้าถัดไปของ cursor
+
+        Raises:
+            ValueError: ถ้า cursor ไม่ถูกต้อง
+        """
+        query, page_size, position, session_id, after = self._parse(cursor)
+        with self._lock:
+            session = self._sessions.get(session_id)
+        if session is not None and session.query == query:
+            page = self._read_page(session, position)
+            if page is not None:
+                return page
+        # cursor ฝั่งเซิร์ฟเวอร์ไม่อยู่แล้ว หรือ client ขอหน้าเดิมซ้ำ: เปิดใหม่ที่ตำแหน่งที่ต้องการ
+        metrics.increment("query_cursor.resumed")
+        return self._read_page(self._create(query, page_size, position, after), position)
+
+    def close(self, cursor):
+        """ปิด cursor ก่อนอ่านครบ คืนค่า True ถ้ามี cursor เปิดอยู่ใน worker นี้"""
+        session_id = self._parse(cursor)[3]
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is None:
+            return False
+        with session.lock:
+            session.close()
+        return True
+
+    def close_idle(self):
+        """ปิด cursor ที่ไม่ถูกใช้งานนานเกิน idle_timeout คืนค่าจำนวนที่ปิด"""
+        deadline = time.monotonic() - self.idle_timeout
+        with self._lock:
+            sessions = [session for session in self._sessions.values() if session.last_used < deadline]
+        closed = 0
+        for session in sessions:
+            if self._discard(session):
+                closed += 1
+        metrics.increment("query_cursor.expired", closed)
+        return closed
+
+    def _sign(self, payload):
+        digest = hmac.new(self._secret, payload.encode('ascii'), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest).decode('ascii').rstrip('=')
+
+    def _encode(self, state):
+        """สร้าง cursor: <payload>.<ลายมือชื่อ> (payload เป็น base64url จึงไม่มีจุด)"""
+        payload = encode_page_cursor(state)
+        return f"{payload}.{self._sign(payload)}"
+
+    def _decode(self, cursor):
+        """
+        ตรวจลายมือชื่อและแปลง cursor กลับเป็นสถานะ
+
+        Raises:
+            ValueError: ถ้า cursor ไม่ถูกต้องหรือถูกแก้ไข
+        """
+        payload, _, signature = (cursor or '').partition('.')
+        if not payload or not signature or not payload.isascii() \
+                or not hmac.compare_digest(signature.encode('utf-8'), self._sign(payload).encode('ascii')):
+            metrics.increment("query_cursor.rejected")
+            raise ValueError("cursor ไม่ถูกต้อง")
+        return decode_page_cursor(payload)
+
+    def _parse(self, cursor):
+        state = self._decode(cursor)
+        query, page_size, position, session_id = state.get('q'), state.get('n'), state.get('o'), state.get('s')
+        if not isinstance(query, str) or not isinstance(page_size, int) or not isinstance(position, int) \
+                or position < 0 or not isinstance(session_id, str) or not isinstance(state.get('e'), (int, float)):
+            raise ValueError("cursor ไม่ถูกต้อง")
+        if state['e'] < time.time():
+            metrics.increment("query_cursor.rejected")
+            raise ValueError("cursor หมดอายุ")
+        return query, min(max(1, page_size), self.max_page_size), position, session_id, state.get('k')
+
+    def _create(self, query, page_size, position, after=None):
+        session = _CursorSession(query, page_size, position, after)
+        with self._lock:
+            self._sessions[session.id] = session
+            overflow = len(self._sessions) - self.max_sessions
+            oldest = sorted(
+                (other for other in self._sessions.values() if other is not session),
+                key=lambda other: other.last_used
+            )[:max(0, overflow)]
+        # เกินจำนวนที่กำหนด: ปิด cursor ที่ไม่ได้ใช้นานที่สุด (client ยังอ่านต่อได้ด้วยการเปิดใหม่)
+        for other in oldest:
+            if self._discard(other):
+                metrics.increment("query_cursor.evicted")
+        return session
+
+    def _discard(self, session):
+        """ปิด cursor ที่ไม่ได้กำลังถูกอ่านอยู่"""
+        if not session.lock.acquire(blocking=False):
+            return False
+        try:
+            with self._lock:
+                self._sessions.pop(session.id, None)
+            session.close()
+            return True
+        finally:
+            session.lock.release()
+
+    def _read_page(self, session, position):
+        """อ่านหนึ่งหน้าจากตำแหน่งที่ระบุ คืนค่า None ถ้า cursor ไม่ได้อยู่ที่ตำแหน่งนั้นแล้ว"""
+        with session.lock:
+            if session.closed or session.position != position:
+                return None
+            try:
+                page = next(session.pages, None)
+            except Exception:
+                with self._lock:
+                    self._sessions.pop(session.id, None)
+                session.close()
+                raise
+            row_count, rows_json = page[:2] if page else (0, '[]')
+            if session.keyset and page:
+                session.last_key = page[2]
+            session.position += row_count
+            session.last_used = time.monotonic()
+            finished = row_count < session.page_size
+            if finished:
+                with self._lock:
+                    self._sessions.pop(session.id, None)
+                session.close()
+        metrics.increment("query_cursor.pages")
+        next_cursor = None
+        if not finished:
+            state = {
+                's': session.id, 'q': session.query, 'n': session.page_size, 'o': session.position,
+                'e': int(time.time() + self.token_ttl)
+            }
+            if session.keyset:
+                state['k'] = session.last_key
+            next_cursor = self._encode(state)
+        return {'rows_json': rows_json, 'row_count': row_count, 'offset': position, 'next_cursor': next_cursor}
+
+    def status(self):
+        """จำนวน cursor ที่เปิดอยู่และการตั้งค่า"""
+        with self._lock:
+            sessions = len(self._sessions)
+        return {'sessions': sessions, 'max_sessions': self.max_sessions, 'idle_timeout': self.idle_timeout}
+
+# instance กลางที่ใช้ร่วมกันทั้งแอปพลิเคชัน
+query_cursors = QueryCursorManager()
@@ -0,0 +1,295 @@
+import os
+import re
+import json
+import time
+import logging
+from datetime import date
+from dotenv import load_dotenv
+from metrics import metrics
+from singleflight import normalize_question
+
+# ตั้งค่าการบันทึกล็อก
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# โหลดค่าจากไฟล์ .env
+load_dotenv()
+
+# เปิด/ปิดการตอบคำถามรูปแบบที่พบบ่อยโดยไม่เรียก AI
+QUERY_TEMPLATES_ENABLED = os.getenv("QUERY_TEMPLATES_ENABLED", "true").lower() == "true"
+# ตอบคำถามที่ได้ค่าเดียว (จำนวน, ผลรวม) โดยไม่ต้องให้ AI วิเคราะห์ผลลัพธ์
+QUERY_TEMPLATES_DIRECT_ANSWER = os.getenv("QUERY_TEMPLATES_DIRECT_ANSWER", "true").lower() == "true"
+# คำพ้องความหมาย JSON {"ลูกค้า": "customers", "ยอดขาย": "orders.total_amount"} (ชื่อตาราง หรือ ตาราง.คอลัมน์)
+QUERY_TEMPLATE_SYNONYMS = json.loads(os.getenv("QUERY_TEMPLATE_SYNONYMS", "{}") or "{}")
+# จำนวนแถวสูงสุดของคำถามแบบ top N
+QUERY_TEMPLATE_MAX_LIMIT = int(os.getenv("QUERY_TEMPLATE_MAX_LIMIT", "1000"))
+
+NUMERIC_TYPES = ('INT', 'DECIMAL', 'NUMERIC', 'FLOAT', 'DOUBLE', 'REAL', 'MONEY', 'INT64', 'DECIMAL128')
+DATE_TYPES = ('DATE', 'TIME')
+
+# รูปแบบคำถามต้องตรงทั้งประโยค เพื่อไม่ให้คำถามที่มีเงื่อนไขอื่น (เช่น "ลูกค้าในกรุงเทพมีกี่คน") ถูกตอบผิด
+COUNT_PATTERNS = [
+    re.compile(r"^(?:how many|count(?: of)?|(?:the )?(?:total )?number of) (?P<table>.+?)(?: are there| do we have| in total| exist| total)?$"),
+    re.compile(r"^(?:นับ)?จำนวน\s*(?P<table>.+?)\s*(?:ทั้งหมด)?\s*(?:มี)?\s*(?:กี่\s*(?:รายการ|คน|แถว|ชิ้น|อัน|ราย)?)?$"),
+    re.compile(r"^(?:มี)?\s*(?P<table>.+?)\s*(?:ทั้งหมด)?\s*(?:มี)?\s*กี่\s*(?:รายการ|คน|แถว|ชิ้น|อัน|ราย)?$"),
+]
+TOP_PATTERNS = [
+    re.compile(r"^(?:show |list |get )?(?:the )?top (?P<n>\d+) (?P<table>.+?) by (?P<column>.+)$"),
+    re.compile(r"^(?:top\s*)?(?P<n>\d+)\s*อันดับ(?:แรก)?\s*(?:ของ)?\s*(?P<table>.+?)\s*(?:เรียง)?ตาม\s*(?P<column>.+)$"),
+    re.compile(r"^(?P<table>.+?)\s*(?:ที่มี|ที่)\s*(?P<column>.+?)\s*(?:สูงสุด|มากที่สุด)\s*(?P<n>\d+)\s*(?:อันดับ(?:แรก)?|รายการ(?:แรก)?)?$"),
+]
+SUM_PATTERNS = [
+    re.compile(r"^(?:what is |what's )?(?:the )?(?:total|sum)(?: of)? (?P<column>.+?)(?: (?:in|from|of) (?P<table>.+?))?(?: (?P<period>this month|this year|today))?$"),
+    re.compile(r"^(?:ยอด)?(?:ผลรวม|รวม)\s*(?:ของ)?\s*(?P<column>.+?)\s*(?:(?:ใน|ของ|จาก)\s*(?P<table>.+?))?\s*(?P<period>เดือนนี้|ปีนี้|วันนี้)?$"),
+    re.compile(r"^(?P<column>.+?)\s*รวม\s*(?:ทั้งหมด)?\s*(?:(?:ใน|ของ|จาก)\s*(?P<table>.+?))?\s*(?P<period>เดือนนี้|ปีนี้|วันนี้)?$"),
+]
+
+PERIODS = {
+    'this month': 'month', 'เดือนนี้': 'month',
+    'this year': 'year', 'ปีนี้': 'year',
+    'today': 'day', 'วันนี้': 'day'
+}
+
+class TemplateMatch:
+    """คำถามที่ตรงกับรูปแบบ พร้อมคำสั่งที่สร้างขึ้นแล้ว"""
+
+    def __init__(self, intent, query, table, column=None, period=None):
+        self.intent = intent
+        self.query = query
+        self.table = table
+        self.column = column
+        self.period = period
+
+    @property
+    def has_direct_answer(self):
+        """คำถามที่ได้ค่าเดียวสามารถตอบได้เลยโดยไม่ต้องให้ AI วิเคราะห์"""
+        return QUERY_TEMPLATES_DIRECT_ANSWER and self.intent in ('count', 'sum')
+
+    def format_answer(self, result):
+        """สร้างคำตอบจากผลลัพธ์ที่มีค่าเดียว"""
+        value = None
+        if isinstance(result, list) and result and isinstance(result[0], dict):
+            value = next(iter(result[0].values()), None)
+        if value is None:
+            value = 0
+        if self.intent == 'count':
+            return f"{self.table} มีทั้งหมด {value:,} รายการ" if isinstance(value, int) else f"{self.table} มีทั้งหมด {value} รายการ"
+        period_text = {'month': ' (เดือนนี้)', 'year': ' (ปีนี้)', 'day': ' (วันนี้)'}.get(self.period, '')
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            value = f"{value:,.2f}"
+        return f"ผลรวมของ {self.column} ใน {self.table}{period_text} คือ {value}"
+
+def _aliases(name):
+    """ชื่อที่ใช้เรียกตาราง/คอลัมน์ได้: ชื่อเดิม, _ เป็นช่องว่าง, และรูปเอกพจน์/พหูพจน์"""
+    base = name.lower()
+    spaced = base.replace('_', ' ')
+    aliases = {base, spaced}
+    for value in (base, spaced):
+        if value.endswith('ies'):
+            aliases.add(value[:-3] + 'y')
+        elif value.endswith('ses') or value.endswith('xes'):
+            aliases.add(value[:-2])
+        elif value.endswith('s'):
+            aliases.add(value[:-1])
+        else:
+            aliases.add(value + 's')
+    return aliases
+
+def _table_columns(table_info):
+    """คอลัมน์ของตาราง SQL หรือฟิลด์ของ collection MongoDB"""
+    return table_info.get('columns') or table_info.get('fields') or []
+
+def _is_type(column, type_names):
+    column_type = str(column.get('type', '')).upper()
+    return any(name in column_type for name in type_names)
+
+class _SchemaIndex:
+    """ดัชนีชื่อตารางและคอลัมน์สำหรับจับคู่กับคำในคำถาม"""
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.tables = {}
+        self.columns = {}
+        for table_name, table_info in schema.items():
+            for alias in _aliases(table_name):
+                self.tables.setdefault(alias, set()).add(table_name)
+            for column in _table_columns(table_info):
+                for alias in _aliases(column['name']):
+                    self.columns.setdefault(alias, set()).add((table_name, column['name']))
+        for word, target in QUERY_TEMPLATE_SYNONYMS.items():
+            word = word.lower()
+            if '.' in target:
+                table_name, column_name = target.split('.', 1)
+                if table_name in schema:
+                    self.columns.setdefault(word, set()).add((table_name, column_name))
+            elif target in schema:
+                self.tables.setdefault(word, set()).add(target)
+
+    def resolve_table(self, phrase):
+        candidates = self.tables.get((phrase or '').strip())
+        return next(iter(candidates)) if candidates and len(candidates) == 1 else None
+
+    def resolve_column(self, phrase, table=None, type_names=None):
+        candidates = self.columns.get((phrase or '').strip(), set())
+        if table:
+            candidates = {item for item in candidates if item[0] == table}
+        if type_names:
+            candidates = {item for item in candidates if _is_type(self.column_info(*item), type_names)}
+        return next(iter(candidates)) if len(candidates) == 1 else None
+
+    def column_info(self, table, column_name):
+        for column in _table_columns(self.schema.get(table, {})):
+            if column['name'] == column_name:
+                return column
+        return {}
+
+    def date_column(self, table):
+        """คอลัมน์วันที่ของตาราง (ต้องมีเพียงคอลัมน์เดียว หรือชื่อบ่งบอกว่าเป็นวันที่สร้าง)"""
+        date_columns = [column['name'] for column in _table_columns(self.schema.get(table, {})) if _is_type(column, DATE_TYPES)]
+        if len(date_columns) == 1:
+            return date_columns[0]
+        for preferred in ('created_at', 'order_date', 'date', 'timestamp', 'created'):
+            if preferred in date_columns:
+                return preferred
+        return None
+
+def _quote(identifier, db_type):
+    if db_type.lower() == 'postgresql':
+        return '"' + identifier.replace('"', '""') + '"'
+    return '`' + identifier.replace('`', '``') + '`'
+
+def _period_range(period, today=None):
+    """ช่วงวันที่ [เริ่ม, สิ้นสุด) ของช่วงเวลา"""
+    today = today or date.today()
+    if period == 'day':
+        start = today
+        end = date.fromordinal(today.toordinal() + 1)
+    elif period == 'month':
+        start = today.replace(day=1)
+        end = date(today.year + (today.month == 12), today.month % 12 + 1, 1)
+    else:
+        start = date(today.year, 1, 1)
+        end = date(today.year + 1, 1, 1)
+    return start.isoformat(), end.isoformat()
+
+def _build_count(table, db_type):
+    if db_type.lower() == 'mongodb':
+        return json.dumps({"collection": table, "aggregate": [{"$count": "count"}]})
+    return f"SELECT COUNT(*) AS count FROM {_quote(table, db_type)}"
+
+def _build_top(table, column, limit, db_type):
+    if db_type.lower() == 'mongodb':
+        return json.dumps({"collection": table, "aggregate": [{"$sort": {column: -1}}, {"$limit": limit}]})
+    return f"SELECT * FROM {_quote(table, db_type)} ORDER BY {_quote(column, db_type)} DESC LIMIT {limit}"
+
+def _build_sum(table, column, date_column, period, db_type):
+    if db_type.lower() == 'mongodb':
+        # คำสั่ง MongoDB เป็น JSON ล้วน จึงระบุเงื่อนไขวันที่ไม่ได้ ให้ AI สร้างแทน
+        if period:
+            return None
+        return json.dumps({"collection": table, "aggregate": [
+            {"$group": {"_id": None, "total": {"$sum": f"${column}"}}},
+            {"$project": {"_id": 0, "total": 1}}
+        ]})
+    query = f"SELECT SUM({_quote(column, db_type)}) AS total FROM {_quote(table, db_type)}"
+    if period:
+        start, end = _period_range(period)
+        quoted_date = _quote(date_column, db_type)
+        query += f" WHERE {quoted_date} >= '{start}' AND {quoted_date} < '{end}'"
+    return query
+
+def _match_count(question, index, db_type):
+    for pattern in COUNT_PATTERNS:
+        match = pattern.match(question)
+        if not match:
+            continue
+        table = index.resolve_table(match.group('table'))
+        if table:
+            return TemplateMatch('count', _build_count(table, db_type), table)
+    return None
+
+def _match_top(question, index, db_type):
+    for pattern in TOP_PATTERNS:
+        match = pattern.match(question)
+        if not match:
+            continue
+        table = index.resolve_table(match.group('table'))
+        limit = int(match.group('n'))
+        if not table or not 0 < limit <= QUERY_TEMPLATE_MAX_LIMIT:
+            continue
+        resolved = index.resolve_column(match.group('column'), table, NUMERIC_TYPES + DATE_TYPES)
+        if resolved:
+            return TemplateMatch('top', _build_top(table, resolved[1], limit, db_type), table, resolved[1])
+    return None
+
+def _match_sum(question, index, db_type):
+    for pattern in SUM_PATTERNS:
+        match = pattern.match(question)
+        if not match:
+            continue
+        table = index.resolve_table(match.group('table')) if match.group('table') else None
+        if match.group('table') and not table:
+            continue
+        resolved = index.resolve_column(match.group('column'), table, NUMERIC_TYPES)
+        if not resolved:
+            continue
+        table, column = resolved
+        period = PERIODS.get(match.group('period')) if match.group('period') else None
+        date_column = index.date_column(table) if period else None
+        if period and not date_column:
+            continue
+        query = _build_sum(table, column, date_column, period, db_type)
+        if query:
+            return TemplateMatch('sum', query, table, column, period)
+    return None
+
+def match_question_template(question, schema, db_type):
+    """
+    จับคู่คำถามกับรูปแบบที่พบบ่อย (จำนวน, top N, ผลรวม) และสร้างคำสั่งโดยไม่เรียก AI
+
+    Args:
+        question (str): คำถามภาษาธรรมชาติ (ไทยหรืออังกฤษ)
+        schema (dict): โครงสร้างฐานข้อมูล
+        db_type (str): ประเภทฐานข้อมูล
+
+    Returns:
+        TemplateMatch หรือ None ถ้าไม่ตรงกับรูปแบบใด (ให้ AI สร้างคำสั่งแทน)
+    """
+    if not QUERY_TEMPLATES_ENABLED or not schema:
+        return None
+    started = time.perf_counter()
+    normalized = normalize_question(question)
+    index = _SchemaIndex(schema)
+    template = None
+    for matcher in (_match_count, _match_top, _match_sum):
+        template = matcher(normalized, index, db_type)
+        if template:
+            break
+    metrics.observe("query_templates.match", (time.perf_counter() - started) * 1000)
+    if template:
+        metrics.increment("query_templates.hits")
+        metrics.increment(f"query_templates.hits.{template.intent}")
+        logger.info(f"คำถามตรงกับรูปแบบ {template.intent}: {template.query}")
+    else:
+        metrics.increment("query_templates.misses")
+    return template
+
+def record_template_fallback():
+    """บันทึกกรณีที่คำสั่งจากรูปแบบรันไม่ผ่านและต้องให้ AI สร้างแทน"""
+    metrics.increment("query_templates.fallbacks")
+
+def get_template_metrics():
+    """สรุปอัตราการตอบคำถามด้วยรูปแบบโดยไม่เรียก AI"""
+    hits = metrics.get_counter("query_templates.hits")
+    misses = metrics.get_counter("query_templates.misses")
+    fallbacks = metrics.get_counter("query_templates.fallbacks")
+    # คำถามที่ตรงรูปแบบแต่ต้องให้ AI สร้างคำสั่งแทนไม่นับเป็นการตอบได้โดยไม่เรียก AI
+    answered = max(0, hits - fallbacks)
+    return {
+        'hits': hits,
+        'misses': misses,
+        'fallbacks': fallbacks,
+        'hit_rate': round(answered / (hits + misses), 4) if hits + misses else 0.0,
+        'by_intent': {intent: metrics.get_counter(f"query_templates.hits.{intent}") for intent in ('count', 'top', 'sum')},
+        'match_latency': metrics.snapshot()['timings'].get("query_templates.match")
+    }
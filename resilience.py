@@ -0,0 +1,345 @@
+import os
+import json
+import time
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from dotenv import load_dotenv
+import openai
+from metrics import metrics
+
+try:
+    import fcntl
+except ImportError:  # Windows ไม่มี fcntl จึงใช้ token bucket แบบในโปรเซสเดียว
+    fcntl = None
+
+# ตั้งค่าการบันทึกล็อก
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# โหลดค่าจากไฟล์ .env
+load_dotenv()
+
+# การ retry
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "3"))
+OPENAI_RETRY_BASE_DELAY = float(os.getenv("OPENAI_RETRY_BASE_DELAY", "0.5"))
+OPENAI_RETRY_MAX_DELAY = float(os.getenv("OPENAI_RETRY_MAX_DELAY", "8"))
+# circuit breaker
+OPENAI_CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("OPENAI_CIRCUIT_FAILURE_THRESHOLD", "5"))
+OPENAI_CIRCUIT_RESET_TIMEOUT = float(os.getenv("OPENAI_CIRCUIT_RESET_TIMEOUT", "30"))
+# token bucket ฝั่ง client (0 = ไม่จำกัด) และโฟลเดอร์สำหรับแชร์สถานะระหว่าง worker
+OPENAI_RATE_LIMIT_RPM = float(os.getenv("OPENAI_RATE_LIMIT_RPM", "0"))
+OPENAI_RATE_LIMIT_TPM = float(os.getenv("OPENAI_RATE_LIMIT_TPM", "0"))
+OPENAI_RATE_LIMIT_STATE_DIR = os.getenv("OPENAI_RATE_LIMIT_STATE_DIR", "")
+OPENAI_RATE_LIMIT_MAX_WAIT = float(os.getenv("OPENAI_RATE_LIMIT_MAX_WAIT", "30"))
+# hedged requests
+OPENAI_HEDGE_ENABLED = os.getenv("OPENAI_HEDGE_ENABLED", "false").lower() == "true"
+OPENAI_HEDGE_MIN_DELAY = float(os.getenv("OPENAI_HEDGE_MIN_DELAY", "0.5"))
+OPENAI_HEDGE_MIN_SAMPLES = int(os.getenv("OPENAI_HEDGE_MIN_SAMPLES", "20"))
+
+class CircuitOpenError(Exception):
+    """upstream ไม่พร้อมใช้งาน circuit breaker จึงปฏิเสธคำขอทันที"""
+
+class RateLimitWaitExceeded(Exception):
+    """ต้องรอ token bucket นานเกินกำหนด"""
+
+class _HedgeSkipped(Exception):
+    """คำขอ hedge ไม่ถูกส่งเพราะได้คำตอบไปแล้ว"""
+
+def is_retryable_error(error):
+    """ข้อผิดพลาดที่ควร retry: 429, 5xx, การเชื่อมต่อล้มเหลว และ timeout"""
+    if isinstance(error, (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return False
+
+def _retry_after_seconds(error):
+    """อ่านค่า Retry-After จาก response ถ้ามี"""
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    value = response.headers.get('retry-after')
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+class CircuitBreaker:
+    """
+    circuit breaker แบบสามสถานะ: closed -> open (เมื่อผิดพลาดติดกันเกินกำหนด) -> half_open (ทดลองหนึ่งคำขอ)
+    """
+
+    def __init__(self, failure_threshold=OPENAI_CIRCUIT_FAILURE_THRESHOLD, reset_timeout=OPENAI_CIRCUIT_RESET_TIMEOUT,
+                 clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = 'closed'
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == 'open' and self._clock() - self._opened_at >= self.reset_timeout:
+                return 'half_open'
+            return self._state
+
+    def before_call(self):
+        """ตรวจสอบก่อนเรียก upstream ถ้า circuit เปิดอยู่จะ raise CircuitOpenError"""
+        with self._lock:
+            if self._state == 'open':
+                if self._clock() - self._opened_at < self.reset_timeout:
+                    metrics.increment("openai.circuit_rejections")
+                    raise CircuitOpenError("OpenAI API ไม่พร้อมใช้งานชั่วคราว กรุณาลองใหม่ภายหลัง")
+                self._state = 'half_open'
+                self._probe_in_flight = False
+            if self._state == 'half_open':
+                if self._probe_in_flight:
+                    metrics.increment("openai.circuit_rejections")
+                    raise CircuitOpenError("OpenAI API ไม่พร้อมใช้งานชั่วคราว กรุณาลองใหม่ภายหลัง")
+                self._probe_in_flight = True
+
+    def release_probe(self):
+        """คืนสิทธิ์ทดลองเรียกในสถานะ half_open เมื่อไม่ได้เรียก upstream จริง"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            if self._state != 'closed':
+                logger.info("OpenAI API กลับมาใช้งานได้ ปิด circuit breaker")
+            self._state = 'closed'
+            self._failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probe_in_flight = False
+            if self._state == 'half_open' or self._failures >= self.failure_threshold:
+                if self._state != 'open':
+                    logger.warning(f"OpenAI API ผิดพลาดติดกัน {self._failures} ครั้ง เปิด circuit breaker")
+                    metrics.increment("openai.circuit_opened")
+                self._state = 'open'
+                self._opened_at = self._clock()
+
+class TokenBucket:
+    """
+    token bucket สำหรับจำกัดอัตราการเรียก API ฝั่ง client
+
+    ถ้ากำหนด state_path จะเก็บสถานะในไฟล์และล็อกด้วย fcntl ทำให้ทุก worker ใช้ bucket เดียวกัน
+    """
+
+    def __init__(self, rate_per_minute, state_path=None, name="bucket"):
+        self.name = name
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(1.0, rate_per_minute / 60.0 * 10)  # burst ได้ประมาณ 10 วินาที
+        self.state_path = state_path if (state_path and fcntl) else None
+        self._lock = threading.Lock()
+        self._tokens = self.capacity
+        self._updated = time.time()
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def _refill(self, tokens, updated, now):
+        return min(self.capacity, tokens + (now - updated) * self.rate)
+
+    def _update_state(self, change):
+        """ปรับสถานะของ bucket ผ่านฟังก์ชัน change(tokens, now) -> (tokens, result)"""
+        now = time.time()
+        with self._lock:
+            if not self.state_path:
+                tokens = self._refill(self._tokens, self._updated, now)
+                self._tokens, result = change(tokens, now)
+                self._updated = now
+                return result
+            with open(self.state_path, 'a+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    raw = f.read()
+                    state = json.loads(raw) if raw else {'tokens': self.capacity, 'updated': now}
+                    tokens = self._refill(state['tokens'], state['updated'], now)
+                    tokens, result = change(tokens, now)
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps({'tokens': tokens, 'updated': now}))
+                    f.flush()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+                return result
+
+    def acquire(self, amount=1.0, max_wait=OPENAI_RATE_LIMIT_MAX_WAIT):
+        """รอจนกว่าจะมี token พอ แล้วหัก token ออก"""
+        if not self.enabled:
+            return 0.0
+        amount = min(amount, self.capacity)
+        waited = 0.0
+
+        def take(tokens, now):
+            if tokens >= amount:
+                return tokens - amount, 0.0
+            return tokens, (amount - tokens) / self.rate
+
+        while True:
+            wait_seconds = self._update_state(take)
+            if wait_seconds <= 0:
+                if waited:
+                    metrics.observe(f"openai.rate_limit_wait.{self.name}", waited * 1000)
+                return waited
+            if waited + wait_seconds > max_wait:
+                raise RateLimitWaitExceeded(f"ต้องรอ rate limit ({self.name}) นานเกิน {max_wait} วินาที")
+            time.sleep(wait_seconds)
+            waited += wait_seconds
+
+    def penalize(self, seconds):
+        """เมื่อได้รับ 429 ให้ทำให้ bucket ติดลบ เพื่อให้ทุก worker ชะลอตามเวลาที่ upstream กำหนด"""
+        if not self.enabled:
+            return
+        self._update_state(lambda tokens, now: (min(tokens, -seconds * self.rate), None))
+
+def _bucket_state_path(name):
+    if not OPENAI_RATE_LIMIT_STATE_DIR:
+        return None
+    os.makedirs(OPENAI_RATE_LIMIT_STATE_DIR, exist_ok=True)
+    return os.path.join(OPENAI_RATE_LIMIT_STATE_DIR, f"openai-{name}.bucket")
+
+class ResilientCaller:
+    """ครอบการเรียก OpenAI API ด้วย rate limit, circuit breaker, hedging และ retry แบบ jitter"""
+
+    def __init__(self):
+        self.breaker = CircuitBreaker()
+        self.request_bucket = TokenBucket(OPENAI_RATE_LIMIT_RPM, _bucket_state_path("requests"), name="requests")
+        self.token_bucket = TokenBucket(OPENAI_RATE_LIMIT_TPM, _bucket_state_path("tokens"), name="tokens")
+        self.hedge_enabled = OPENAI_HEDGE_ENABLED
+        self._hedge_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="openai-hedge")
+
+    def _backoff_delay(self, attempt, error):
+        retry_after = _retry_after_seconds(error)
+        if retry_after is not None:
+            return min(retry_after, OPENAI_RETRY_MAX_DELAY)
+        # full jitter: สุ่มระหว่าง 0 ถึง base * 2^attempt
+        return random.uniform(0, min(OPENAI_RETRY_MAX_DELAY, OPENAI_RETRY_BASE_DELAY * (2 ** attempt)))
+
+    def _hedge_delay(self):
+        """รอถึง p95 ของ latency ก่อนส่งคำขอซ้ำ (ต้องมีตัวอย่างพอ)"""
+        snapshot = metrics.snapshot()['timings'].get("openai.latency")
+        if not snapshot or snapshot['count'] < OPENAI_HEDGE_MIN_SAMPLES:
+            return None
+        return max(OPENAI_HEDGE_MIN_DELAY, metrics.percentile("openai.latency", 95) / 1000)
+
+    def _call_hedged(self, fn):
+        """ส่งคำขอ ถ้ายังไม่ได้คำตอบภายใน p95 ให้ส่งคำขอซ้ำ แล้วใช้คำตอบที่มาถึงก่อน"""
+        delay = self._hedge_delay()
+        if delay is None:
+            return fn()
+        settled = threading.Event()
+
+        def attempt():
+            # คำขอที่ยังไม่เริ่มเมื่อมีคำตอบแล้วจะไม่ถูกส่ง
+            if settled.is_set():
+                metrics.increment("openai.hedge_cancelled")
+                raise _HedgeSkipped()
+            result = fn()
+            settled.set()
+            return result
+
+        primary = self._hedge_executor.submit(attempt)
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+        metrics.increment("openai.hedged_requests")
+        hedge = self._hedge_executor.submit(attempt)
+        futures = [primary, hedge]
+        while futures:
+            done, pending = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        metrics.increment("openai.hedge_wins")
+                    self._cancel_losers(pending)
+                    return future.result()
+            futures = list(pending)
+            if not futures:
+                # ทั้งสองคำขอผิดพลาด ส่งข้อผิดพลาดของคำขอแรกออกไป
+                return primary.result()
+
+    def _cancel_losers(self, futures):
+        """
+        ยกเลิกคำขอที่แพ้ซึ่งยังรอคิวอยู่
+
+        คำขอที่กำลังส่งอยู่หยุดกลางทางไม่ได้ (client แบบ sync) ผลลัพธ์จะถูกทิ้งเมื่อเสร็จ
+        """
+        for future in futures:
+            if future.cancel():
+                metrics.increment("openai.hedge_cancelled")
+
+    def call(self, fn, estimated_tokens=0, hedge=False, stream=False):
+        """
+        เรียก fn() พร้อมกลไกป้องกันความผิดพลาด
+
+        Args:
+            fn (callable): ฟังก์ชันที่เรียก OpenAI API
+            estimated_tokens (int): จำนวน token โดยประมาณ (ใช้กับ token bucket)
+            hedge (bool): อนุญาตให้ส่งคำขอซ้ำเมื่อช้ากว่า p95 (ใช้กับคำขอที่ไม่ใช่ stream)
+            stream (bool): คำขอแบบ stream ซึ่งเวลาที่วัดได้เป็นเพียงเวลาถึง byte แรก
+                จึงบันทึกแยกเป็น openai.stream_first_byte_latency ไม่ให้ปน p95 ที่ใช้ตัดสินการ hedge
+        """
+        for attempt in range(OPENAI_MAX_RETRIES + 1):
+            self.breaker.before_call()
+            try:
+                self.request_bucket.acquire(1)
+                if estimated_tokens:
+                    self.token_bucket.acquire(estimated_tokens)
+            except RateLimitWaitExceeded:
+                # ยังไม่ได้เรียก upstream จึงคืนสิทธิ์ probe ให้ circuit breaker
+                self.breaker.release_probe()
+                raise
+
+            started = time.perf_counter()
+            metrics.increment("openai.requests")
+            try:
+                result = self._call_hedged(fn) if (hedge and self.hedge_enabled) else fn()
+            except Exception as e:
+                if not is_retryable_error(e):
+                    # ข้อผิดพลาดฝั่งคำขอ (เช่น 400) ไม่ได้แปลว่า upstream ล่ม
+                    self.breaker.record_success()
+                    raise
+                self.breaker.record_failure()
+                metrics.increment("openai.failures")
+                if isinstance(e, openai.RateLimitError):
+                    penalty = _retry_after_seconds(e) or OPENAI_RETRY_BASE_DELAY
+                    self.request_bucket.penalize(penalty)
+                    self.token_bucket.penalize(penalty)
+                if attempt >= OPENAI_MAX_RETRIES:
+                    raise
+                delay = self._backoff_delay(attempt, e)
+                metrics.increment("openai.retries")
+                logger.warning(f"เรียก OpenAI API ไม่สำเร็จ ({str(e)}) จะลองใหม่ใน {delay:.2f} วินาที (ครั้งที่ {attempt + 1})")
+                time.sleep(delay)
+                continue
+
+            self.breaker.record_success()
+            latency_metric = "openai.stream_first_byte_latency" if stream else "openai.latency"
+            metrics.observe(latency_metric, (time.perf_counter() - started) * 1000)
+            return result
+
+    def status(self):
+        """สถานะของกลไกป้องกันความผิดพลาด"""
+        return {
+            'circuit_state': self.breaker.state,
+            'hedge_enabled': self.hedge_enabled,
+            'rate_limit_rpm': OPENAI_RATE_LIMIT_RPM,
+            'rate_limit_tpm': OPENAI_RATE_LIMIT_TPM,
+            'rate_limit_shared': bool(self.request_bucket.state_path)
+        }
+
+# instance กลางที่ใช้ร่วมกันทั้งแอปพลิเคชัน
+resilient_caller = ResilientCaller()
@@ -0,0 +1,112 @@
+import re
+import asyncio
+import hashlib
+import logging
+from metrics import metrics
+
+# ตั้งค่าการบันทึกล็อก
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+def normalize_question(question):
+    """ปรับคำถามให้อยู่ในรูปแบบมาตรฐาน: ตัวพิมพ์เล็ก ช่องว่างเดียว และไม่มีเครื่องหมายท้ายประโยค"""
+    normalized = re.sub(r'\s+', ' ', question or '').strip().lower()
+    return normalized.rstrip(' ?？!.。')
+
+def make_key(*parts):
+    """สร้าง key จากหลายส่วนประกอบ"""
+    raw = '\x1f'.join('' if part is None else str(part) for part in parts)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+class _Broadcast:
+    """รัน async generator ครั้งเดียว และกระจาย event ให้ผู้รับทุกราย (ผู้ที่เข้ามาทีหลังจะได้รับ event ย้อนหลังด้วย)"""
+
+    def __init__(self, source, on_finished):
+        self._events = []
+        self._done = False
+        self._subscribers = 0
+        self._condition = asyncio.Condition()
+        self._on_finished = on_finished
+        self._task = asyncio.create_task(self._run(source))
+
+    async def _run(self, source):
+        try:
+            async for event in source:
+                async with self._condition:
+                    self._events.append(event)
+                    self._condition.notify_all()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"เกิดข้อผิดพลาดใน pipeline ที่ใช้ร่วมกัน: {str(e)}")
+        finally:
+            self._on_finished()
+            async with self._condition:
+                self._done = True
+                self._condition.notify_all()
+
+    async def subscribe(self):
+        self._subscribers += 1
+        index = 0
+        try:
+            while True:
+                async with self._condition:
+                    await self._condition.wait_for(lambda: index < len(self._events) or self._done)
+                    batch = self._events[index:]
+                    index = len(self._events)
+                    finished = self._done
+                for event in batch:
+                    yield event
+                if finished and index >= len(self._events):
+                    return
+        finally:
+            self._subscribers -= 1
+            # ถ้าไม่มีผู้รับเหลืออยู่ ไม่จำเป็นต้องทำงานต่อ
+            if self._subscribers == 0 and not self._task.done():
+                logger.info("ผู้รับทั้งหมดยกเลิกการเชื่อมต่อ หยุด pipeline ที่ใช้ร่วมกัน")
+                self._task.cancel()
+
+class SingleFlight:
+    """
+    รวมคำขอที่เหมือนกันซึ่งกำลังทำงานอยู่ ให้เหลือการทำงานจริงเพียงครั้งเดียว
+
+    คำขอแรก (leader) เป็นผู้เริ่มการทำงาน คำขอที่ตามมา (follower) ที่มี key เดียวกันจะรอผลลัพธ์เดียวกัน
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self._streams = {}
+
+    async def do(self, key, coroutine_factory):
+        """รัน coroutine ครั้งเดียวต่อ key ที่กำลังทำงานอยู่ และคืนผลลัพธ์เดียวกันให้ทุกคำขอ"""
+        future = self._calls.get(key)
+        if future is not None:
+            metrics.increment(f"singleflight.{self.name}.coalesced")
+        else:
+            metrics.increment(f"singleflight.{self.name}.executions")
+            future = asyncio.ensure_future(coroutine_factory())
+            self._calls[key] = future
+            future.add_done_callback(lambda _: self._calls.pop(key, None))
+        # shield เพื่อไม่ให้การยกเลิกของคำขอหนึ่งไปยกเลิกงานที่คำขออื่นรออยู่
+        return await asyncio.shield(future)
+
+    def subscribe(self, key, source_factory):
+        """
+        รับ event จาก async generator ที่ใช้ร่วมกันต่อ key
+
+        ถ้ายังไม่มี pipeline ที่กำลังทำงานสำหรับ key นี้ จะเริ่มใหม่จาก source_factory()
+        """
+        broadcast = self._streams.get(key)
+        if broadcast is not None:
+            metrics.increment(f"singleflight.{self.name}.coalesced")
+            logger.info(f"รวมคำขอเข้ากับ pipeline ที่กำลังทำงานอยู่ ({self.name})")
+        else:
+            metrics.increment(f"singleflight.{self.name}.executions")
+            broadcast = _Broadcast(source_factory(), lambda: self._streams.pop(key, None))
+            self._streams[key] = broadcast
+        return broadcast.subscribe()
+
+    def in_flight(self):
+        """จำนวนงานที่กำลังทำงานอยู่"""
+        return len(self._calls) + len(self._streams)
@@ -0,0 +1,206 @@
+import os
+import asyncio
+import logging
+import time
+import threading
+from dotenv import load_dotenv
+from database import execute_sql_query, validate_sql_query
+from metrics import metrics
+
+# ตั้งค่าการบันทึกล็อก
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# โหลดค่าจากไฟล์ .env
+load_dotenv()
+
+# จำนวนคำสั่งที่สร้างพร้อมกัน (0 หรือ 1 = ปิดโหมดนี้)
+SQL_SPECULATIVE_CANDIDATES = int(os.getenv("SQL_SPECULATIVE_CANDIDATES", "0"))
+# ค่า temperature ของแต่ละคำสั่ง คั่นด้วยเครื่องหมายจุลภาค
+SQL_SPECULATIVE_TEMPERATURES = [
+    float(value) for value in os.getenv("SQL_SPECULATIVE_TEMPERATURES", "0.0,0.3,0.6,0.9").split(",") if value.strip()
+]
+# จำนวนรอบสูงสุดที่ให้ AI แก้ไขคำสั่งจากข้อผิดพลาดของฐานข้อมูล
+SQL_REPAIR_ROUNDS = int(os.getenv("SQL_REPAIR_ROUNDS", "1"))
+
+class InvalidSQLCandidate(Exception):
+    """คำสั่งที่สร้างขึ้นไม่ผ่านการตรวจสอบหรือรันไม่ผ่าน"""
+
+    def __init__(self, sql_query, message):
+        super().__init__(message)
+        self.sql_query = sql_query
+
+def is_speculative_enabled(requested=None):
+    """ตรวจสอบว่าจะใช้โหมดสร้างคำสั่งหลายชุดพร้อมกันหรือไม่"""
+    if requested is not None:
+        return requested
+    return SQL_SPECULATIVE_CANDIDATES > 1
+
+def _candidate_temperatures(num_candidates):
+    """เลือกค่า temperature สำหรับคำสั่งแต่ละชุด"""
+    temperatures = SQL_SPECULATIVE_TEMPERATURES or [0.1]
+    return [temperatures[i % len(temperatures)] for i in range(num_candidates)]
+
+class CandidateSkipped(Exception):
+    """ไม่ได้ส่งคำขอสร้างคำสั่งเพราะได้คำสั่งที่ถูกต้องจากชุดอื่นแล้ว"""
+
+def _generate_unless_stopped(service, question, schema, db_type, temperature, stop):
+    # งานที่ยังรอ thread อยู่เมื่อได้ผู้ชนะแล้วจะไม่ส่งคำขอไปยัง OpenAI
+    # (คำขอที่ส่งไปแล้วยกเลิกไม่ได้ จะทำงานจนจบและยังคิดค่าใช้จ่าย)
+    if stop.is_set():
+        metrics.increment("sql_speculation.skipped_candidates")
+        raise CandidateSkipped()
+    return service.generate_sql_from_question(question, schema, db_type, temperature)
+
+async def _generate_and_validate(service, question, schema, db_type, temperature, stop):
+    """สร้างคำสั่งหนึ่งชุดแล้วตรวจสอบด้วย parse + EXPLAIN"""
+    try:
+        sql_query = await asyncio.to_thread(
+            _generate_unless_stopped, service, question, schema, db_type, temperature, stop
+        )
+    except Exception as e:
+        # สร้างคำสั่งไม่สำเร็จ (เช่น OpenAI API ผิดพลาด) จึงไม่มีคำสั่งให้แก้ไข
+        raise InvalidSQLCandidate("", str(e))
+    try:
+        await asyncio.to_thread(validate_sql_query, sql_query)
+    except Exception as e:
+        raise InvalidSQLCandidate(sql_query, str(e))
+    return sql_query
+
+async def _execute(sql_query):
+    """รันคำสั่งที่ผ่านการตรวจสอบแล้ว"""
+    try:
+        return await asyncio.to_thread(execute_sql_query, sql_query)
+    except Exception as e:
+        raise InvalidSQLCandidate(sql_query, str(e))
+
+async def _race_candidates(service, question, schema, db_type, temperatures):
+    """
+    สร้างคำสั่งหลายชุดพร้อมกัน รันคำสั่งแรกที่ผ่านการตรวจสอบ และเลิกรอชุดที่เหลือ
+
+    ชุดที่ยังไม่ได้ส่งคำขอจะไม่ถูกส่ง แต่คำขอที่ส่งไปยัง OpenAI แล้วจะทำงานจนจบและยังคิดค่าใช้จ่าย
+    (cancelled_candidates นับชุดที่เลิกรอ ส่วน skipped_candidates นับชุดที่ไม่ได้ส่งคำขอ)
+
+    Returns:
+        tuple: (sql_query, result)
+
+    Raises:
+        InvalidSQLCandidate: ถ้าไม่มีคำสั่งใดผ่านการตรวจสอบ หรือคำสั่งที่เลือกรันไม่ผ่าน
+    """
+    stop = threading.Event()
+    tasks = [
+        asyncio.create_task(_generate_and_validate(service, question, schema, db_type, temperature, stop))
+        for temperature in temperatures
+    ]
+    last_error = None
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            try:
+                sql_query = await next_done
+            except InvalidSQLCandidate as e:
+                metrics.increment("sql_speculation.invalid_candidates")
+                logger.warning(f"คำสั่งที่สร้างไม่ผ่านการตรวจสอบ: {str(e)}")
+                last_error = e
+                continue
+
+            # ได้คำสั่งที่ถูกต้องแล้ว เลิกรอชุดที่เหลือ
+            stop.set()
+            pending = [task for task in tasks if not task.done()]
+            for task in pending:
+                task.cancel()
+            metrics.increment("sql_speculation.cancelled_candidates", len(pending))
+
+            result = await _execute(sql_query)
+            return sql_query, result
+    finally:
+        stop.set()
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+    raise last_error or InvalidSQLCandidate("", "ไม่สามารถสร้างคำสั่งที่ถูกต้องได้")
+
+async def generate_and_execute_sql(service, question, schema, db_type, num_candidates=None):
+    """
+    สร้างคำสั่ง SQL หลายชุดพร้อมกันด้วย temperature ต่างกัน แล้วรันคำสั่งแรกที่ถูกต้อง
+
+    ถ้าไม่มีคำสั่งใดผ่าน จะส่งข้อผิดพลาดจากฐานข้อมูลกลับให้ AI แก้ไขตามจำนวนรอบที่กำหนด
+
+    Args:
+        service: OpenAIService ที่ใช้สร้างคำสั่ง
+        question (str): คำถามภาษาธรรมชาติ
+        schema (dict): โครงสร้างฐานข้อมูล
+        db_type (str): ประเภทฐานข้อมูล
+        num_candidates (int, optional): จำนวนคำสั่งที่สร้างพร้อมกัน
+
+    Returns:
+        dict: sql_query, result, attempts, repaired และ latency_ms
+    """
+    started = time.perf_counter()
+    num_candidates = max(1, num_candidates or SQL_SPECULATIVE_CANDIDATES or 1)
+    temperatures = _candidate_temperatures(num_candidates)
+    metrics.increment("sql_speculation.requests")
+
+    attempts = len(temperatures)
+    repaired = False
+    try:
+        try:
+            sql_query, result = await _race_candidates(service, question, schema, db_type, temperatures)
+        except InvalidSQLCandidate as error:
+            last_error = error
+            sql_query = None
+            for repair_round in range(SQL_REPAIR_ROUNDS):
+                if not last_error.sql_query:
+                    # ไม่มีคำสั่งที่จะส่งให้ AI แก้ไข
+                    break
+                metrics.increment("sql_speculation.repair_attempts")
+                logger.info(f"เริ่มการแก้ไขคำสั่งรอบที่ {repair_round + 1}")
+                attempts += 1
+                try:
+                    repaired_sql = await asyncio.to_thread(
+                        service.repair_sql_query, question, schema, db_type,
+                        last_error.sql_query, str(last_error)
+                    )
+                    try:
+                        await asyncio.to_thread(validate_sql_query, repaired_sql)
+                    except Exception as e:
+                        raise InvalidSQLCandidate(repaired_sql, str(e))
+                    result = await _execute(repaired_sql)
+                    sql_query = repaired_sql
+                    repaired = True
+                    break
+                except InvalidSQLCandidate as e:
+                    last_error = e
+            if sql_query is None:
+                raise last_error
+    except Exception:
+        metrics.increment("sql_speculation.failures")
+        metrics.observe("sql_speculation.latency", (time.perf_counter() - started) * 1000)
+        raise
+
+    latency_ms = (time.perf_counter() - started) * 1000
+    metrics.increment("sql_speculation.successes")
+    if repaired:
+        metrics.increment("sql_speculation.repaired_successes")
+    metrics.observe("sql_speculation.latency", latency_ms)
+
+    return {
+        'sql_query': sql_query,
+        'result': result,
+        'attempts': attempts,
+        'repaired': repaired,
+        'latency_ms': round(latency_ms, 1)
+    }
+
+def get_speculation_metrics():
+    """สรุปอัตราความสำเร็จและเวลาที่ใช้ของโหมดสร้างคำสั่งหลายชุด"""
+    snapshot = metrics.snapshot()
+    return {
+        'requests': metrics.get_counter("sql_speculation.requests"),
+        'success_rate': metrics.ratio("sql_speculation.successes", "sql_speculation.requests"),
+        'repair_success_rate': metrics.ratio("sql_speculation.repaired_successes", "sql_speculation.repair_attempts"),
+        'invalid_candidates': metrics.get_counter("sql_speculation.invalid_candidates"),
+        'cancelled_candidates': metrics.get_counter("sql_speculation.cancelled_candidates"),
+        'skipped_candidates': metrics.get_counter("sql_speculation.skipped_candidates"),
+        'latency': snapshot['timings'].get("sql_speculation.latency")
+    }
@@ -0,0 +1,108 @@
+import time
+import threading
+from datetime import datetime, date
+from decimal import Decimal
+
+import pytest
+
+from cache import Cache, SQLiteBackend, RedisBackend, serialize, deserialize
+
+def _run_threads(count, target):
+    barrier = threading.Barrier(count)
+    results = [None] * count
+
+    def run(index):
+        barrier.wait()
+        results[index] = target(index)
+
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def _slow_compute(calls):
+    def compute():
+        calls.append(1)
+        time.sleep(0.2)
+        return {"value": 42}
+    return compute
+
+@pytest.fixture(params=["sqlite", "redis"])
+def shared_backends(request, tmp_path):
+    """ที่เก็บร่วมสองตัวที่ชี้ไปยังข้อมูลชุดเดียวกัน (เหมือนสอง worker)"""
+    if request.param == "sqlite":
+        path = str(tmp_path / "cache.db")
+        return SQLiteBackend(path), SQLiteBackend(path)
+    fakeredis = pytest.importorskip("fakeredis")
+    server = fakeredis.FakeServer()
+    return (
+        RedisBackend(client=fakeredis.FakeRedis(server=server)),
+        RedisBackend(client=fakeredis.FakeRedis(server=server))
+    )
+
+def test_get_or_set_computes_once_within_a_process():
+    cache = Cache()
+    calls = []
+    compute = _slow_compute(calls)
+
+    results = _run_threads(8, lambda _: cache.get_or_set("stampede_local", "key", compute, ttl=60))
+
+    assert len(calls) == 1
+    assert results == [{"value": 42}] * 8
+
+def test_get_or_set_computes_once_across_workers(shared_backends):
+    workers = [Cache(backend) for backend in shared_backends]
+    calls = []
+    compute = _slow_compute(calls)
+
+    results = _run_threads(8, lambda index: workers[index % 2].get_or_set("stampede_shared", "key", compute, ttl=60))
+
+    assert len(calls) == 1
+    assert results == [{"value": 42}] * 8
+
+def test_get_or_set_does_not_store_failures():
+    cache = Cache()
+
+    def fail():
+        raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError):
+        cache.get_or_set("failures", "key", fail)
+    assert cache.get_or_set("failures", "key", lambda: "ok") == "ok"
+
+def test_invalidate_bumps_generation_for_every_worker(shared_backends):
+    # local_ttl=0: ไม่เก็บค่าหรือเลข generation ในหน่วยความจำ เพื่อให้เห็นผลจากที่เก็บร่วมทันที
+    first, second = (Cache(backend, local_ttl=0) for backend in shared_backends)
+    first.set("generation", "key", "old", ttl=60)
+    assert second.get("generation", "key") == "old"
+
+    second.invalidate("generation")
+
+    assert first.get("generation", "key") is None
+    assert second.get("generation", "key") is None
+    first.set("generation", "key", "new", ttl=60)
+    assert second.get("generation", "key") == "new"
+
+def test_invalidate_clears_local_tier():
+    cache = Cache()
+    cache.set("local_invalidate", "key", 1)
+    cache.invalidate("local_invalidate")
+    assert cache.get("local_invalidate", "key") is None
+
+def test_msgpack_round_trips_decimal_and_datetime(shared_backends):
+    value = {
+        "amount": Decimal("1234.50"),
+        "created_at": datetime(2024, 1, 2, 3, 4, 5, 678000),
+        "day": date(2024, 1, 2),
+        "rows": [{"price": Decimal("0.10")}]
+    }
+    data = serialize(value)
+    assert data[:1] == b"m"
+    assert deserialize(data) == value
+    assert isinstance(deserialize(data)["amount"], Decimal)
+
+    writer, reader = (Cache(backend, local_ttl=0) for backend in shared_backends)
+    writer.set("msgpack", ("tuple", "key"), value, ttl=60)
+    assert reader.get("msgpack", ("tuple", "key")) == value
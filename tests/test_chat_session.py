@@ -0,0 +1,100 @@
+import threading
+
+from chat_session import ChatSessionStore, estimate_tokens
+
+def _history(count):
+    # แต่ละข้อความประมาณ 14 token: budget 30 เก็บข้อความล่าสุดได้ 2 ข้อความ
+    return [
+        {"role": "user" if index % 2 == 0 else "assistant", "content": f"{index:02d}" + "x" * 38}
+        for index in range(count)
+    ]
+
+class RecordingSummarizer:
+    def __init__(self, block=False):
+        self.calls = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        if not block:
+            self.release.set()
+
+    def __call__(self, previous_summary, messages):
+        self.calls.append((previous_summary, list(messages)))
+        self.started.set()
+        self.release.wait(5)
+        return f"summary-{len(self.calls)}"
+
+def test_history_over_budget_is_summarized_and_recent_turns_kept_in_order():
+    store = ChatSessionStore(history_budget=30)
+    history = _history(10)
+    assert estimate_tokens(history[0]["content"]) == 14
+    session = store.get_or_create(seed_history=history)
+    summarize = RecordingSummarizer()
+
+    assert store.compact_now(session, summarize)
+
+    assert summarize.calls == [("", history[:8])]
+    summary, recent = store.build_context(session)
+    assert summary == "summary-1"
+    assert recent == history[8:]
+
+def test_history_within_budget_is_not_summarized():
+    store = ChatSessionStore(history_budget=30)
+    session = store.get_or_create(seed_history=_history(2))
+    summarize = RecordingSummarizer()
+
+    assert not store.compact_now(session, summarize)
+    assert not store.schedule_compaction(session, summarize)
+    assert summarize.calls == []
+
+def test_next_compaction_continues_from_previous_summary():
+    store = ChatSessionStore(history_budget=30)
+    history = _history(4)
+    session = store.get_or_create(seed_history=history)
+    summarize = RecordingSummarizer()
+    store.compact_now(session, summarize)
+
+    store.append_turn(session, "a" * 40, "b" * 40)
+    store.compact_now(session, summarize)
+
+    assert summarize.calls[1] == ("summary-1", history[2:])
+    assert store.build_context(session) == ("summary-2", [
+        {"role": "user", "content": "a" * 40},
+        {"role": "assistant", "content": "b" * 40}
+    ])
+
+def test_schedule_compaction_does_not_double_summarize_while_pending():
+    store = ChatSessionStore(history_budget=30)
+    history = _history(6)
+    session = store.get_or_create(seed_history=history)
+    summarize = RecordingSummarizer(block=True)
+
+    assert store.schedule_compaction(session, summarize)
+    assert summarize.started.wait(5)
+    assert not store.schedule_compaction(session, summarize)
+    assert not store.compact_now(session, summarize)
+
+    # ข้อความใหม่ระหว่างสรุปต้องไม่หาย
+    store.append_turn(session, "question", "answer")
+    summarize.release.set()
+    store._executor.shutdown(wait=True)
+
+    assert len(summarize.calls) == 1
+    summary, recent = store.build_context(session)
+    assert summary == "summary-1"
+    assert recent == history[4:] + [
+        {"role": "user", "content": "question"},
+        {"role": "assistant", "content": "answer"}
+    ]
+
+def test_failed_summary_keeps_history():
+    store = ChatSessionStore(history_budget=30)
+    history = _history(6)
+    session = store.get_or_create(seed_history=history)
+
+    def failing(previous_summary, messages):
+        raise RuntimeError("upstream down")
+
+    store.compact_now(session, failing)
+
+    assert store.build_context(session) == ("", history)
+    assert not session.compacting
@@ -0,0 +1,28 @@
+import openai_service
+
+def test_import_does_not_open_a_client():
+    assert openai_service.get_openai_client() is None
+    assert openai_service.get_openai_service().client is None
+
+def test_close_releases_the_client_that_was_opened(monkeypatch):
+    monkeypatch.setattr(openai_service, "api_key", "test")
+    client = openai_service.open_openai_client()
+    try:
+        http_client = openai_service._http_client
+        assert client is not None
+        # เปิดซ้ำได้ client ตัวเดิม ไม่สร้าง connection pool ใหม่
+        assert openai_service.open_openai_client() is client
+        assert openai_service.get_openai_service().client is client
+    finally:
+        openai_service.close_openai_client()
+
+    assert http_client.is_closed
+    assert openai_service.get_openai_client() is None
+    assert openai_service.get_openai_service().client is None
+    # ปิดซ้ำได้โดยไม่เกิดข้อผิดพลาด
+    openai_service.close_openai_client()
+
+def test_missing_api_key_opens_nothing(monkeypatch):
+    monkeypatch.setattr(openai_service, "api_key", None)
+    assert openai_service.open_openai_client() is None
+    assert openai_service._http_client is None
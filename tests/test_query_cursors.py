@@ -0,0 +1,102 @@
+import json
+import time
+
+import pytest
+from sqlalchemy import create_engine, text
+
+from database import db_manager, decode_page_cursor, encode_page_cursor
+from query_cursors import QueryCursorManager
+
+@pytest.fixture
+def sql_engine(monkeypatch, tmp_path):
+    """ฐานข้อมูล SQLite ที่มีตาราง items 25 แถว ใช้แทนการเชื่อมต่อ SQL ของแอป"""
+    engine = create_engine(f"sqlite:///{tmp_path / 'cursor.db'}")
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE items (id INTEGER PRIMARY KEY, name TEXT)"))
+        connection.execute(
+            text("INSERT INTO items (id, name) VALUES (:id, :name)"),
+            [{'id': index, 'name': f"item-{index}"} for index in range(1, 26)]
+        )
+    monkeypatch.setattr(db_manager, 'db_type', 'postgresql')
+    monkeypatch.setattr(db_manager, 'query_engine', engine)
+    yield engine
+    engine.dispose()
+
+def _ids(page):
+    return [row['id'] for row in json.loads(page['rows_json'])]
+
+def _resign(manager, cursor, **changes):
+    state = decode_page_cursor(cursor.partition('.')[0])
+    state.update(changes)
+    return manager._encode(state)
+
+def test_pages_are_read_in_order(sql_engine):
+    manager = QueryCursorManager(page_size=10, secret="test")
+    pages = [manager.open("SELECT id, name FROM items")]
+    while pages[-1]['next_cursor']:
+        pages.append(manager.fetch(pages[-1]['next_cursor']))
+
+    assert [page['offset'] for page in pages] == [0, 10, 20]
+    assert sum((_ids(page) for page in pages), []) == list(range(1, 26))
+
+def test_tampered_cursor_is_rejected(sql_engine):
+    manager = QueryCursorManager(page_size=10, secret="test")
+    cursor = manager.open("SELECT id FROM items")['next_cursor']
+    payload, _, signature = cursor.partition('.')
+    state = decode_page_cursor(payload)
+    state['q'] = "SELECT id FROM secrets"
+
+    with pytest.raises(ValueError):
+        manager.fetch(f"{encode_page_cursor(state)}.{signature}")
+    with pytest.raises(ValueError):
+        manager.fetch(f"{payload}.{signature[:-1]}")
+    # ลายมือชื่อจากกุญแจอื่นใช้ไม่ได้
+    with pytest.raises(ValueError):
+        QueryCursorManager(secret="other").fetch(cursor)
+
+def test_expired_cursor_is_rejected(sql_engine):
+    manager = QueryCursorManager(page_size=10, secret="test")
+    cursor = manager.open("SELECT id FROM items")['next_cursor']
+
+    with pytest.raises(ValueError, match="หมดอายุ"):
+        manager.fetch(_resign(manager, cursor, e=int(time.time()) - 1))
+
+@pytest.mark.parametrize("query", [
+    # แบ่งหน้าแบบ keyset
+    "SELECT id, name FROM items WHERE id > 3",
+    # กำหนดลำดับเอง จึงต้องข้ามแถว
+    "SELECT id, name FROM items WHERE id > 3 ORDER BY name DESC",
+])
+def test_evicted_session_resumes_at_the_right_offset(sql_engine, query):
+    manager = QueryCursorManager(page_size=5, secret="test")
+    first = manager.open(query)
+    second = manager.fetch(first['next_cursor'])
+    expected = [_ids(manager.fetch(second['next_cursor']))]
+
+    # ปิด cursor ฝั่งเซิร์ฟเวอร์ทั้งหมด (เช่น ถูกไล่ออกหรือคำขอไปอยู่อีก worker)
+    manager.idle_timeout = -1
+    manager.close_idle()
+    assert manager.status()['sessions'] == 0
+
+    resumed = manager.fetch(second['next_cursor'])
+    assert resumed['offset'] == 10
+    assert [_ids(resumed)] == expected
+    assert resumed['offset'] + resumed['row_count'] == 15
+
+def test_keyset_cursor_resumes_after_last_id(sql_engine):
+    manager = QueryCursorManager(page_size=5, secret="test")
+    cursor = manager.open("SELECT id, name FROM items")['next_cursor']
+    assert decode_page_cursor(cursor.partition('.')[0])['k'] == 5
+
+    manager.idle_timeout = -1
+    manager.close_idle()
+    # แถวที่ถูกลบก่อนตำแหน่งเดิมไม่ทำให้ข้ามหรืออ่านแถวซ้ำ
+    with sql_engine.begin() as connection:
+        connection.execute(text("DELETE FROM items WHERE id <= 2"))
+    assert _ids(manager.fetch(cursor)) == [6, 7, 8, 9, 10]
+
+def test_ordered_query_does_not_use_keyset(sql_engine):
+    manager = QueryCursorManager(page_size=5, secret="test")
+    cursor = manager.open("SELECT id FROM items ORDER BY id DESC")['next_cursor']
+    assert 'k' not in decode_page_cursor(cursor.partition('.')[0])
+    assert _ids(manager.fetch(cursor)) == [20, 19, 18, 17, 16]
@@ -0,0 +1,118 @@
+import json
+from datetime import date
+
+import pytest
+
+import query_templates
+from metrics import MetricsRegistry
+from query_templates import match_question_template, record_template_fallback, get_template_metrics, _period_range
+
+SCHEMA = {
+    'customers': {'columns': [
+        {'name': 'id', 'type': 'INTEGER'},
+        {'name': 'name', 'type': 'VARCHAR(100)'},
+        {'name': 'created_at', 'type': 'DATETIME'}
+    ]},
+    'orders': {'columns': [
+        {'name': 'id', 'type': 'INTEGER'},
+        {'name': 'customer_id', 'type': 'INTEGER'},
+        {'name': 'total_amount', 'type': 'DECIMAL(10, 2)'},
+        {'name': 'order_date', 'type': 'DATE'}
+    ]}
+}
+
+@pytest.fixture(autouse=True)
+def fresh_metrics(monkeypatch):
+    registry = MetricsRegistry()
+    monkeypatch.setattr(query_templates, 'metrics', registry)
+    return registry
+
+@pytest.mark.parametrize("question", [
+    "How many customers?",
+    "number of customers",
+    "จำนวน customers ทั้งหมด",
+    "customers มีกี่คน",
+])
+def test_count_questions(question):
+    template = match_question_template(question, SCHEMA, 'mysql')
+    assert template.intent == 'count'
+    assert template.table == 'customers'
+    assert template.query == "SELECT COUNT(*) AS count FROM `customers`"
+
+def test_table_aliases_resolve_singular_form():
+    template = match_question_template("how many order", SCHEMA, 'postgresql')
+    assert template.query == 'SELECT COUNT(*) AS count FROM "orders"'
+
+@pytest.mark.parametrize("question", [
+    "top 5 orders by total amount",
+    "5 อันดับแรกของ orders ตาม total_amount",
+])
+def test_top_questions_bind_limit_and_column(question):
+    template = match_question_template(question, SCHEMA, 'postgresql')
+    assert template.intent == 'top'
+    assert (template.table, template.column) == ('orders', 'total_amount')
+    assert template.query == 'SELECT * FROM "orders" ORDER BY "total_amount" DESC LIMIT 5'
+
+def test_top_rejects_limit_over_maximum():
+    question = f"top {query_templates.QUERY_TEMPLATE_MAX_LIMIT + 1} orders by total amount"
+    assert match_question_template(question, SCHEMA, 'mysql') is None
+
+def test_top_requires_sortable_column():
+    assert match_question_template("top 5 customers by name", SCHEMA, 'mysql') is None
+
+def test_sum_question_infers_table_from_column():
+    template = match_question_template("total total_amount", SCHEMA, 'mysql')
+    assert template.intent == 'sum'
+    assert template.query == "SELECT SUM(`total_amount`) AS total FROM `orders`"
+
+def test_sum_with_period_binds_date_range():
+    template = match_question_template("ยอดรวม total_amount ของ orders เดือนนี้", SCHEMA, 'mysql')
+    start, end = _period_range('month')
+    assert template.period == 'month'
+    assert template.query == (
+        f"SELECT SUM(`total_amount`) AS total FROM `orders` "
+        f"WHERE `order_date` >= '{start}' AND `order_date` < '{end}'"
+    )
+
+@pytest.mark.parametrize("period, today, expected", [
+    ('day', date(2024, 2, 29), ('2024-02-29', '2024-03-01')),
+    ('month', date(2024, 12, 15), ('2024-12-01', '2025-01-01')),
+    ('year', date(2024, 6, 1), ('2024-01-01', '2025-01-01')),
+])
+def test_period_range(period, today, expected):
+    assert _period_range(period, today) == expected
+
+def test_mongodb_queries_are_json():
+    template = match_question_template("how many customers", SCHEMA, 'mongodb')
+    assert json.loads(template.query) == {"collection": "customers", "aggregate": [{"$count": "count"}]}
+    # เงื่อนไขวันที่ของ MongoDB ให้ AI สร้างแทน
+    assert match_question_template("total total_amount in orders this month", SCHEMA, 'mongodb') is None
+
+@pytest.mark.parametrize("question", [
+    "how many customers in bangkok",
+    "how many products",
+    "ลูกค้าในกรุงเทพมีกี่คน",
+])
+def test_unmatched_questions_fall_back_to_ai(question):
+    assert match_question_template(question, SCHEMA, 'mysql') is None
+
+def test_identifiers_are_quoted():
+    schema = {'weird`table': {'columns': [{'name': 'id', 'type': 'INTEGER'}]}}
+    template = match_question_template("how many weird`table", schema, 'mysql')
+    assert template.query == "SELECT COUNT(*) AS count FROM `weird``table`"
+
+def test_direct_answer_format():
+    template = match_question_template("how many customers", SCHEMA, 'mysql')
+    assert template.has_direct_answer
+    assert template.format_answer([{'count': 1234}]) == "customers มีทั้งหมด 1,234 รายการ"
+
+def test_hit_rate_counts_fallbacks_as_misses():
+    match_question_template("how many customers", SCHEMA, 'mysql')
+    match_question_template("how many orders", SCHEMA, 'mysql')
+    match_question_template("why are sales down", SCHEMA, 'mysql')
+    match_question_template("what changed last week", SCHEMA, 'mysql')
+    record_template_fallback()
+
+    stats = get_template_metrics()
+    assert (stats['hits'], stats['misses'], stats['fallbacks']) == (2, 2, 1)
+    assert stats['hit_rate'] == 0.25
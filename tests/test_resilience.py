@@ -0,0 +1,206 @@
+import time
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import openai
+import pytest
+
+import resilience
+from resilience import CircuitBreaker, CircuitOpenError, ResilientCaller, RateLimitWaitExceeded, TokenBucket
+from metrics import metrics
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+def _status_error(error_class, status_code):
+    request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+    return error_class("error", response=httpx.Response(status_code, request=request), body=None)
+
+def _caller():
+    caller = ResilientCaller()
+    # ไม่ต้องรอจริงระหว่าง retry
+    caller._backoff_delay = lambda attempt, error: 0
+    return caller
+
+def test_circuit_breaker_transitions():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30, clock=clock)
+    assert breaker.state == "closed"
+
+    for _ in range(3):
+        breaker.before_call()
+        breaker.record_failure()
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    clock.advance(30)
+    assert breaker.state == "half_open"
+    breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    breaker.before_call()
+
+def test_circuit_breaker_reopens_when_probe_fails():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, clock=clock)
+    breaker.before_call()
+    breaker.record_failure()
+
+    clock.advance(10)
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    clock.advance(5)
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+def test_circuit_breaker_allows_a_single_half_open_probe():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, clock=clock)
+    breaker.before_call()
+    breaker.record_failure()
+    clock.advance(10)
+
+    allowed = []
+    rejected = []
+
+    def probe():
+        try:
+            breaker.before_call()
+            allowed.append(1)
+        except CircuitOpenError:
+            rejected.append(1)
+
+    threads = [threading.Thread(target=probe) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(allowed) == 1
+    assert len(rejected) == 7
+
+    # probe ที่ไม่ได้เรียก upstream จริงคืนสิทธิ์ให้คำขอถัดไป
+    breaker.release_probe()
+    breaker.before_call()
+
+def test_retries_stop_on_non_retryable_error():
+    caller = _caller()
+    calls = []
+
+    def bad_request():
+        calls.append(1)
+        raise _status_error(openai.BadRequestError, 400)
+
+    with pytest.raises(openai.BadRequestError):
+        caller.call(bad_request)
+    assert len(calls) == 1
+    assert caller.breaker.state == "closed"
+
+def test_retryable_errors_are_retried_until_success():
+    caller = _caller()
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise _status_error(openai.InternalServerError, 500)
+        return "ok"
+
+    assert caller.call(flaky) == "ok"
+    assert len(calls) == 3
+
+def test_retries_give_up_after_max_retries():
+    caller = _caller()
+    calls = []
+
+    def down():
+        calls.append(1)
+        raise _status_error(openai.InternalServerError, 503)
+
+    with pytest.raises(openai.InternalServerError):
+        caller.call(down)
+    assert len(calls) == resilience.OPENAI_MAX_RETRIES + 1
+
+def _hedging_caller(workers):
+    caller = _caller()
+    caller.hedge_enabled = True
+    caller._hedge_delay = lambda: 0.05
+    caller._hedge_executor = ThreadPoolExecutor(max_workers=workers)
+    return caller
+
+def test_hedge_returns_the_faster_response():
+    caller = _hedging_caller(workers=2)
+    calls = []
+    lock = threading.Lock()
+
+    def request():
+        with lock:
+            calls.append(1)
+            attempt = len(calls)
+        if attempt == 1:
+            time.sleep(0.5)
+            return "slow"
+        return "fast"
+
+    wins = metrics.get_counter("openai.hedge_wins")
+    started = time.perf_counter()
+    assert caller.call(request, hedge=True) == "fast"
+    assert time.perf_counter() - started < 0.4
+    assert metrics.get_counter("openai.hedge_wins") == wins + 1
+
+def test_losing_hedge_is_cancelled():
+    # executor มี thread เดียว: คำขอซ้ำต้องรอคิวจนคำขอแรกเสร็จ แล้วจึงถูกยกเลิกโดยไม่ถูกส่ง
+    caller = _hedging_caller(workers=1)
+    calls = []
+
+    def request():
+        calls.append(1)
+        time.sleep(0.2)
+        return "primary"
+
+    cancelled = metrics.get_counter("openai.hedge_cancelled")
+    assert caller.call(request, hedge=True) == "primary"
+    caller._hedge_executor.shutdown(wait=True)
+    assert len(calls) == 1
+    assert metrics.get_counter("openai.hedge_cancelled") == cancelled + 1
+
+@pytest.mark.skipif(resilience.fcntl is None, reason="ต้องใช้ fcntl")
+def test_shared_token_bucket_never_overdraws(tmp_path):
+    state_path = str(tmp_path / "requests.bucket")
+    # 60 ครั้งต่อนาที = 1 token ต่อวินาที, burst 10
+    buckets = [TokenBucket(60, state_path, name="test"), TokenBucket(60, state_path, name="test")]
+    granted = []
+    lock = threading.Lock()
+
+    def worker(bucket):
+        for _ in range(30):
+            try:
+                bucket.acquire(1, max_wait=0)
+            except RateLimitWaitExceeded:
+                continue
+            with lock:
+                granted.append(1)
+
+    started = time.time()
+    threads = [threading.Thread(target=worker, args=(buckets[index % 2],)) for index in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+
+    with open(state_path) as f:
+        state = json.load(f)
+    assert state["tokens"] >= 0
+    assert len(granted) <= buckets[0].capacity + elapsed * buckets[0].rate + 1
+    assert len(granted) >= buckets[0].capacity
@@ -0,0 +1,114 @@
+import asyncio
+
+import pytest
+
+from singleflight import SingleFlight, normalize_question, make_key
+
+def test_concurrent_calls_with_same_key_run_once():
+    async def scenario():
+        flight = SingleFlight("test_once")
+        calls = []
+
+        async def work():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return {"rows": [1, 2, 3]}
+
+        results = await asyncio.gather(*(flight.do("key", work) for _ in range(10)))
+        return calls, results, flight.in_flight()
+
+    calls, results, in_flight = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert results == [{"rows": [1, 2, 3]}] * 10
+    assert in_flight == 0
+
+def test_different_keys_run_separately():
+    async def scenario():
+        flight = SingleFlight("test_keys")
+        calls = []
+
+        async def work(key):
+            calls.append(key)
+            await asyncio.sleep(0.01)
+            return key
+
+        results = await asyncio.gather(*(flight.do(key, lambda key=key: work(key)) for key in ("a", "b", "a")))
+        return calls, results
+
+    calls, results = asyncio.run(scenario())
+    assert sorted(calls) == ["a", "b"]
+    assert results == ["a", "b", "a"]
+
+def test_exception_reaches_every_waiter_and_key_is_released():
+    async def scenario():
+        flight = SingleFlight("test_error")
+        calls = []
+
+        async def failing():
+            calls.append("fail")
+            await asyncio.sleep(0.05)
+            raise RuntimeError("boom")
+
+        results = await asyncio.gather(*(flight.do("key", failing) for _ in range(5)), return_exceptions=True)
+        in_flight_after_error = flight.in_flight()
+
+        async def succeeding():
+            calls.append("ok")
+            return "ok"
+
+        retried = await flight.do("key", succeeding)
+        return calls, results, in_flight_after_error, retried
+
+    calls, results, in_flight_after_error, retried = asyncio.run(scenario())
+    assert all(isinstance(result, RuntimeError) and str(result) == "boom" for result in results)
+    assert len(results) == 5
+    assert in_flight_after_error == 0
+    # key ถูกปล่อยแล้ว การเรียกครั้งถัดไปต้องทำงานใหม่
+    assert calls == ["fail", "ok"]
+    assert retried == "ok"
+
+def test_cancelled_waiter_does_not_cancel_shared_work():
+    async def scenario():
+        flight = SingleFlight("test_cancel")
+
+        async def work():
+            await asyncio.sleep(0.05)
+            return "done"
+
+        first = asyncio.ensure_future(flight.do("key", work))
+        second = asyncio.ensure_future(flight.do("key", work))
+        await asyncio.sleep(0)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(scenario()) == "done"
+
+def test_subscribe_replays_events_to_late_subscribers():
+    async def scenario():
+        flight = SingleFlight("test_stream")
+        runs = []
+
+        async def source():
+            runs.append(1)
+            for index in range(3):
+                await asyncio.sleep(0.01)
+                yield {"index": index}
+
+        async def collect(delay):
+            await asyncio.sleep(delay)
+            return [event async for event in flight.subscribe("key", source)]
+
+        results = await asyncio.gather(collect(0), collect(0.015))
+        return runs, results
+
+    runs, results = asyncio.run(scenario())
+    expected = [{"index": 0}, {"index": 1}, {"index": 2}]
+    assert runs == [1]
+    assert results == [expected, expected]
+
+@pytest.mark.parametrize("first, second", [
+    ("How many users?", "how   many users"),
+    ("ยอดขายเดือนนี้？", "ยอดขายเดือนนี้"),
+])
+def test_equivalent_questions_share_a_key(first, second):
+    assert make_key(normalize_question(first), "mysql") == make_key(normalize_question(second), "mysql")
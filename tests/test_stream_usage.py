@@ -0,0 +1,60 @@
+from openai.types.chat import ChatCompletionChunk
+
+import openai_service
+from metrics import metrics
+from model_router import ModelRoute, cached_prompt_tokens
+
+def _chunk(choices, usage=None):
+    data = {
+        "id": "chatcmpl-test",
+        "object": "chat.completion.chunk",
+        "created": 0,
+        "model": "gpt-4o-mini",
+        "choices": choices,
+    }
+    if usage is not None:
+        data["usage"] = usage
+    return ChatCompletionChunk.model_validate(data)
+
+def test_stream_records_and_charges_dict_usage(monkeypatch):
+    """chunk สุดท้ายของ stream มี usage เป็น dict (openai==1.3.5) ต้องบันทึก token ค่าใช้จ่าย และหักโควตาได้"""
+    charged = []
+    monkeypatch.setattr(openai_service.admission_controller, "charge_tokens", charged.append)
+    route = ModelRoute("usage_test", "small", "gpt-4o-mini", 0)
+    usage = {
+        "prompt_tokens": 1200,
+        "completion_tokens": 30,
+        "total_tokens": 1230,
+        "prompt_tokens_details": {"cached_tokens": 1024},
+    }
+    stream = [
+        _chunk([{"index": 0, "delta": {"content": "สวัสดี"}, "finish_reason": None}]),
+        _chunk([], usage),
+    ]
+    assert isinstance(stream[-1].usage, dict)
+
+    before = {
+        name: metrics.get_counter(f"model_route.{route.name}.{name}")
+        for name in ("prompt_tokens", "cached_tokens", "completion_tokens", "cost_microusd")
+    }
+    service = openai_service.OpenAIService.__new__(openai_service.OpenAIService)
+    chunks = list(service._stream_with_usage(iter(stream), route))
+
+    # chunk ที่มีแต่ usage ไม่ถูกส่งต่อ
+    assert [chunk.choices[0].delta.content for chunk in chunks] == ["สวัสดี"]
+    assert charged == [1230]
+    assert metrics.get_counter(f"model_route.{route.name}.prompt_tokens") - before["prompt_tokens"] == 1200
+    assert metrics.get_counter(f"model_route.{route.name}.cached_tokens") - before["cached_tokens"] == 1024
+    assert metrics.get_counter(f"model_route.{route.name}.completion_tokens") - before["completion_tokens"] == 30
+    assert metrics.get_counter(f"model_route.{route.name}.cost_microusd") > before["cost_microusd"]
+
+def test_cached_prompt_tokens_accepts_objects_and_dicts():
+    class Details:
+        cached_tokens = 64
+
+    class Usage:
+        prompt_tokens_details = Details()
+
+    assert cached_prompt_tokens(Usage()) == 64
+    assert cached_prompt_tokens({"prompt_tokens_details": {"cached_tokens": 64}}) == 64
+    assert cached_prompt_tokens({"prompt_tokens": 10}) == 0
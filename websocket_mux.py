@@ -0,0 +1,218 @@
+import os
+import json
+import time
+import struct
+import asyncio
+import logging
+from dotenv import load_dotenv
+from metrics import metrics
+
+# ตั้งค่าการบันทึกล็อก
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# โหลดค่าจากไฟล์ .env
+load_dotenv()
+
+# จำนวน stream ที่รันพร้อมกันได้ต่อการเชื่อมต่อ WebSocket หนึ่งเส้น
+WS_MAX_STREAMS_PER_CONNECTION = int(os.getenv("WS_MAX_STREAMS_PER_CONNECTION", "4"))
+# จำนวนการเชื่อมต่อ WebSocket สูงสุดต่อ worker
+WS_MAX_CONNECTIONS = int(os.getenv("WS_MAX_CONNECTIONS", "500"))
+
+# close code เมื่อเซิร์ฟเวอร์รับการเชื่อมต่อเพิ่มไม่ได้ (Try Again Later)
+WS_CLOSE_TRY_AGAIN_LATER = 1013
+
+class BinaryBatch:
+    """
+    ข้อมูลผลลัพธ์ที่ส่งเป็น binary frame
+
+    รูปแบบ frame: ความยาว header 4 bytes (big-endian) + header (JSON) + body (JSON array ของแถวข้อมูล)
+    ทำให้ส่งผลลัพธ์ที่แปลงเป็น JSON แล้วได้ทันทีโดยไม่ต้องห่อด้วย JSON อีกชั้น
+    """
+
+    __slots__ = ('header', 'body')
+
+    def __init__(self, header, body):
+        self.header = header
+        self.body = body
+
+    def encode(self, stream_id):
+        header = json.dumps({'id': stream_id, **self.header}, ensure_ascii=False).encode('utf-8')
+        return struct.pack('>I', len(header)) + header + self.body
+
+class _Connection:
+    """การเชื่อมต่อ WebSocket หนึ่งเส้นที่มีหลาย stream ทำงานพร้อมกัน"""
+
+    def __init__(self, multiplexer, websocket, identity=None):
+        self.multiplexer = multiplexer
+        self.websocket = websocket
+        self.identity = identity
+        self.streams = {}
+        self.closed = False
+        # frame ของแต่ละ stream ต้องไม่ถูกส่งซ้อนกันบน socket เดียวกัน
+        self._send_lock = asyncio.Lock()
+
+    async def _send(self, message):
+        if self.closed:
+            return
+        try:
+            async with self._send_lock:
+                await self.websocket.send(message)
+        except Exception as e:
+            logger.warning(f"ส่งข้อมูลผ่าน WebSocket ไม่สำเร็จ: {str(e)}")
+            self.closed = True
+
+    async def send_text(self, text):
+        await self._send({'type': 'websocket.send', 'text': text})
+
+    async def send_json(self, message):
+        await self.send_text(json.dumps(message, ensure_ascii=False, default=str))
+
+    async def send_bytes(self, data):
+        await self._send({'type': 'websocket.send', 'bytes': data})
+
+    async def run(self):
+        """รับ frame จาก client จนกว่าการเชื่อมต่อจะปิด แล้วยกเลิก stream ที่ยังค้างอยู่"""
+        try:
+            while True:
+                message = await self.websocket.receive()
+                if message['type'] == 'websocket.disconnect':
+                    break
+                if message.get('text') is None:
+                    await self.send_json({'error': "รองรับเฉพาะ text frame ที่เป็น JSON"})
+                    continue
+                await self._handle_frame(message['text'])
+        finally:
+            self.closed = True
+            tasks = list(self.streams.values())
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _handle_frame(self, text):
+        try:
+            frame = json.loads(text)
+        except json.JSONDecodeError:
+            await self.send_json({'error': "frame ต้องเป็น JSON"})
+            return
+        if not isinstance(frame, dict) or frame.get('id') is None:
+            await self.send_json({'error': "ต้องระบุ id ของ stream"})
+            return
+
+        stream_id = str(frame['id'])
+        frame_type = frame.get('type')
+        if frame_type == 'cancel':
+            task = self.streams.get(stream_id)
+            if task is None:
+                await self.send_json({'id': stream_id, 'cancelled': False})
+            else:
+                task.cancel()
+            return
+
+        handler = self.multiplexer.handlers.get(frame_type)
+        if handler is None:
+            await self.send_json({'id': stream_id, 'error': f"ไม่รู้จักประเภท stream: {frame_type}"})
+            return
+        if stream_id in self.streams:
+            await self.send_json({'id': stream_id, 'error': "id นี้กำลังถูกใช้งานอยู่"})
+            return
+        if len(self.streams) >= self.multiplexer.max_streams:
+            metrics.increment("ws.streams_rejected")
+            await self.send_json({
+                'id': stream_id,
+                'error': f"มี stream ที่ทำงานอยู่ครบ {self.multiplexer.max_streams} รายการแล้ว",
+                'code': 'too_many_streams'
+            })
+            return
+
+        payload = frame.get('payload') or {}
+        self.streams[stream_id] = asyncio.create_task(self._run_stream(stream_id, frame_type, handler, payload))
+
+    async def _run_stream(self, stream_id, stream_type, handler, payload):
+        started = time.perf_counter()
+        # ใส่ id ลงใน frame โดยไม่ต้องแปลง event ที่เป็น JSON อยู่แล้วซ้ำ
+        prefix = f'{{"id": {json.dumps(stream_id)}, "event": '
+        metrics.increment(f"ws.streams.{stream_type}")
+        release = None
+        try:
+            if self.multiplexer.admit is not None:
+                release = await self.multiplexer.admit(self.identity, stream_type, payload)
+            async for event in handler(payload):
+                if isinstance(event, BinaryBatch):
+                    await self.send_bytes(event.encode(stream_id))
+                elif isinstance(event, str):
+                    await self.send_text(prefix + event + '}')
+                else:
+                    await self.send_json({'id': stream_id, 'event': event})
+                if self.closed:
+                    return
+            await self.send_json({'id': stream_id, 'done': True})
+        except asyncio.CancelledError:
+            metrics.increment("ws.streams_cancelled")
+            await self.send_json({'id': stream_id, 'cancelled': True})
+        except Exception as e:
+            logger.error(f"เกิดข้อผิดพลาดใน stream {stream_type} ({stream_id}): {str(e)}")
+            message = {'id': stream_id, 'error': str(e)}
+            if getattr(e, 'retry_after', None):
+                message['retry_after'] = e.retry_after
+            await self.send_json(message)
+        finally:
+            if release is not None:
+                release()
+            self.streams.pop(stream_id, None)
+            metrics.observe(f"ws.stream.{stream_type}", (time.perf_counter() - started) * 1000)
+
+class StreamMultiplexer:
+    """
+    รวม stream หลายรายการ (chat, analyze, sql_query ฯลฯ) ไว้บน WebSocket เส้นเดียวต่อ browser
+
+    client ส่ง {"id", "type", "payload"} เพื่อเริ่ม stream และ {"id", "type": "cancel"} เพื่อยกเลิก
+    เซิร์ฟเวอร์ส่ง {"id", "event"} ต่อ event, {"id", "done"} / {"id", "cancelled"} / {"id", "error"} เมื่อจบ
+    และส่งผลลัพธ์ขนาดใหญ่เป็น binary frame (ดู BinaryBatch)
+    """
+
+    def __init__(self, max_streams=WS_MAX_STREAMS_PER_CONNECTION, max_connections=WS_MAX_CONNECTIONS):
+        self.handlers = {}
+        # async def admit(identity, stream_type, payload) ที่คืนค่าฟังก์ชันสำหรับคืนสิทธิ์ (ถ้ากำหนด)
+        self.admit = None
+        self.max_streams = max(1, max_streams)
+        self.max_connections = max(1, max_connections)
+        self._connections = set()
+
+    def register(self, stream_type, handler):
+        """
+        ลงทะเบียนประเภท stream
+
+        Args:
+            stream_type (str): ชื่อประเภทที่ client ระบุใน "type"
+            handler (callable): ฟังก์ชันที่รับ payload และคืนค่า async iterator ของ event
+                (dict, str ที่เป็น JSON แล้ว หรือ BinaryBatch)
+        """
+        self.handlers[stream_type] = handler
+
+    async def serve(self, websocket, identity=None):
+        """รับการเชื่อมต่อ WebSocket และจัดการ stream จนกว่าการเชื่อมต่อจะปิด"""
+        await websocket.accept()
+        if len(self._connections) >= self.max_connections:
+            metrics.increment("ws.connections_rejected")
+            await websocket.close(code=WS_CLOSE_TRY_AGAIN_LATER)
+            return
+        connection = _Connection(self, websocket, identity)
+        self._connections.add(connection)
+        metrics.increment("ws.connections")
+        try:
+            await connection.run()
+        finally:
+            self._connections.discard(connection)
+
+    def status(self):
+        """จำนวนการเชื่อมต่อและ stream ที่กำลังทำงาน"""
+        return {
+            'connections': len(self._connections),
+            'active_streams': sum(len(connection.streams) for connection in self._connections),
+            'max_streams_per_connection': self.max_streams,
+            'max_connections': self.max_connections
+        }
+
+# instance กลางที่ใช้ร่วมกันทั้งแอปพลิเคชัน
+stream_multiplexer = StreamMultiplexer()